@@ -1,11 +1,22 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
+import click
 from flask import Flask, jsonify, send_from_directory
-from app.extensions import db,ma,migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.extensions import db,ma
 from app.config import DevelopmentConfig,ProductionConfig,TestingConfig
+from app.startup import StartupTimer, logger as startup_logger
 
 from flask_restx import Api, Resource, fields
 
 def create_app():
+    # The first app of the process also accounts for importing the app package
+    timer = StartupTimer(_IMPORT_STARTED if not _apps_created else time.perf_counter())
+    _apps_created.append(True)
+    timer.mark('imports')
+
     myapp = Flask(__name__)
 
     # Load configuration
@@ -16,8 +27,12 @@ def create_app():
         myapp.config.from_object(TestingConfig)
     else:
         myapp.config.from_object(DevelopmentConfig)
+    if myapp.config['PROXY_TRUSTED_HOPS']:
+        # request.remote_addr is the client's address, not the proxy's
+        myapp.wsgi_app = ProxyFix(myapp.wsgi_app, x_for=myapp.config['PROXY_TRUSTED_HOPS'])
+    timer.mark('config')
 
-
+    api = None
     if myapp.config['SWAGGER_SERVICE']:
         api = Api(myapp, version="1.0", title="Survey API",
           description="API documentation for the Survey project",
@@ -32,15 +47,81 @@ def create_app():
                 }
             },
             )
+    timer.mark('api')
 
-        
     db.init_app(myapp)
     ma.init_app(myapp)
-    migrate.init_app(myapp,db)
+    # Flask-Migrate imports alembic; only CLI invocations (flask db ...) need it when starting lazily
+    if not myapp.config['LAZY_STARTUP'] or click.get_current_context(silent=True) is not None:
+        from app.extensions import migrate
+
+        migrate.init_app(myapp,db)
+    timer.mark('extensions')
+
+    from app.util.instrumentation import init_instrumentation
+    from app.util.metrics import init_metrics
+    from app.util.compression import init_compression
+    from app.util.profiling import init_profiling
+    from app.util.idempotency import init_idempotency
+    from app.util.rate_limit import init_rate_limiting
+    from app.util.dashboard import init_dashboard
+    from app.util.search import init_search
+    from app.util.outbox import init_outbox
+    from app.util.jobs import init_jobs
+    from app.util.tenancy import init_tenancy
+    from app.util.lookup import init_lookups
+    from app.util.mail_service import init_mail
+    from app.util.invitations import init_invitations
+
+    # Instrumentation is registered first so its after_request runs last and sees the final response
+    init_instrumentation(myapp, api)
+    init_tenancy(myapp)
+    init_metrics(myapp)
+    init_compression(myapp)
+    init_profiling(myapp)
+    init_idempotency(myapp)
+    init_rate_limiting(myapp)
+    init_dashboard(myapp)
+    init_search(myapp)
+    init_outbox(myapp)
+    init_jobs(myapp)
+    init_lookups(myapp)
+    init_mail(myapp)
+    init_invitations(myapp)  # after init_tenancy: its tenant hook must run first
+    timer.mark('middleware')
 
     from app.db_init import init_db_command
+    from app.bench import bench_cli
+    from app.archive import archive_cli
+    from app.purge import purge_cli
+    from app.users import users_cli
+    from app.seed import seed_command
+    from app.search import search_cli
+    from app.funnel import funnel_cli
+    from app.outbox import outbox_cli
+    from app.jobs import jobs_cli
+    from app.tenants import tenants_cli
+    from app.lookup import lookup_cli
+    from app.mail import mail_cli
+    from app.invitations import invitations_cli
+    from app.startup import startup_report_command
 
     myapp.cli.add_command(init_db_command)
+    myapp.cli.add_command(bench_cli)
+    myapp.cli.add_command(archive_cli)
+    myapp.cli.add_command(purge_cli)
+    myapp.cli.add_command(users_cli)
+    myapp.cli.add_command(seed_command)
+    myapp.cli.add_command(search_cli)
+    myapp.cli.add_command(funnel_cli)
+    myapp.cli.add_command(outbox_cli)
+    myapp.cli.add_command(jobs_cli)
+    myapp.cli.add_command(tenants_cli)
+    myapp.cli.add_command(lookup_cli)
+    myapp.cli.add_command(mail_cli)
+    myapp.cli.add_command(invitations_cli)
+    myapp.cli.add_command(startup_report_command)
+    timer.mark('cli')
 
 
     from app.model import User
@@ -52,6 +133,19 @@ def create_app():
 
         api.add_namespace(survey_ns, path='/spars/survey')
         api.add_namespace(auth_ns, path='/spars/auth')
+    timer.mark('namespaces')
+
+    # The Swagger spec and mapper configuration otherwise happen on first use; warm-up moves that work before fork
+    if myapp.config['STARTUP_WARMUP']:
+        from app.startup import warm_up
+
+        warm_up(myapp, api)
+        timer.mark('warmup')
+
+    myapp.extensions['startup_timing'] = timer.report()
+    startup_logger.info('startup', extra=dict(event='startup', **myapp.extensions['startup_timing']))
+
+    return myapp
 
 
-    return myapp
\ No newline at end of file
+_apps_created = []
\ No newline at end of file
@@ -0,0 +1,124 @@
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import delete, func, insert, literal, select
+
+from app.extensions import db
+from app.model import Answer, ArchivedAnswer, Survey
+
+archive_cli = AppGroup('archive', help='Move answers of closed surveys to the answer_archive table.')
+
+# Columns copied between answer and answer_archive
+ANSWER_COLUMNS = ('id', 'survey_id', 'question_id', 'answer_text', 'answer_file', 'response_id',
+                  'selected_option_id', 'attempt_id', 'created_at', 'updated_at')
+
+
+def _move_batch(source, target, survey_id, batch_size, extra=None):
+    """Copy one batch of a survey's rows from `source` to `target` and delete them from `source`.
+
+    INSERT .. SELECT and DELETE run in one short transaction per batch, so locks are held only for
+    `batch_size` rows at a time. Returns the number of rows moved.
+    """
+    ids = db.session.execute(
+        select(source.id).where(source.survey_id == survey_id).order_by(source.id).limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    extra = extra or {}
+    columns = list(ANSWER_COLUMNS) + list(extra)
+    selected = [getattr(source, name) for name in ANSWER_COLUMNS] + [literal(value) for value in extra.values()]
+    db.session.execute(insert(target).from_select(columns, select(*selected).where(source.id.in_(ids))))
+    db.session.execute(delete(source).where(source.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
+
+
+def archive_survey(survey_id, batch_size=5000, pause=0.0):
+    """Move every answer of a closed survey to answer_archive and mark the survey archived.
+
+    Safe to interrupt and rerun: reads fall through to the archive while a survey is half moved.
+    Returns the number of answers moved.
+    """
+    moved = 0
+    while True:
+        count = _move_batch(Answer, ArchivedAnswer, survey_id, batch_size, {'archived_at': datetime.utcnow()})
+        moved += count
+        if count < batch_size:
+            break
+        if pause:
+            time.sleep(pause)  # let other writers in between batches
+
+    survey = db.session.get(Survey, survey_id)
+    survey.archived_at = datetime.utcnow()
+    db.session.commit()
+    return moved
+
+
+def restore_survey(survey_id, batch_size=5000, pause=0.0):
+    """Move a survey's answers back from answer_archive, e.g. before reopening it."""
+    survey = db.session.get(Survey, survey_id)
+    survey.archived_at = None
+    db.session.commit()
+
+    moved = 0
+    while True:
+        count = _move_batch(ArchivedAnswer, Answer, survey_id, batch_size)
+        moved += count
+        if count < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return moved
+
+
+def archive_closed_surveys(batch_size=5000, pause=0.0):
+    """Archive all closed surveys that are not archived yet; returns {survey_id: answers moved}."""
+    survey_ids = db.session.execute(
+        select(Survey.id).where(Survey.status == 'close', Survey.archived_at.is_(None)).order_by(Survey.id)
+    ).scalars().all()
+    return {survey_id: archive_survey(survey_id, batch_size, pause) for survey_id in survey_ids}
+
+
+@archive_cli.command('run')
+@click.option('--survey-id', type=int, default=None, help='Archive one closed survey instead of all of them.')
+@click.option('--batch-size', default=5000, show_default=True, help='Answers moved per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@with_appcontext
+def run_command(survey_id, batch_size, pause):
+    """Move answers of closed surveys out of the answer table."""
+    if survey_id is not None:
+        survey = db.session.get(Survey, survey_id)
+        if survey is None or survey.status != 'close':
+            raise click.ClickException(f"Survey {survey_id} does not exist or is not closed.")
+        results = {survey_id: archive_survey(survey_id, batch_size, pause)}
+    else:
+        results = archive_closed_surveys(batch_size, pause)
+
+    for archived_id, moved in results.items():
+        click.echo(f"Survey {archived_id}: archived {moved} answers.")
+    click.echo(f"Archived {len(results)} surveys.")
+
+
+@archive_cli.command('restore')
+@click.argument('survey_id', type=int)
+@click.option('--batch-size', default=5000, show_default=True, help='Answers moved per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@with_appcontext
+def restore_command(survey_id, batch_size, pause):
+    """Move a survey's answers back into the answer table."""
+    if db.session.get(Survey, survey_id) is None:
+        raise click.ClickException(f"Survey {survey_id} does not exist.")
+    click.echo(f"Survey {survey_id}: restored {restore_survey(survey_id, batch_size, pause)} answers.")
+
+
+@archive_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show live and archived answer counts."""
+    live = db.session.execute(select(func.count(Answer.id))).scalar()
+    archived = db.session.execute(select(func.count(ArchivedAnswer.id))).scalar()
+    surveys = db.session.execute(select(func.count(Survey.id)).where(Survey.archived_at.isnot(None))).scalar()
+    click.echo(f"answer: {live} rows, answer_archive: {archived} rows from {surveys} archived surveys.")
@@ -0,0 +1,258 @@
+"""ASGI entry point with native async handlers for the I/O-bound endpoints.
+
+OTP requests and answer submission are served by coroutines on async SQLAlchemy engines
+(aiosqlite/asyncmy), one per tenant database, and an async HTTP client for SMS. Every other route is the regular Flask app,
+bridged through asgiref's WsgiToAsgi. The coroutines only do the I/O differently: the request rules
+are the functions the Flask routes call (app/util/submission.py, the OTP helpers of
+app/util/sms_service.py, login_claims and check_rate_limit of app/decorator.py), run on the
+async connections through `run_sync`.
+"""
+import json
+import re
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, Unauthorized
+
+from app import create_app
+from app.decorator import bearer_token, check_rate_limit, login_claims
+from app.model import Otp, User
+from app.util.invitations import SCHEME as INVITATION_SCHEME, invitation_tenant, invited_user
+from app.util.idempotency import REPLAYED_HEADER, idempotency_key
+from app.util.rate_limit import client_address
+from app.util.sms_service import close_async_client, otp_request_mobile, otp_response, send_otp_async
+from app.util.submission import (record_submission, replayed_submission, role_names, submission_survey, submitted,
+                                 validate_survey_submission_permission)
+from app.util.tenancy import TENANT_HEADER, engine_for, request_tenant
+
+# Sync driver -> async driver used for the same database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+asyncmy',
+    'mysql+pymysql': 'mysql+asyncmy',
+}
+
+
+class JsonError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+
+def async_database_url(url):
+    """Map the Flask-SQLAlchemy engine URL onto its async driver."""
+    if url.drivername not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {url.drivername}")
+    return url.set(drivername=ASYNC_DRIVERS[url.drivername])
+
+
+async def read_json(receive, max_length):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if max_length and len(body) > max_length:
+            raise JsonError(413, {"message": "Request payload too large."})
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        raise JsonError(400, {"message": "Failed to decode JSON object."})
+
+
+async def send_json(send, status, body, headers=None):
+    payload = json.dumps(body).encode()
+    raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+    raw_headers.extend((name.lower().encode('latin1'), value.encode('latin1')) for name, value in (headers or {}).items())
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': raw_headers,
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+class SparsAsgi:
+    """Routes the async paths to coroutines and everything else to the Flask app."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.engines = {}  # tenant -> async engine, None for the default database
+        self.routes = [
+            ('POST', re.compile(r'^/spars/auth/request_otp/?$'), self.request_otp),
+            ('POST', re.compile(r'^/spars/survey/(?P<survey_id>\d+)/answers/?$'), self.submit_answers),
+        ]
+
+    def get_engine(self, tenant=None):
+        if tenant not in self.engines:
+            with self.flask_app.app_context():
+                engine = engine_for(tenant)
+                url = async_database_url(engine.url)
+            self.engines[tenant] = create_async_engine(
+                url, pool_pre_ping=True, execution_options=engine.get_execution_options())
+        return self.engines[tenant]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            for method, pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match and scope['method'] == method:
+                    return await self.dispatch(handler, scope, receive, send, **match.groupdict())
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.get_engine()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines.values():
+                    await engine.dispose()
+                with self.flask_app.app_context():
+                    await close_async_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, handler, scope, receive, send, **params):
+        # Flask 3 keeps the app context in a contextvar, so it is safe to hold across awaits
+        with self.flask_app.app_context():
+            try:
+                data = await read_json(receive, self.flask_app.config['MAX_CONTENT_LENGTH'])
+                # Handlers return (status, body) or (status, body, headers)
+                status, body, *headers = await handler(scope, data, **params)
+            except JsonError as e:
+                status, body, headers = e.status, e.body, []
+            except HTTPException as e:
+                status, body, headers = e.code, {"message": e.description}, []
+        await send_json(send, status, body, headers[0] if headers else None)
+
+    @staticmethod
+    def authorization(scope):
+        return dict(scope['headers']).get(b'authorization', b'').decode('latin1')
+
+    def invitation_token(self, scope):
+        scheme, _, token = self.authorization(scope).partition(' ')
+        return token if scheme == INVITATION_SCHEME and token else None
+
+    def tenant(self, scope):
+        """Tenant whose database the request works on, as resolved for Flask requests."""
+        if not self.flask_app.config['TENANT_DATABASES']:
+            return None
+        invitation = self.invitation_token(scope)
+        if invitation is not None:
+            return invitation_tenant(self.flask_app.config, invitation)
+        requested = dict(scope['headers']).get(TENANT_HEADER.lower().encode('latin1'), b'').decode('latin1')
+        return request_tenant(self.flask_app.config, bearer_token(self.authorization(scope)), requested or None)
+
+    async def authenticate(self, scope, connection):
+        """Async equivalent of token_required; returns the current user.
+
+        On a tenant's connection the user is read from its replica of the tenant's users.
+        """
+        try:
+            data = login_claims(bearer_token(self.authorization(scope)))
+        except Unauthorized as e:
+            raise JsonError(401, {"error": e.description})
+        user = await AsyncSession(bind=connection).get(User, data['sub'])
+        if user is None:
+            raise JsonError(401, {"error": "User is invalid"})
+        return user
+
+    async def invited_user(self, scope, connection, tenant, survey_id):
+        """Async equivalent of invitation_or_token_required with an invitation."""
+        try:
+            return await connection.run_sync(invited_user, tenant, self.invitation_token(scope), survey_id)
+        except HTTPException as e:
+            raise JsonError(e.code, {"error": e.description})
+
+    async def role_names(self, connection, tenant, user_id):
+        """role_names on the default database, which is `connection`'s without a tenant."""
+        if tenant is None:
+            return await connection.run_sync(role_names, user_id)
+        async with self.get_engine().connect() as default:
+            return await default.run_sync(role_names, user_id)
+
+    def check_rate_limit(self, resource, scope, data=None, current_user=None):
+        """check_rate_limit as a (status, body, headers) response, or None."""
+        ip = client_address(scope['client'][0] if scope.get('client') else None,
+                            dict(scope['headers']).get(b'x-forwarded-for', b'').decode('latin1'),
+                            self.flask_app.config['PROXY_TRUSTED_HOPS'])
+        limited = check_rate_limit(resource, ip, data, current_user)
+        if limited is None:
+            return None
+        body, status, headers = limited
+        return status, body, headers
+
+    async def request_otp(self, scope, data):
+        """Async RequestOtp.post"""
+        limited = self.check_rate_limit('request_otp', scope, data)
+        if limited:
+            return limited
+        mobile = otp_request_mobile(data)
+
+        async with self.get_engine().begin() as connection:
+            otp_value = await connection.run_sync(Otp.insert_otp, mobile)
+        body, status = otp_response(await send_otp_async(mobile, otp_value))
+        return status, body
+
+    async def submit_answers(self, scope, data, survey_id):
+        """Async SurveyAnswersResource.post"""
+        answers = data.get('answers') if isinstance(data, dict) else None
+        if not isinstance(answers, list) or not all(
+                isinstance(answer, dict) and isinstance(answer.get('question_id'), int) for answer in answers):
+            return 400, {"errors": {"answers": "A list of answers with integer question_id is required"},
+                         "message": "Input payload validation failed"}
+
+        key = idempotency_key(Headers([(name.decode('latin1'), value.decode('latin1'))
+                                       for name, value in scope['headers']]), data)
+        cache = self.flask_app.extensions['idempotency_cache']
+        tenant = self.tenant(scope)
+        engine = self.get_engine(tenant)
+        try:
+            async with engine.begin() as connection:
+                if self.invitation_token(scope) is not None:
+                    current_user = await self.invited_user(scope, connection, tenant, int(survey_id))
+                    roles = ()
+                else:
+                    current_user = await self.authenticate(scope, connection)
+                    roles = None
+                limited = self.check_rate_limit('submit_answers', scope, data, current_user)
+                if limited:
+                    return limited
+
+                survey = await connection.run_sync(submission_survey, int(survey_id))
+                if roles is None:
+                    roles = await self.role_names(connection, tenant, current_user.id)
+                validate_survey_submission_permission(survey, current_user, roles)
+
+                replayed = await connection.run_sync(replayed_submission, cache, current_user.id, key, survey.id)
+                if replayed is not None:
+                    return 201, replayed, {REPLAYED_HEADER: 'true'}
+
+                attempt_id, answers_count = await connection.run_sync(
+                    record_submission, survey.id, current_user, answers, key
+                )
+        except IntegrityError:
+            if key is None:
+                raise
+            # Lost the race to a concurrent submission with the same key; read its attempt in a new transaction
+            async with engine.connect() as connection:
+                replayed = await connection.run_sync(
+                    replayed_submission, cache, current_user.id, key, survey.id, 'conflict')
+            if replayed is None:
+                raise
+            return 201, replayed, {REPLAYED_HEADER: 'true'}
+
+        return 201, submitted(cache, current_user.id, key, survey.id, attempt_id, answers_count)
+
+
+def create_asgi_app():
+    return SparsAsgi(create_app())
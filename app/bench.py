@@ -0,0 +1,221 @@
+import json
+import os
+import random
+import secrets
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import delete, func, insert, select
+
+from app.extensions import db
+from app.model import (Answer, Option, Otp, Question, Survey, SurveyAttempt, SurveyInvitation, User, survey_editors,
+                       user_roles)
+from app.purge import Throttle, purge_survey
+
+bench_cli = AppGroup('bench', help='Seed benchmark datasets and run load tests.')
+
+BENCH_MOBILE_PREFIX = '8'
+BENCH_OTP_TTL = timedelta(hours=4)
+BENCH_ENVIRONMENTS = ('development', 'testing')  # FLASK_ENV values seed may write to
+
+
+def _check_environment():
+    # Seeded OTPs are working logins; never plant them in a staging or production database
+    env = os.getenv('FLASK_ENV', 'development')
+    if env not in BENCH_ENVIRONMENTS:
+        raise click.ClickException(f"Refusing to seed benchmark users with FLASK_ENV={env}; "
+                                   f"use {' or '.join(BENCH_ENVIRONMENTS)}.")
+
+
+def _next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+@bench_cli.command('seed')
+@click.option('--users', default=100, show_default=True, help='Respondents to create.')
+@click.option('--surveys', default=5, show_default=True, help='Surveys to create.')
+@click.option('--questions', default=20, show_default=True, help='Questions per survey.')
+@click.option('--attempts', default=1000, show_default=True, help='Pre-existing attempts spread over users and surveys.')
+@click.option('--logins', default=100, show_default=True, help='One-time OTPs per user, one is used per login.')
+@click.option('--seed', default=0, show_default=True, help='Random seed for reproducible datasets.')
+@click.option('--manifest', default='bench_dataset.json', show_default=True, help='Where to write the dataset manifest.')
+@with_appcontext
+def seed_command(users, surveys, questions, attempts, logins, seed, manifest):
+    """Seed users, surveys and attempts for benchmarking and write a manifest for loadgen.py.
+
+    Only runs with FLASK_ENV=development or testing. The users log in with a random OTP of this run,
+    written to the manifest only and valid for a few hours; `flask bench clean` removes the dataset.
+    """
+    _check_environment()
+    rng = random.Random(seed)
+    otp = f"{secrets.randbelow(10 ** 6):06d}"
+    now = datetime.utcnow()
+
+    user_rows = []
+    mobiles = []
+    for i in range(users):
+        mobile = f"{BENCH_MOBILE_PREFIX}{seed % 100:02d}{i:07d}"
+        mobiles.append(mobile)
+        user_rows.append({
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'first_name': f"Bench{i}",
+            'mobile': mobile,
+            'created_at': now,
+            'updated_at': now,
+        })
+    db.session.execute(insert(User), user_rows)
+
+    # Each verify_otp call consumes one of the seeded OTPs
+    expiry = now + BENCH_OTP_TTL
+    otp_rows = [{'mobile': mobile, 'otp': otp, 'expiration_time': expiry, 'is_verified': False}
+                for mobile in mobiles for _ in range(logins)]
+    for start in range(0, len(otp_rows), 10000):
+        db.session.execute(insert(Otp), otp_rows[start:start + 10000])
+
+    survey_id = _next_id(Survey)
+    question_id = _next_id(Question)
+    option_id = _next_id(Option)
+    survey_rows, question_rows, option_rows = [], [], []
+    manifest_surveys = []
+    for s in range(surveys):
+        survey_rows.append({
+            'id': survey_id, 'title': f"Benchmark survey {s}", 'description': 'Generated by flask bench seed',
+            'created_by_user_id': user_rows[0]['id'], 'status': 'create', 'created_at': now, 'updated_at': now,
+        })
+        manifest_questions = []
+        for q in range(questions):
+            choice = q % 2 == 0
+            question_rows.append({
+                'id': question_id, 'survey_id': survey_id, 'text': f"Question {q} of survey {s}",
+                'question_type': 'single-choice' if choice else 'text', 'is_required': True,
+                'created_at': now, 'updated_at': now,
+            })
+            option_ids = []
+            if choice:
+                for o in range(4):
+                    option_rows.append({'id': option_id, 'question_id': question_id, 'text': f"Option {o}",
+                                        'order': o, 'created_at': now, 'updated_at': now})
+                    option_ids.append(option_id)
+                    option_id += 1
+            manifest_questions.append({'id': question_id, 'options': option_ids})
+            question_id += 1
+        manifest_surveys.append({'id': survey_id, 'questions': manifest_questions})
+        survey_id += 1
+
+    db.session.execute(insert(Survey), survey_rows)
+    db.session.execute(insert(Question), question_rows)
+    if option_rows:
+        db.session.execute(insert(Option), option_rows)
+
+    attempt_id = _next_id(SurveyAttempt)
+    attempt_rows, answer_rows = [], []
+    for _ in range(attempts):
+        survey = rng.choice(manifest_surveys)
+        attempt_rows.append({'id': attempt_id, 'survey_id': survey['id'],
+                             'user_id': rng.choice(user_rows)['id'], 'attempt_date': now})
+        for question in survey['questions']:
+            selected = rng.choice(question['options']) if question['options'] else None
+            answer_rows.append({
+                'survey_id': survey['id'], 'question_id': question['id'], 'attempt_id': attempt_id,
+                'selected_option_id': selected, 'answer_text': None if selected else f"answer {rng.randint(0, 9999)}",
+                'created_at': now, 'updated_at': now,
+            })
+        attempt_id += 1
+        if len(answer_rows) >= 10000:
+            db.session.execute(insert(SurveyAttempt), attempt_rows)
+            db.session.execute(insert(Answer), answer_rows)
+            attempt_rows, answer_rows = [], []
+    if attempt_rows:
+        db.session.execute(insert(SurveyAttempt), attempt_rows)
+        db.session.execute(insert(Answer), answer_rows)
+
+    db.session.commit()
+
+    with open(manifest, 'w') as fh:
+        json.dump({'seed': seed, 'otp': otp, 'otp_expires_at': expiry.isoformat(timespec='seconds'),
+                   'users': mobiles, 'surveys': manifest_surveys}, fh)
+    click.echo(f"Seeded {users} users, {surveys} surveys x {questions} questions and {attempts} attempts; "
+               f"manifest written to {manifest}. The OTPs expire at {expiry.isoformat(timespec='minutes')}.")
+
+
+@bench_cli.command('clean')
+@click.option('--manifest', default='bench_dataset.json', show_default=True, help='Manifest of the dataset to remove.')
+@with_appcontext
+def clean_command(manifest):
+    """Remove a seeded dataset: its surveys, its users with their attempts and OTPs."""
+    try:
+        with open(manifest) as fh:
+            dataset = json.load(fh)
+    except FileNotFoundError:
+        raise click.ClickException(f"No manifest at {manifest}.")
+    throttle = Throttle(10000, 0)
+    for survey in dataset['surveys']:
+        purge_survey(throttle, survey['id'])
+
+    mobiles = dataset['users']
+    for start in range(0, len(mobiles), 1000):
+        chunk = mobiles[start:start + 1000]
+        user_ids = select(User.id).where(User.mobile.in_(chunk))
+        # Attempts the load test left on other surveys
+        attempt_ids = select(SurveyAttempt.id).where(SurveyAttempt.user_id.in_(user_ids))
+        throttle.delete(Answer, Answer.attempt_id.in_(attempt_ids))
+        throttle.delete(SurveyInvitation, SurveyInvitation.user_id.in_(user_ids))
+        throttle.delete(SurveyAttempt, SurveyAttempt.user_id.in_(user_ids))
+        throttle.delete(Otp, Otp.mobile.in_(chunk))
+        db.session.execute(delete(survey_editors).where(survey_editors.c.user_id.in_(user_ids)))
+        db.session.execute(delete(user_roles).where(user_roles.c.user_id.in_(user_ids)))
+        db.session.execute(delete(User).where(User.mobile.in_(chunk)))
+        db.session.commit()
+    click.echo(f"Removed {len(dataset['surveys'])} surveys and {len(mobiles)} users with their data.")
+
+
+def _loadgen():
+    # loadgen.py lives next to flask_app.py so it can also be copied and run on its own
+    try:
+        import loadgen
+    except ImportError:
+        raise click.ClickException('loadgen.py must be importable; run flask from the project root.')
+    return loadgen
+
+
+@bench_cli.command('run')
+@click.option('--url', default='http://127.0.0.1:5015', show_default=True, help='Base URL of a running server.')
+@click.option('--manifest', default='bench_dataset.json', show_default=True)
+@click.option('--vus', default=8, show_default=True, help='Concurrent virtual users.')
+@click.option('--duration', default=30.0, show_default=True, help='Seconds to run.')
+@click.option('--iterations', default=None, type=int, help='Flows per virtual user instead of a duration.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--out', default=None, help='Write the JSON report to this path.')
+def run_command(url, manifest, vus, duration, iterations, seed, out):
+    """Drive the OTP login -> fetch -> submit -> list flow against a running server."""
+    loadgen = _loadgen()
+    with open(manifest) as fh:
+        dataset = json.load(fh)
+    report = loadgen.run(url, dataset, vus=vus, duration=float('inf') if iterations else duration,
+                         iterations=iterations, seed=seed)
+    click.echo(loadgen.format_report(report))
+    if out:
+        with open(out, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        click.echo(f"Report written to {out}.")
+
+
+@bench_cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--fail-over', default=None, type=float,
+              help='Exit non-zero if any latency regresses by more than this percentage.')
+def compare_command(baseline, current, fail_over):
+    """Compare two JSON reports, e.g. from two commits."""
+    rows = _loadgen().compare(json.load(baseline), json.load(current))
+    regressed = False
+    for name, (old, new, change) in rows.items():
+        click.echo(f"{name:<36}{old if old is not None else '-':>12}{new if new is not None else '-':>12}"
+                   f"{f'{change:+.1f}%' if change is not None else '-':>10}")
+        if fail_over is not None and change is not None and name.endswith('_ms') and change > fail_over:
+            regressed = True
+    if regressed:
+        sys.exit(1)
@@ -1,11 +1,36 @@
+import json
 import os
 from dotenv import load_dotenv
 
+load_dotenv('.env')
+
+
+def tenant_binds(databases):
+    """SQLALCHEMY_BINDS entries for TENANT_DATABASES.
+
+    A tenant is either "<url>" (a database of its own) or {"url": "<url>", "schema": "<schema>"}
+    (a schema on a shared server, through schema_translate_map).
+    """
+    binds = {}
+    for tenant, database in databases.items():
+        if isinstance(database, dict) and database.get('schema'):
+            database = {'url': database['url'],
+                        'execution_options': {'schema_translate_map': {None: database['schema']}}}
+        binds[f"tenant:{tenant}"] = database
+    return binds
+
+
 class Config:
     """Base configuration."""
-    load_dotenv('.env')
     SECRET_KEY = os.getenv('SECRET_KEY', 'your_default_secret_key')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///users.db')  # Default to SQLite
+    # Surveys, attempts and answers of each tenant live in its own database, see app/util/tenancy.py.
+    # {"<tenant>": "<url>" or {"url": "<url>", "schema": "<schema>"}}; users, roles and OTPs stay in
+    # DATABASE_URI, and users without a tenant keep their survey data there too.
+    TENANT_DATABASES = json.loads(os.getenv('TENANT_DATABASES', '{}'))
+    SQLALCHEMY_BINDS = tenant_binds(TENANT_DATABASES)
+    DEFAULT_TENANT = os.getenv('SPARS_TENANT')  # tenant of CLI commands; requests take it from the JWT
+    TENANT_FANOUT_THREADS = 8  # shards queried at once by cross-tenant admin queries
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DEBUG = False
     TESTING = False
@@ -15,40 +40,183 @@ class Config:
     TOKEN_TIME = 5 # IN HOURS
 
     INDEX_ROUTE = True
+
+    # Defer Flask-Migrate, marshmallow schemas and the Swagger spec until first use
+    LAZY_STARTUP = True
+    # Build the deferred pieces inside create_app; set by gunicorn_config.py when preloading
+    STARTUP_WARMUP = os.getenv('SPARS_STARTUP_WARMUP', 'false').lower() == 'true'
     
     LOGGING = True
     REQUEST_LOGGING = True
     RESPONSE_LOGGING = True
     ERROR_LOGGING = True
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    SLOW_QUERY_THRESHOLD_MS = 100
+    SLOW_REQUEST_THRESHOLD_MS = 1000
+    N_PLUS_ONE_THRESHOLD = 10  # Same statement executed this many times in one request
+    SERVER_TIMING_HEADER = False  # Adds Server-Timing and X-Query-Count response headers
 
 
-    SMS_SERVICE = True
+    SMS_SERVICE = os.getenv('SMS_SERVICE', 'false').lower() == 'true'  # send OTPs by SMS (OTP_SERVER); off: only logged
     MAIL_SERVICE = True
     UHID_SERVICE = True
     CDAC_SERVICE = True
 
+    # Patient identity lookups (app/util/lookup.py); a service stays off while its server is unset.
+    # `flask lookup stub` serves both APIs locally.
+    UHID_SERVER = os.getenv('UHID_SERVER')
+    UHID_TOKEN = os.getenv('UHID_TOKEN')
+    CDAC_SERVER = os.getenv('CDAC_SERVER')
+    CDAC_TOKEN = os.getenv('CDAC_TOKEN')
+    LOOKUP_TIMEOUT = (2, 5)  # IN SECONDS, connect and read
+    LOOKUP_POOL_SIZE = 10  # keep-alive connections per service and worker
+    LOOKUP_BATCH_SIZE = 100  # keys per bulk request
+    LOOKUP_CACHE_SIZE = 50000  # records per service and worker
+    LOOKUP_CACHE_TTL = 6 * 60 * 60  # IN SECONDS
+    LOOKUP_NEGATIVE_TTL = 10 * 60  # IN SECONDS, how long "not found" is remembered
+    LOOKUP_BREAKER_THRESHOLD = 5  # consecutive failures that suspend calls to a service
+    LOOKUP_BREAKER_RESET = 30  # IN SECONDS, before a trial call is let through
+    LOOKUP_PREFETCH_THREADS = 2  # background lookups per service and worker
+
+    # Survey invitations and result summaries (app/util/mail_service.py). Messages are queued in the
+    # database and sent by the mail_dispatch job, or `flask mail dispatch`; nothing is sent while
+    # MAIL_SMTP_HOST is unset. `flask mail stub` is a local SMTP server to try it against.
+    MAIL_SMTP_HOST = os.getenv('MAIL_SMTP_HOST')
+    MAIL_SMTP_PORT = int(os.getenv('MAIL_SMTP_PORT', '587'))
+    MAIL_SMTP_USERNAME = os.getenv('MAIL_SMTP_USERNAME')
+    MAIL_SMTP_PASSWORD = os.getenv('MAIL_SMTP_PASSWORD')
+    MAIL_SMTP_STARTTLS = os.getenv('MAIL_SMTP_STARTTLS', 'true').lower() == 'true'
+    MAIL_SENDER = os.getenv('MAIL_SENDER', 'SPARS <noreply@localhost>')
+    MAIL_SMTP_TIMEOUT = 30  # IN SECONDS
+    MAIL_SMTP_CONNECTIONS = 2  # persistent connections per process, sending in parallel
+    MAIL_MESSAGES_PER_CONNECTION = 500  # a connection is reopened after this many messages
+    MAIL_BATCH_SIZE = 200  # messages claimed from the queue at a time
+    MAIL_RATE_LIMIT = 20  # messages per second and process, 0 for no limit
+    MAIL_MAX_ATTEMPTS = 5  # temporary failures before a message is given up
+    MAIL_RETRY_BASE_DELAY = 60  # IN SECONDS, doubled after every failed attempt
+    MAIL_RETRY_MAX_DELAY = 60 * 60  # IN SECONDS
+    MAIL_LEASE_SECONDS = 5 * 60  # how long a dispatcher owns the messages it claimed
+    MAIL_SOFT_BOUNCE_LIMIT = 3  # soft bounces (e.g. mailbox full) after which an address is suppressed
+    MAIL_RETENTION_DAYS = 30  # sent, bounced and failed messages are deleted after this
+    MAIL_TEMPLATE_CACHE_SIZE = 256  # rendered campaign templates per process
+    MAIL_TEMPLATE_CACHE_TTL = 60 * 60  # IN SECONDS
+    MAIL_SURVEY_URL = os.getenv('MAIL_SURVEY_URL', 'http://localhost:5000/survey/{survey_id}')  # link in invitations
+
+    # Survey invitations (app/util/invitations.py): signed tokens answering one survey without an OTP login.
+    # INVITATION_SECRET defaults to a key derived from SECRET_KEY; login tokens never pass as invitations.
+    INVITATION_SECRET = os.getenv('INVITATION_SECRET')
+    INVITATION_URL = os.getenv('INVITATION_URL', 'http://localhost:5000/survey/{survey_id}?invitation={token}')
+    INVITATION_TTL_DAYS = 30
+    INVITATION_BATCH_SIZE = 10000  # invitations written per transaction
+    INVITATION_DENYLIST_CAPACITY = 100000  # revoked invitations per database before the filter is resized
+    INVITATION_DENYLIST_ERROR_RATE = 0.001  # fraction of valid tokens checked against the database
+    INVITATION_DENYLIST_REFRESH = 10  # IN SECONDS, how soon a revocation reaches the other workers
+
     AUTHENTICATION_FLAG = True
     
 
 
     SWAGGER_SERVICE = True
+
+    COMPRESSION_SERVICE = True
+    ETAG_SERVICE = True
+    COMPRESSION_MIN_SIZE = 1024  # IN BYTES, smaller bodies are sent as-is
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BR_LEVEL = 5
+    COMPRESSION_ZSTD_LEVEL = 3
+    COMPRESSION_MIMETYPES = ['application/json', 'text/html', 'text/css', 'text/plain', 'application/javascript']
+    COMPRESSION_CACHE_SIZE = 32 * 1024 * 1024  # IN BYTES
+    # Endpoints whose compressed bodies are cached by ETag (survey definitions)
+    COMPRESSION_CACHE_ENDPOINTS = ['survey_single_survey_resource', 'survey_survey_resource']
+
+    METRICS_SERVICE = True
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # When set, /spars/metrics requires "Bearer <token>"
+    METRICS_REQUIRE_TOKEN = False  # Leave /spars/metrics out (404) until METRICS_TOKEN is set
+
+    # Superadmins can profile a request by sending "X-Spars-Profile: cpu,sample,alloc"
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() == 'true'
+    PROFILING_DIR = os.getenv('PROFILING_DIR')  # Defaults to <instance>/profiles
+    PROFILING_SAMPLE_INTERVAL = 0.001  # IN SECONDS
+    PROFILING_TRACEMALLOC_FRAMES = 25
+    PROFILING_ALLOC_TOP = 50
+    PROFILING_MAX_PROFILES = 200
+
+    # Token buckets shared by all workers on the host through a memory-mapped file.
+    # Limits are "<count>/<second|minute|hour|day>" per resource and per caller identity.
+    # Set RATELIMIT_ENABLED=false when running `flask bench run` from a single host.
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+    RATELIMIT_STORAGE_PATH = os.getenv('RATELIMIT_STORAGE_PATH')  # Defaults to /dev/shm/spars_ratelimit
+    RATELIMIT_SLOTS = 65536
+    # Reverse proxies in front of the app (gunicorn binds to 127.0.0.1 behind one). The client address,
+    # which the "ip" limits key on, is taken from the X-Forwarded-For entry the outermost trusted proxy
+    # added. Set 0 when clients connect directly, or they could pick their address.
+    PROXY_TRUSTED_HOPS = int(os.getenv('PROXY_TRUSTED_HOPS', '1'))
+    RATELIMIT_LIMITS = {
+        'request_otp': {'mobile': '3/minute', 'ip': '30/minute'},  # each OTP costs an SMS
+        'verify_otp': {'mobile': '10/minute', 'ip': '60/minute'},
+        'submit_answers': {'user': '30/minute', 'ip': '300/minute'},
+    }
+
+    # Per-worker cache of idempotency keys already recorded; the database stays the source of truth
+    IDEMPOTENCY_CACHE_SIZE = 10000
+    IDEMPOTENCY_CACHE_TTL = 10 * 60  # IN SECONDS
+
+    # Per-worker cache of /spars/survey/dashboard, revalidated against the user's latest attempt
+    DASHBOARD_CACHE_SIZE = 10000
+    DASHBOARD_CACHE_TTL = 5 * 60  # IN SECONDS
+
+    # Webhooks receiving outbox events: {"<consumer>": {"url": "...", "secret": "..."}}, see app/util/outbox.py.
+    # Deliveries are signed with the consumer's secret; run them with `flask outbox dispatch`.
+    OUTBOX_WEBHOOKS = json.loads(os.getenv('OUTBOX_WEBHOOKS', '{}'))
+    OUTBOX_BATCH_SIZE = 100  # events per webhook request
+    OUTBOX_TIMEOUT = 10  # IN SECONDS, per webhook request
+    OUTBOX_RETRY_BASE_DELAY = 5  # IN SECONDS, doubled after every consecutive failure
+    OUTBOX_RETRY_MAX_DELAY = 10 * 60  # IN SECONDS
+    OUTBOX_LEASE_SECONDS = 5 * 60  # how long a dispatcher owns a consumer before another may take over
+    OUTBOX_POLL_INTERVAL = 1  # IN SECONDS, between dispatch rounds when idle
+    OUTBOX_SETTLE_SECONDS = 5  # how long an id gap may be an uncommitted event before it is skipped
+    OUTBOX_RETENTION_DAYS = 7  # delivered events are kept this long for pull consumers
+
+    # Background jobs (app/util/jobs.py). Every gunicorn worker competes for a lease row in the database;
+    # the one holding it runs the scheduler. `flask jobs worker` runs one outside gunicorn.
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+    SCHEDULER_LEASE_SECONDS = 30  # a dead leader is replaced within this
+    SCHEDULER_THREADS = 4  # for I/O-bound jobs, in the leader process
+    SCHEDULER_PROCESSES = 2  # for CPU-heavy jobs (archival, purge, funnel rebuilds)
+    SCHEDULER_MISFIRE_GRACE = 60 * 60  # IN SECONDS, runs missed by up to this much (no leader) still run once
+    SCHEDULER_RUN_RETENTION_DAYS = 7  # job_run history
+    # Times are UTC; remove an entry to stop scheduling that job
+    SCHEDULER_JOBS = {
+        'cleanup': {'trigger': 'interval', 'minutes': 15},
+        'outbox_dispatch': {'trigger': 'interval', 'seconds': 10},
+        'outbox_prune': {'trigger': 'cron', 'hour': 1, 'minute': 30},
+        'mail_dispatch': {'trigger': 'interval', 'seconds': 10},
+        'archive_closed_surveys': {'trigger': 'cron', 'hour': 2},
+        'purge_deleted': {'trigger': 'cron', 'hour': 3},
+        'funnel_rebuild': {'trigger': 'cron', 'day_of_week': 'sun', 'hour': 4},
+    }
+    OTP_RETENTION_HOURS = 24  # expired OTPs are deleted after this
+
     OTP_SERVER = os.getenv('OTP_SERVER')
     OTP_USERNAME = os.getenv('OTP_USERNAME')
     OTP_PASSWORD = os.getenv('OTP_PASSWORD')
     OTP_ID = os.getenv('OTP_ID')
     OTP_SENDERID = os.getenv('OTP_SENDERID')
+    OTP_SERVER_TIMEOUT = 10  # IN SECONDS
 
 
 
 class DevelopmentConfig(Config):
     """Development configuration."""
     DEBUG = True
+    SERVER_TIMING_HEADER = True
 
 
 class ProductionConfig(Config):
     """Production configuration."""
     SECRET_KEY = os.getenv('SECRET_KEY', 'a_strong_production_secret_key')
     DEBUG = False
+    METRICS_REQUIRE_TOKEN = True
 
 
 class TestingConfig(Config):
@@ -56,3 +224,5 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test_users.db'  # Separate DB for testing
     DEBUG = True
+    SERVER_TIMING_HEADER = True
+    RATELIMIT_ENABLED = False
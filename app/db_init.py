@@ -4,6 +4,7 @@ from flask.cli import with_appcontext
 import click
 from app.extensions import db
 from app.model import User, Role, Survey, Question, Option, QuestionConstraint
+from app.util.tenancy import engine_for, shard_tables, tenants
 
 
 @click.command("init-db")
@@ -13,6 +14,9 @@ def init_db_command():
     click.echo("Dropping and recreating all tables...")
     db.drop_all()
     db.create_all()
+    for tenant in tenants():
+        db.metadata.drop_all(engine_for(tenant), tables=shard_tables())
+        db.metadata.create_all(engine_for(tenant), tables=shard_tables())
     click.echo("Database initialized.")
 
     # Default roles
@@ -2,27 +2,40 @@ from functools import wraps
 from pprint import pprint
 from flask import request, jsonify,current_app
 import jwt
-from app.model import User
+from werkzeug.exceptions import HTTPException, Unauthorized
+from app.extensions import db
+from app.model import SurveyInvitation, User
+from app.util.rate_limit import too_many_requests
+
+
+def bearer_token(authorization):
+    """The token of an `Authorization: Bearer <token>` header value, None if there is none."""
+    parts = (authorization or '').split(' ')
+    return parts[1] if len(parts) == 2 and parts[1] else None
+
+
+def login_claims(token):
+    """Claims of a login token; raises Unauthorized with the message token_required answers with."""
+    if not token:
+        raise Unauthorized("Token is missing!")
+    try:
+        # Decode the token using the secret key
+        return jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"], options={'require': ['sub']})
+    except Exception as e:
+        raise Unauthorized(f"Token is invalid or expired: {str(e)}")
 
 
 def token_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization'].split(' ')[1]  
-
-        if not token:
-            return {"error": "Token is missing!"}, 401
-
         try:
-            # Decode the token using the secret key
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.get(data['sub'])  # Fetch user using the 'sub' claim (user ID)
-            if not current_user:
-                return {"error": "User is invalid"}, 401
-        except Exception as e:
-            return {"error": f"Token is invalid or expired: {str(e)}"}, 401
+            data = login_claims(bearer_token(request.headers.get('Authorization')))
+        except Unauthorized as e:
+            return {"error": e.description}, 401
+
+        current_user = User.query.get(data['sub'])  # Fetch user using the 'sub' claim (user ID)
+        if not current_user:
+            return {"error": "User is invalid"}, 401
 
         # Pass current_user and other arguments to the wrapped function
         return f(*args, current_user=current_user, **kwargs)
@@ -30,6 +43,28 @@ def token_required(f):
     return decorated_function
 
 
+def invitation_or_token_required(f):
+    """token_required that also accepts `Authorization: Invitation <token>` for the survey in the URL;
+    current_user is then an InvitedUser (see app/util/invitations.py)."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Invitation':
+            return token_required(f)(*args, **kwargs)
+
+        # Imported here: both import the tenancy module, which imports this one
+        from app.util.invitations import invited_user
+        from app.util.tenancy import current_tenant
+        try:
+            connection = db.session.connection(bind_arguments={'mapper': SurveyInvitation})
+            current_user = invited_user(connection, current_tenant(), token, kwargs.get('survey_id'))
+        except HTTPException as e:
+            return {"error": e.description}, e.code
+        return f(*args, current_user=current_user, **kwargs)
+
+    return decorated_function
+
+
 def verify_superadmin(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -56,3 +91,38 @@ def verify_superadmin(f):
     return decorated_function
 
 
+def check_rate_limit(resource, ip, data=None, current_user=None):
+    """Take the tokens of a request to `resource`; returns the 429 response (body, status, headers) or None.
+
+    The mobile bucket is keyed on the "mobile" of a JSON object body, the user one on current_user.
+    """
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return None
+    mobile = data.get('mobile') if isinstance(data, dict) else None
+    retry_after = limiter.check(resource, {
+        'ip': ip,
+        'mobile': str(mobile) if mobile is not None else None,
+        'user': current_user.id if current_user is not None else None,
+    })
+    return too_many_requests(retry_after) if retry_after is not None else None
+
+
+def rate_limit(resource):
+    """Throttle a view with the token buckets configured for `resource` in RATELIMIT_LIMITS.
+
+    Place it below token_required so the per-user bucket can use current_user.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            limited = check_rate_limit(resource, request.remote_addr, request.get_json(silent=True),
+                                       kwargs.get('current_user'))
+            if limited is not None:
+                return limited
+
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
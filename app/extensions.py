@@ -1,8 +1,28 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_marshmallow import Marshmallow
-from flask_migrate import Migrate
 
 
-db = SQLAlchemy()
+class TenantSession(Session):
+    """Sends statements on tenant data to the current tenant's bind, see app/util/tenancy.py."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            from app.util.tenancy import tenant_bind
+
+            bind = tenant_bind(self._db, mapper, clause)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': TenantSession})
 ma = Marshmallow()
-migrate = Migrate()
+
+
+def __getattr__(name):
+    # Flask-Migrate pulls in alembic, which serving workers never need, so it is imported on first use
+    if name == 'migrate':
+        from flask_migrate import Migrate
+
+        globals()['migrate'] = Migrate()
+        return globals()['migrate']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,27 @@
+import time
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from app.extensions import db
+from app.model import Survey
+from app.util.funnel import rebuild_funnels
+
+funnel_cli = AppGroup('funnel', help='Completion funnel maintenance.')
+
+
+@funnel_cli.command('rebuild')
+@click.option('--survey-id', type=int, default=None, help='Rebuild one survey instead of all of them.')
+@with_appcontext
+def rebuild_command(survey_id):
+    """Recompute funnels from the stored attempts and answers.
+
+    Submissions keep funnels up to date; rebuild after bulk loads, after restoring data, or when a
+    survey's questions were edited after attempts came in.
+    """
+    if survey_id is not None and db.session.get(Survey, survey_id) is None:
+        raise click.ClickException(f"Survey {survey_id} does not exist.")
+
+    started = time.perf_counter()
+    rebuilt = rebuild_funnels(None if survey_id is None else [survey_id])
+    click.echo(f"Rebuilt {rebuilt} survey version funnels in {time.perf_counter() - started:.1f}s.")
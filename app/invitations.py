@@ -0,0 +1,130 @@
+import csv
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import select
+
+from app.extensions import db
+from app.model import Survey, User
+from app.util.invitations import (create_invitations, invitation_stats, invitation_url, issue_token, live_invitations,
+                                  revoke_invitations)
+from app.util.tenancy import current_tenant
+
+invitations_cli = AppGroup('invitations', help='Signed survey invitations: bulk creation, export and revocation.')
+
+
+def _survey(survey_id):
+    survey = db.session.get(Survey, survey_id)
+    if survey is None or survey.is_deleted:
+        raise click.ClickException(f"Survey {survey_id} not found (tenant: {current_tenant() or 'default'}).")
+    return survey
+
+
+def _tenant_user_ids(chunk_size=10000):
+    """Ids of the current tenant's users, read a chunk at a time (invitations commit in between)."""
+    tenant = current_tenant()
+    in_tenant = User.tenant_id.is_(None) if tenant is None else User.tenant_id == tenant
+    after = ''
+    while True:
+        ids = db.session.execute(
+            select(User.id).where(in_tenant, User.id > after).order_by(User.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            return
+        yield from ids
+        after = ids[-1]
+
+
+def _file_user_ids(lines, mobiles, chunk_size=1000):
+    """User ids from a file of user ids or, with `mobiles`, of mobile numbers; unknown mobiles are left out."""
+    values = (line.strip() for line in lines)
+    values = [value for value in values if value]
+    if not mobiles:
+        yield from values
+        return
+    for start in range(0, len(values), chunk_size):
+        yield from db.session.execute(
+            select(User.id).where(User.mobile.in_(values[start:start + chunk_size]))).scalars().all()
+
+
+class _LinkWriter:
+    """CSV of invitation links with the users' mobile numbers, for sending them by other channels."""
+
+    def __init__(self, output, survey_id):
+        self.writer = csv.writer(output)
+        self.writer.writerow(('invitation_id', 'user_id', 'mobile', 'link'))
+        self.survey_id = survey_id
+
+    def __call__(self, invitations):
+        mobiles = dict(db.session.execute(select(User.id, User.mobile).where(
+            User.id.in_([user_id for _, user_id, _ in invitations]))).all())
+        self.writer.writerows((invitation_id, user_id, mobiles.get(user_id),
+                               invitation_url(current_app.config, self.survey_id, token))
+                              for invitation_id, user_id, token in invitations)
+
+
+@invitations_cli.command('create')
+@click.argument('survey_id', type=int)
+@click.option('--all-users', is_flag=True, help="Invite every user of the tenant (SPARS_TENANT).")
+@click.option('--users-file', type=click.File(), help='File with one user id per line.')
+@click.option('--mobiles', is_flag=True, help='The users file lists mobile numbers instead of user ids.')
+@click.option('--days', type=click.IntRange(1, 365), default=None, help='Days the invitations stay valid [default: INVITATION_TTL_DAYS].')
+@click.option('--email', is_flag=True, help='Queue an email with the link for users who have an address.')
+@click.option('--output', type=click.File('w'), help='Write the new links to this CSV file ("-" for stdout).')
+@with_appcontext
+def create_command(survey_id, all_users, users_file, mobiles, days, email, output):
+    """Invite users to SURVEY_ID, INVITATION_BATCH_SIZE per transaction; users already invited are skipped."""
+    if all_users == (users_file is not None):
+        raise click.UsageError("Give exactly one of --all-users and --users-file.")
+    if email and not current_app.config['MAIL_SERVICE']:
+        raise click.ClickException("Mail is disabled, set MAIL_SERVICE=true.")
+    survey = _survey(survey_id)
+    user_ids = _tenant_user_ids() if all_users else _file_user_ids(users_file, mobiles)
+    expires_at = datetime.utcnow() + timedelta(days=days or current_app.config['INVITATION_TTL_DAYS'])
+
+    started = time.perf_counter()
+    stats = create_invitations(survey, user_ids, expires_at, email=email,
+                               on_batch=_LinkWriter(output, survey.id) if output is not None else None)
+    click.echo(', '.join(f"{count} {name.replace('_', ' ')}" for name, count in stats.items() if name != 'campaign_id')
+               + f" in {time.perf_counter() - started:.1f}s; valid until {expires_at.isoformat(timespec='seconds')}",
+               err=True)
+
+
+@invitations_cli.command('export')
+@click.argument('survey_id', type=int)
+@click.option('--output', type=click.File('w'), default='-', show_default=True, help='CSV file to write.')
+@with_appcontext
+def export_command(survey_id, output):
+    """Write the links of SURVEY_ID's pending invitations again; tokens are not stored, they are re-signed."""
+    survey = _survey(survey_id)
+    writer = _LinkWriter(output, survey.id)
+    tenant = current_tenant()
+    for rows in live_invitations(survey.id):
+        writer([(row.id, row.user_id, issue_token(current_app.config, row.id, survey.id, row.user_id, tenant,
+                                                  row.expires_at)) for row in rows])
+
+
+@invitations_cli.command('revoke')
+@click.argument('survey_id', type=int)
+@click.argument('invitation_ids', nargs=-1)
+@click.option('--all', 'revoke_all', is_flag=True, help='Revoke every invitation to the survey.')
+@with_appcontext
+def revoke_command(survey_id, invitation_ids, revoke_all):
+    """Revoke INVITATION_IDS of SURVEY_ID, or all of them with --all."""
+    if revoke_all == bool(invitation_ids):
+        raise click.UsageError("Give invitation ids or --all.")
+    survey = _survey(survey_id)
+    revoked = revoke_invitations(survey.id, None if revoke_all else list(invitation_ids))
+    click.echo(f"{revoked} invitations revoked; workers refuse them within "
+               f"{current_app.config['INVITATION_DENYLIST_REFRESH']}s")
+
+
+@invitations_cli.command('status')
+@click.argument('survey_id', type=int)
+@with_appcontext
+def status_command(survey_id):
+    """Show how many invitations to SURVEY_ID are pending, accepted, revoked and expired."""
+    stats = invitation_stats(_survey(survey_id).id)
+    click.echo(', '.join(f"{count} {name}" for name, count in stats.items()))
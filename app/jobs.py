@@ -0,0 +1,54 @@
+import json
+import signal
+import threading
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+from app.util.jobs import JOBS, job_status, run_job, start_scheduler, stop_scheduler
+
+jobs_cli = AppGroup('jobs', help='Background job scheduler.')
+
+
+@jobs_cli.command('list')
+@with_appcontext
+def list_command():
+    """Show the scheduler leader and each job's schedule, next and last run."""
+    status = job_status()
+    leader = status['leader']
+    click.echo(f"leader: {leader['holder']} until {leader['expires_at']}" if leader else "leader: none")
+    for job in status['jobs']:
+        last = job['last_run']
+        last = f"{last['status']} at {last['started_at']} in {last['duration_ms']}ms" if last else 'never run'
+        schedule = job['schedule'] or ('not scheduled yet' if job['enabled'] else 'disabled')
+        click.echo(f"{job['id']:>24} [{job['executor']}] {schedule}, next {job['next_run_at']}, last {last}")
+
+
+@jobs_cli.command('run')
+@click.argument('job_id', type=click.Choice(list(JOBS)))
+@with_appcontext
+def run_command(job_id):
+    """Run one job now, in this process; the run is recorded like a scheduled one."""
+    click.echo(json.dumps(run_job(job_id), default=str))
+
+
+@jobs_cli.command('worker')
+@with_appcontext
+def worker_command():
+    """Compete for scheduler leadership and run jobs until interrupted.
+
+    For deployments where the app is not served by gunicorn (the ASGI entry point, `flask run`), or
+    to keep jobs out of the serving processes altogether with SCHEDULER_ENABLED=false for those.
+    """
+    current_app.config['SCHEDULER_ENABLED'] = True
+    leader = start_scheduler(current_app._get_current_object())
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopped.set())
+    click.echo(f"Scheduler worker {leader.holder} started.")
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_scheduler()
+    click.echo("Scheduler worker stopped, lease released.")
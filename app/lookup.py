@@ -0,0 +1,156 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from app.util.lookup import LookupFailed, lookup_client
+
+lookup_cli = AppGroup('lookup', help='Patient identity lookups (UHID, CDAC services).')
+
+SERVICES = ('uhid', 'cdac')
+
+
+@lookup_cli.command('get')
+@click.argument('service', type=click.Choice(SERVICES))
+@click.argument('keys', nargs=-1, required=True)
+@with_appcontext
+def get_command(service, keys):
+    """Look up KEYS (UHIDs, or mobile numbers for cdac), in batches, and print the records."""
+    client = lookup_client(service)
+    if client is None:
+        raise click.ClickException(f"The {service} service is disabled, set {service.upper()}_SERVER.")
+    started = time.perf_counter()
+    try:
+        records = client.get_many(keys)
+    except LookupFailed as e:
+        raise click.ClickException(str(e))
+    for key, record in records.items():
+        click.echo(f"{key}: {json.dumps(record) if record is not None else 'not found'}")
+    click.echo(f"{len(records)} keys in {(time.perf_counter() - started) * 1000:.1f}ms", err=True)
+
+
+@lookup_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show the configured services; circuit and cache are per process, so this shows a fresh client."""
+    for service in SERVICES:
+        client = lookup_client(service)
+        click.echo(f"{service}: " + (json.dumps(client.status()) if client is not None else 'disabled'))
+
+
+def _stub_uhid(mobile):
+    return f"AIIMS{int(hashlib.blake2b(mobile.encode(), digest_size=8).hexdigest(), 16) % 10 ** 8:08d}"
+
+
+def _stub_known(key, missing_rate):
+    return int(hashlib.blake2b(key.encode(), digest_size=8).hexdigest(), 16) % 1000 >= missing_rate * 1000
+
+
+_STUB_SINGLE = re.compile(r'^/(registrations|patients)/([^/_][^/]*)$')
+_STUB_BATCH = re.compile(r'^/(registrations|patients)/_batch$')
+
+
+class StubLookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't wait for the ACK
+
+    def _delay_or_fail(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rng.random() < server.fail_rate:
+            self._answer(503, {'message': 'failing on purpose'})
+            return True
+        return False
+
+    def do_GET(self):
+        match = _STUB_SINGLE.match(self.path)
+        if match is None:
+            return self._answer(404, {'message': 'unknown path'})
+        if self._delay_or_fail():
+            return
+        record = self.server.apis[match.group(1)][0](match.group(2))
+        self._answer(200, record) if record else self._answer(404, {'message': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        match = _STUB_BATCH.match(self.path)
+        if match is None:
+            return self._answer(404, {'message': 'unknown path'})
+        if self._delay_or_fail():
+            return
+        lookup, collection = self.server.apis[match.group(1)]
+        records = [lookup(str(key)) for key in json.loads(body).get('ids', [])]
+        self._answer(200, {collection: [record for record in records if record]})
+
+    def _answer(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        self.server.on_request(self.command, self.path, args[1] if len(args) > 1 else '')
+
+
+class StubLookupServer(ThreadingHTTPServer):
+    """The UHID and the CDAC API with made-up, deterministic records, for `flask lookup stub` and the tests.
+
+    A `fail_rate` fraction of the requests is answered with a 503; `requests` counts the requests
+    received and `on_request(method, path, status)` is called after each.
+    """
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0, missing_rate=0.2, on_request=None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.missing_rate = missing_rate
+        self.on_request = on_request or (lambda method, path, status: None)
+        self.requests = 0
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.apis = {'registrations': (self.registration, 'registrations'), 'patients': (self.patient, 'patients')}
+        super().__init__(address, StubLookupHandler)
+
+    def registration(self, mobile):
+        if not _stub_known(mobile, self.missing_rate):
+            return None
+        return {'mobile': mobile, 'uhid': _stub_uhid(mobile), 'registered_on': '2024-01-01'}
+
+    def patient(self, uhid):
+        if not uhid.startswith('AIIMS') or not _stub_known(uhid, self.missing_rate / 2):
+            return None
+        number = int(uhid[5:] or 0)
+        return {'uhid': uhid, 'name': f"Patient {number % 1000}", 'gender': ('Male', 'Female')[number % 2],
+                'age': 18 + number % 70, 'department': ('OPD', 'Cardiology', 'Medicine', 'Surgery')[number % 4]}
+
+
+@lookup_cli.command('stub')
+@click.option('--port', default=8766, show_default=True)
+@click.option('--latency', default=0.0, show_default=True, help='Seconds to wait before answering.')
+@click.option('--fail-rate', default=0.0, show_default=True, help='Fraction of requests answered with a 503.')
+@click.option('--missing-rate', default=0.2, show_default=True, help='Fraction of keys the services do not know.')
+def stub_command(port, latency, fail_rate, missing_rate):
+    """Serve both the UHID and the CDAC API with made-up, deterministic records.
+
+    Set UHID_SERVER and CDAC_SERVER to http://127.0.0.1:<port> to try caching, batching and the
+    circuit breaker without the real services.
+    """
+    def on_request(method, path, status):
+        click.echo(f"{method} {path} {status}")
+
+    click.echo(f"Listening on http://127.0.0.1:{port}/")
+    with StubLookupServer(('127.0.0.1', port), latency, fail_rate, missing_rate, on_request) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,180 @@
+import random
+import socketserver
+import threading
+import time
+from datetime import datetime
+from email import message_from_bytes
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select
+
+from app.extensions import db
+from app.model import MailCampaign, MailMessage, MailSuppression
+from app.util.mail_service import dispatch, record_bounce
+
+mail_cli = AppGroup('mail', help='Queued survey emails: sending, queue status and bounces.')
+
+
+@mail_cli.command('dispatch')
+@click.option('--once', is_flag=True, help='Send what is due and exit instead of polling.')
+@click.option('--interval', default=5.0, show_default=True, help='Seconds between polls when nothing is due.')
+@with_appcontext
+def dispatch_command(once, interval):
+    """Send queued emails until interrupted; several dispatchers can run at once."""
+    if not current_app.config['MAIL_SMTP_HOST']:
+        raise click.ClickException("No SMTP server configured, set MAIL_SMTP_HOST.")
+    while True:
+        started = time.perf_counter()
+        sent = dispatch()
+        if sent:
+            click.echo(f"{datetime.utcnow().isoformat(timespec='seconds')} "
+                       + ', '.join(f"{count} {outcome}" for outcome, count in sorted(sent.items()))
+                       + f" in {time.perf_counter() - started:.1f}s")
+        if once:
+            return
+        if not sent:
+            time.sleep(interval)
+
+
+@mail_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show the queue: messages per status, those due now and waiting to be retried, and suppressions."""
+    counts = dict(db.session.execute(
+        select(MailMessage.status, func.count(MailMessage.id)).group_by(MailMessage.status)).all())
+    retrying = db.session.execute(select(func.count(MailMessage.id)).where(
+        MailMessage.status == 'queued', MailMessage.next_attempt_at > datetime.utcnow())).scalar()
+    campaigns = db.session.execute(select(func.count(MailCampaign.id))).scalar()
+    suppressed = db.session.execute(
+        select(func.count(MailSuppression.email)).where(MailSuppression.suppressed)).scalar()
+    click.echo(f"{campaigns} campaigns; messages: " + ', '.join(
+        f"{counts.get(status, 0)} {status}" for status in ('queued', 'sent', 'failed', 'bounced'))
+        + f" ({retrying} of the queued waiting to be retried)")
+    click.echo(f"{suppressed} suppressed addresses")
+    if not current_app.config['MAIL_SMTP_HOST']:
+        click.echo("MAIL_SMTP_HOST is not set, nothing is being sent.")
+
+
+@mail_cli.command('bounce')
+@click.argument('emails', nargs=-1, required=True)
+@click.option('--soft', is_flag=True, help='Temporary failure (mailbox full, ...); suppresses after MAIL_SOFT_BOUNCE_LIMIT.')
+@click.option('--reason', default=None, help='Diagnostic of the bounce report.')
+@with_appcontext
+def bounce_command(emails, soft, reason):
+    """Record bounce reports that arrived after sending, so the addresses stop getting mail."""
+    for email in emails:
+        entry = record_bounce(email, not soft, reason)
+        db.session.flush()
+        click.echo(f"{entry.email}: {'suppressed' if entry.suppressed else f'{entry.soft_bounces} soft bounces'}")
+    db.session.commit()
+
+
+class StubSmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply('220 spars-stub ESMTP')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-spars-stub\r\n250-8BITMIME\r\n250-PIPELINING\r\n250 SMTPUTF8\r\n')
+            elif verb == 'HELO':
+                self.reply('250 spars-stub')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip(), []
+                self.reply('250 2.1.0 OK')
+            elif verb == 'RCPT':
+                address = command[8:].strip().strip('<>').split('>')[0]
+                if address.lower().startswith('bounce'):
+                    self.reply('550 5.1.1 No such user')
+                elif address.lower().startswith('tempfail') or random.random() < server.tempfail_rate:
+                    self.reply('451 4.3.0 Try again later')
+                else:
+                    recipients.append(address)
+                    self.reply('250 2.1.5 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 5.5.1 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line)
+                data = b''.join(lines)
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    server.received += 1
+                    number = server.received
+                self.reply(f"250 2.0.0 Queued as {number}")
+                server.on_message(number, sender, recipients, data)
+                sender, recipients = None, []
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 2.0.0 OK')
+            elif verb == 'NOOP':
+                self.reply('250 2.0.0 OK')
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('502 5.5.2 Command not implemented')
+
+
+class StubSmtpServer(socketserver.ThreadingTCPServer):
+    """SMTP server that accepts mail without delivering it, for `flask mail stub` and the tests.
+
+    Recipients whose address starts with "bounce" are rejected for good (550), those starting with
+    "tempfail" for now (451), like a `tempfail_rate` fraction of the others. `on_message(number,
+    sender, recipients, data)` is called for every accepted message.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, tempfail_rate=0.0, on_message=None):
+        self.latency = latency
+        self.tempfail_rate = tempfail_rate
+        self.on_message = on_message or (lambda number, sender, recipients, data: None)
+        self.received = 0
+        self.lock = threading.Lock()
+        super().__init__(address, StubSmtpHandler)
+
+
+@mail_cli.command('stub')
+@click.option('--port', default=8025, show_default=True)
+@click.option('--latency', default=0.0, show_default=True, help='Seconds to wait before accepting a message.')
+@click.option('--tempfail-rate', default=0.0, show_default=True, help='Fraction of recipients answered with a 451.')
+@click.option('--quiet', is_flag=True, help='Only print a count every 1000 messages.')
+def stub_command(port, latency, tempfail_rate, quiet):
+    """Run a local SMTP server that accepts mail without delivering it.
+
+    Recipients whose address starts with "bounce" are rejected for good (550), "tempfail" for now
+    (451). Set MAIL_SMTP_HOST=127.0.0.1, MAIL_SMTP_PORT=<port> and MAIL_SMTP_STARTTLS=false to send to it.
+    """
+    def on_message(number, sender, recipients, data):
+        if not quiet:
+            message = message_from_bytes(data)
+            click.echo(f"{number}: {sender} -> {', '.join(recipients)}: {message['Subject']}")
+        elif number % 1000 == 0:
+            click.echo(f"{number} messages received")
+
+    click.echo(f"Listening on 127.0.0.1:{port}")
+    with StubSmtpServer(('127.0.0.1', port), latency, tempfail_rate, on_message) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -1,4 +1,7 @@
 from app.extensions import db
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session, with_loader_criteria
+from werkzeug.exceptions import NotFound
 import uuid
 from datetime import datetime, timedelta
 import random
@@ -16,6 +19,30 @@ survey_editors = db.Table('survey_editors',
     db.Column('user_id', db.String(36), db.ForeignKey('user.id'), primary_key=True)
 )
 
+class SoftDeleteMixin:
+    """Soft-deleted rows are hidden from every ORM query unless it sets include_deleted (see _hide_soft_deleted)."""
+    is_deleted = db.Column(db.Boolean, default=False)
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    def soft_delete(self):
+        self.is_deleted = True
+        self.deleted_at = datetime.utcnow()
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_soft_deleted(execute_state):
+    """Add `is_deleted = false` for soft-deletable entities to ORM selects, lazy and eager loads included.
+
+    Opt out per statement with `.execution_options(include_deleted=True)`. Core statements executed
+    on a connection bypass the ORM and have to filter themselves.
+    """
+    if (execute_state.is_select and not execute_state.is_column_load
+            and not execute_state.execution_options.get('include_deleted', False)):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(SoftDeleteMixin, lambda cls: cls.is_deleted == False, include_aliases=True)
+        )
+
+
 class Role(db.Model):
     __tablename__ = 'role'
 
@@ -43,6 +70,8 @@ class User(db.Model):
     mobile = db.Column(db.String(15), unique=True, nullable=False)  # Unique mobile number
     aadhar = db.Column(db.String(12), unique=True, nullable=True)  # Unique Aadhar number
     gender = db.Column(db.String(10), nullable=True)  # Gender field, e.g., "Male", "Female", etc.
+    tenant_id = db.Column(db.String(50), nullable=True)  # TENANT_DATABASES entry holding the user's survey data
+    email = db.Column(db.String(254), nullable=True)  # Optional, for survey invitations and result summaries
 
     # Many-to-many relationship with Role
     roles = db.relationship('Role', secondary=user_roles, back_populates='users')
@@ -61,14 +90,25 @@ class User(db.Model):
         return f"<User {self.first_name} {self.last_name}>"
 
 
-class Survey(db.Model):
+class Survey(SoftDeleteMixin, db.Model):
     __tablename__ = 'survey'
+    # Partial indexes cover only live rows on SQLite/PostgreSQL; MySQL builds them as regular indexes
+    __table_args__ = (
+        db.Index('ix_survey_live_status', 'status',
+                 sqlite_where=db.text('is_deleted = 0'), postgresql_where=db.text('NOT is_deleted')),
+        db.Index('ix_survey_deleted_at', 'deleted_at',
+                 sqlite_where=db.text('is_deleted = 1'), postgresql_where=db.text('is_deleted')),
+        # Full-text search on MySQL; SQLite uses the FTS5 table of app/util/search.py instead
+        db.Index('ft_survey_text', 'title', 'description', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
     created_by_user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)  # Foreign key to User
-    status = db.Column(db.String(20), default='draft', nullable=False)  # Survey status (draft, published, closed)
+    # Survey status (draft, published, closed); active_history loads the old value on change, even if it was
+    # never read, for the outbox's status change events
+    status = db.column_property(db.Column(db.String(20), default='draft', nullable=False), active_history=True)
 
     # Relationships
     created_by = db.relationship('User', backref=db.backref('created_surveys', lazy='dynamic'))
@@ -80,14 +120,29 @@ class Survey(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
-    is_deleted = db.Column(db.Boolean, default=False)
+    archived_at = db.Column(db.DateTime, nullable=True)  # Set once all answers of a closed survey moved to answer_archive
+    # Optimistic concurrency: every UPDATE checks and bumps the version, a stale write raises StaleDataError
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Completion funnels are kept per questions version: it moves when questions or options are edited, unlike
+    # `version`, which every state change, archival and soft delete bumps too
+    questions_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f"<Survey {self.title} by {self.created_by.first_name}>"
 
 
-class Question(db.Model):
+class Question(SoftDeleteMixin, db.Model):
     __tablename__ = 'question'
+    __table_args__ = (
+        db.Index('ix_question_live_survey', 'survey_id',
+                 sqlite_where=db.text('is_deleted = 0'), postgresql_where=db.text('NOT is_deleted')),
+        db.Index('ix_question_deleted_at', 'deleted_at',
+                 sqlite_where=db.text('is_deleted = 1'), postgresql_where=db.text('is_deleted')),
+        db.Index('ft_question_text', 'text', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     survey_id = db.Column(db.Integer, db.ForeignKey('survey.id'), nullable=False)
@@ -117,7 +172,9 @@ class Question(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
-    is_deleted = db.Column(db.Boolean, default=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 class Option(db.Model):
@@ -137,6 +194,9 @@ class Option(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 class QuestionConstraint(db.Model):
@@ -156,6 +216,10 @@ class QuestionConstraint(db.Model):
 
 class Answer(db.Model):
     __tablename__ = 'answer'
+    __table_args__ = (
+        db.Index('ix_answer_attempt', 'attempt_id'),  # answers of given attempts (history, funnel catch-up)
+        db.Index('ft_answer_text', 'answer_text', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     survey_id = db.Column(db.Integer, db.ForeignKey('survey.id'), nullable=False)
@@ -171,12 +235,236 @@ class Answer(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     attempt_id = db.Column(db.Integer, db.ForeignKey("survey_attempts.id"), nullable=False)
 
+class ArchivedAnswer(db.Model):
+    """Answers of closed surveys, moved out of the hot answer table by `flask archive run`."""
+    __tablename__ = 'answer_archive'
+    __table_args__ = (
+        db.Index('ix_answer_archive_survey_attempt', 'survey_id', 'attempt_id'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Keeps the id the answer had in the answer table
+    survey_id = db.Column(db.Integer, nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False)
+    answer_text = db.Column(db.Text, nullable=True)
+    answer_file = db.Column(db.String(255), nullable=True)
+    response_id = db.Column(db.Integer, nullable=True)
+    selected_option_id = db.Column(db.Integer, nullable=True)
+    attempt_id = db.Column(db.Integer, nullable=False)
+
+    question = db.relationship('Question', viewonly=True)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
 class SurveyAttempt(db.Model):
     __tablename__ = "survey_attempts"
     id = db.Column(db.Integer, primary_key=True)
     survey_id = db.Column(db.Integer, db.ForeignKey("survey.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.String(36), db.ForeignKey("user.id"), nullable=False)
     attempt_date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=True)  # Client attempt ID, see app/util/idempotency.py
+    answers_count = db.Column(db.Integer, nullable=True)
+    survey_version = db.Column(db.Integer, nullable=True)  # Survey.questions_version answered; NULL for older attempts
+
+    # NULL keys never conflict, so attempts submitted without a key are unaffected
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'idempotency_key', name='uq_survey_attempts_user_idempotency_key'),
+        db.Index('ix_survey_attempts_user_survey', 'user_id', 'survey_id'),  # per-user history and dashboard
+    )
+
+    @staticmethod
+    def record(connection, survey_id, user_id, answers, idempotency_key=None):
+        """Insert an attempt and its answers with Core statements on `connection`.
+
+        Works on the ORM session's connection and, through `AsyncConnection.run_sync`, on the async
+        engine used by the ASGI entry point. Returns (attempt_id, answers_count). Raises IntegrityError
+        when the user already recorded an attempt with `idempotency_key`.
+        """
+        from app.util.funnel import add_attempt, load_questions
+        from app.util.outbox import add_event
+
+        questions = load_questions(connection, survey_id)
+        if {answer['question_id'] for answer in answers}.difference(questions):
+            raise NotFound("Question not found in this survey.")
+        version = connection.execute(select(Survey.questions_version).where(Survey.id == survey_id)).scalar()
+
+        attempt_date = datetime.utcnow()
+        attempt_id = connection.execute(
+            insert(SurveyAttempt).values(survey_id=survey_id, user_id=user_id, attempt_date=attempt_date,
+                                         idempotency_key=idempotency_key, answers_count=len(answers),
+                                         survey_version=version)
+        ).inserted_primary_key[0]
+
+        rows = [{
+            'survey_id': survey_id,
+            'question_id': answer['question_id'],
+            'answer_text': answer.get('answer_text'),
+            'answer_file': answer.get('answer_file'),
+            'selected_option_id': answer.get('selected_option_id'),
+            'attempt_id': attempt_id,
+        } for answer in answers]
+        if rows:
+            connection.execute(insert(Answer), rows)
+        add_attempt(connection, survey_id, version, questions, attempt_id, answers)
+        add_event(connection, 'attempt.submitted', survey_id, {
+            'attempt_id': attempt_id,
+            'user_id': user_id,
+            'survey_version': version,
+            'attempt_date': attempt_date.isoformat(),
+            'answers': [{name: row[name] for name in ('question_id', 'answer_text', 'answer_file', 'selected_option_id')}
+                        for row in rows],
+        })
+        return attempt_id, len(rows)
+
+    @staticmethod
+    def find_by_key(connection, user_id, idempotency_key):
+        return connection.execute(
+            select(SurveyAttempt.id, SurveyAttempt.survey_id, SurveyAttempt.answers_count)
+            .where(SurveyAttempt.user_id == user_id, SurveyAttempt.idempotency_key == idempotency_key)
+        ).first()
+
+class QuestionFunnel(db.Model):
+    """Materialized completion funnel: per survey questions version and question, how many attempts reached,
+    answered and stopped at it. Maintained by SurveyAttempt.record, see app/util/funnel.py."""
+    __tablename__ = 'question_funnel'
+
+    survey_id = db.Column(db.Integer, db.ForeignKey('survey.id'), primary_key=True)
+    survey_version = db.Column(db.Integer, primary_key=True)  # Survey.questions_version
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)  # counter shard, summed on read
+    position = db.Column(db.Integer, nullable=False)  # topological order within the survey
+    reached = db.Column(db.Integer, nullable=False, default=0)
+    answered = db.Column(db.Integer, nullable=False, default=0)
+    exited = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SurveyInvitation(db.Model):
+    """Invitation of a user to answer a survey without logging in, with a signed token.
+
+    Tokens carry the id and are checked without reading this table (see app/util/invitations.py); the
+    row records revocation and the attempt the invitation was accepted with.
+    """
+    __tablename__ = 'survey_invitation'
+    __table_args__ = (
+        db.Index('ix_survey_invitation_survey_user', 'survey_id', 'user_id'),
+        db.Index('ix_survey_invitation_revoked_at', 'revoked_at'),  # deny list refreshes
+    )
+
+    id = db.Column(db.String(32), primary_key=True)  # random, the token's jti
+    survey_id = db.Column(db.Integer, db.ForeignKey('survey.id'), nullable=False)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    accepted_at = db.Column(db.DateTime, nullable=True)
+    attempt_id = db.Column(db.Integer, nullable=True)  # survey_attempts row of the accepted submission
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+
+class OutboxEvent(db.Model):
+    """Event for downstream consumers, written in the transaction of the change it describes.
+
+    Ids only grow, so they double as the cursor of webhook and pull consumers; see app/util/outbox.py.
+    """
+    __tablename__ = 'outbox_event'
+    __table_args__ = {'sqlite_autoincrement': True}  # never reuse ids of pruned events, cursors point past them
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)  # attempt.submitted, survey.published, survey.status_changed
+    survey_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class OutboxCursor(db.Model):
+    """Delivery position of one configured webhook consumer."""
+    __tablename__ = 'outbox_cursor'
+
+    consumer = db.Column(db.String(50), primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)  # everything up to here was acknowledged
+    failures = db.Column(db.Integer, nullable=False, default=0)  # consecutive failed deliveries
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # retry backoff
+    locked_until = db.Column(db.DateTime, nullable=True)  # lease of the dispatcher delivering to this consumer
+    last_error = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class MailCampaign(db.Model):
+    """One mailing: a template rendered once with `context`, sent to each recipient in mail_message."""
+    __tablename__ = 'mail_campaign'
+
+    id = db.Column(db.Integer, primary_key=True)
+    template = db.Column(db.String(50), nullable=False)  # app/templates/mail/<template>.*
+    context = db.Column(db.Text, nullable=False)  # JSON, the same for every recipient
+    survey_id = db.Column(db.Integer, nullable=True)
+    tenant_id = db.Column(db.String(50), nullable=True)  # database of the survey
+    created_by_user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class MailMessage(db.Model):
+    """Queued email to one recipient of a campaign; see app/util/mail_service.py."""
+    __tablename__ = 'mail_message'
+    __table_args__ = (
+        db.Index('ix_mail_message_due', 'status', 'next_attempt_at'),  # the dispatcher's queue
+        db.Index('ix_mail_message_campaign_status', 'campaign_id', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('mail_campaign.id'), nullable=False)
+    user_id = db.Column(db.String(36), nullable=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    variables = db.Column(db.Text, nullable=False)  # JSON, substituted into the campaign's rendered template
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, sent, failed, bounced
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # retry backoff
+    claimed_by = db.Column(db.String(36), nullable=True)  # dispatcher holding the message until locked_until
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class MailSuppression(db.Model):
+    """Address that bounced; hard bounces, and soft ones past MAIL_SOFT_BOUNCE_LIMIT, get no more mail."""
+    __tablename__ = 'mail_suppression'
+
+    email = db.Column(db.String(254), primary_key=True)
+    soft_bounces = db.Column(db.Integer, nullable=False, default=0)
+    suppressed = db.Column(db.Boolean, nullable=False, default=False)
+    reason = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class JobRun(db.Model):
+    """One run of a background job, written by app.util.jobs.run_job whichever process ran it."""
+    __tablename__ = 'job_run'
+    __table_args__ = (
+        db.Index('ix_job_run_job_started', 'job_id', 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # running, success, failed
+    host = db.Column(db.String(100), nullable=False)  # hostname:pid of the process that ran it
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration_ms = db.Column(db.Float, nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON returned by the job
+    error = db.Column(db.Text, nullable=True)
+
+
+class SchedulerLease(db.Model):
+    """Leader lease: the process holding an unexpired row runs the job scheduler."""
+    __tablename__ = 'scheduler_lease'
+
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False)  # hostname:pid:nonce of the leader
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
 
 class Response(db.Model):
     __tablename__ = 'response'
@@ -211,11 +499,16 @@ class Otp(db.Model):
         return ''.join(random.choices(string.digits, k=6))
 
     @staticmethod
-    def create_otp(mobile):
+    def insert_otp(connection, mobile):
+        """Insert a new OTP for `mobile` on a Core connection (sync or via run_sync) and return its value."""
         otp_value = Otp.generate_otp()
         expiration_time = datetime.utcnow() + timedelta(minutes=5)  # OTP expires in 5 minutes
-        otp = Otp(mobile=mobile, otp=otp_value, expiration_time=expiration_time)
-        db.session.add(otp)
+        connection.execute(insert(Otp).values(mobile=mobile, otp=otp_value, expiration_time=expiration_time))
+        return otp_value
+
+    @staticmethod
+    def create_otp(mobile):
+        otp_value = Otp.insert_otp(db.session.connection(bind_arguments={'mapper': Otp}), mobile)
         db.session.commit()
         return otp_value
 
@@ -0,0 +1,162 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select
+
+from app.extensions import db
+from app.model import OutboxCursor, OutboxEvent
+from app.util.outbox import dispatch, prune_events, verify_signature
+from app.util.tenancy import DEFAULT, current_tenant, each_tenant
+
+outbox_cli = AppGroup('outbox', help='Deliver outbox events to webhook consumers.')
+
+
+def _consumers(names):
+    webhooks = current_app.config['OUTBOX_WEBHOOKS']
+    if not webhooks:
+        raise click.ClickException("No consumers configured, set OUTBOX_WEBHOOKS.")
+    unknown = set(names).difference(webhooks)
+    if unknown:
+        raise click.ClickException(f"Unknown consumers: {', '.join(sorted(unknown))}.")
+    return list(names) or list(webhooks)
+
+
+@outbox_cli.command('dispatch')
+@click.option('--consumer', 'names', multiple=True, help='Only deliver to this consumer (repeatable).')
+@click.option('--once', is_flag=True, help='Deliver what is pending and exit instead of polling.')
+@with_appcontext
+def dispatch_command(names, once):
+    """Deliver new events of every tenant database to the webhooks, in batches, until interrupted.
+
+    Several dispatchers can run at once: each consumer is leased to one of them at a time.
+    """
+    consumers = _consumers(names)
+    interval = current_app.config['OUTBOX_POLL_INTERVAL']
+    while True:
+        delivered = each_tenant(lambda: dispatch(consumers))
+        for tenant, counts in delivered.items():
+            for consumer, count in counts.items():
+                if count:
+                    click.echo(f"{datetime.utcnow().isoformat(timespec='seconds')} {tenant} {consumer}: {count} events")
+        if once:
+            return
+        if not any(any(counts.values()) for counts in delivered.values()):
+            time.sleep(interval)
+
+
+def _status():
+    last_id = db.session.execute(select(func.max(OutboxEvent.id))).scalar() or 0
+    total = db.session.execute(select(func.count(OutboxEvent.id))).scalar()
+    click.echo(f"{current_tenant() or DEFAULT}: {total} events stored, newest id {last_id}")
+    cursors = {cursor.consumer: cursor for cursor in db.session.execute(select(OutboxCursor)).scalars()}
+    for consumer in current_app.config['OUTBOX_WEBHOOKS']:
+        cursor = cursors.get(consumer)
+        position = cursor.last_event_id if cursor else 0
+        lag = db.session.execute(select(func.count(OutboxEvent.id)).where(OutboxEvent.id > position)).scalar()
+        line = f"{consumer:>20}: at {position}, {lag} pending"
+        if cursor is not None and cursor.failures:
+            line += f", {cursor.failures} failures, retry at {cursor.next_attempt_at:%Y-%m-%d %H:%M:%S}: {cursor.last_error}"
+        click.echo(line)
+
+
+@outbox_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show each consumer's position, lag and last error, per tenant database."""
+    each_tenant(_status)
+
+
+@outbox_cli.command('prune')
+@click.option('--days', type=int, default=None, help='Retention in days (default: OUTBOX_RETENTION_DAYS).')
+@with_appcontext
+def prune_command(days):
+    """Delete old events that every webhook consumer has received."""
+    days = current_app.config['OUTBOX_RETENTION_DAYS'] if days is None else days
+    for tenant, deleted in each_tenant(lambda: prune_events(days)).items():
+        click.echo(f"{tenant}: deleted {deleted} events older than {days} days.")
+
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if server.delay:
+            time.sleep(server.delay)
+        if not verify_signature(server.secret, self.headers, body):
+            return self._answer(401, 'bad signature')
+        if random.random() < server.fail_rate:
+            return self._answer(503, 'failing on purpose')
+
+        delivery = json.loads(body)
+        tenant = delivery.get('tenant')  # ids are unique within a tenant's database
+        events = delivery['events']
+        with server.lock:
+            duplicates = sum((tenant, event['id']) in server.seen for event in events)
+            reordered = 0
+            for event in events:
+                survey = (tenant, event['survey_id'])
+                reordered += event['id'] < server.last_by_survey.get(survey, 0)
+                server.last_by_survey[survey] = max(event['id'], server.last_by_survey.get(survey, 0))
+                server.seen.add((tenant, event['id']))
+            server.deliveries.append(delivery)
+        server.on_delivery(self.headers.get('X-Spars-Delivery'), events, duplicates, reordered, len(server.seen))
+        self._answer(200, 'ok')
+
+    def _answer(self, status, message):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(message.encode())
+
+    def log_message(self, format, *args):
+        pass  # on_delivery reports deliveries
+
+
+class StubWebhookServer(ThreadingHTTPServer):
+    """Webhook consumer that checks signatures, order and duplicates, for `flask outbox stub` and the tests.
+
+    Deliveries with a bad signature are answered with a 401, a `fail_rate` fraction of the others
+    with a 503. Accepted deliveries are kept in `deliveries`, and `on_delivery(delivery id, events,
+    duplicates, reordered, received)` is called for each.
+    """
+
+    def __init__(self, address, secret, fail_rate=0.0, delay=0.0, on_delivery=None):
+        self.secret = secret
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.on_delivery = on_delivery or (lambda *delivery: None)
+        self.deliveries = []
+        self.seen = set()
+        self.last_by_survey = {}
+        self.lock = threading.Lock()
+        super().__init__(address, StubWebhookHandler)
+
+
+@outbox_cli.command('stub')
+@click.option('--port', default=8765, show_default=True)
+@click.option('--secret', required=True, help="Secret of the consumer the stub stands in for.")
+@click.option('--fail-rate', default=0.0, show_default=True, help='Fraction of deliveries answered with a 503.')
+@click.option('--delay', default=0.0, show_default=True, help='Seconds to wait before answering.')
+def stub_command(port, secret, fail_rate, delay):
+    """Run a local webhook consumer that checks signatures, order and duplicates.
+
+    Point a consumer at http://127.0.0.1:<port>/ in OUTBOX_WEBHOOKS to try deliveries, retries and
+    backoff without a real downstream system.
+    """
+    def on_delivery(delivery_id, events, duplicates, reordered, received):
+        click.echo(f"{delivery_id}: {len(events)} events, {duplicates} duplicates, "
+                   f"{reordered} out of order, {received} received in total")
+
+    click.echo(f"Listening on http://127.0.0.1:{port}/")
+    with StubWebhookServer(('127.0.0.1', port), secret, fail_rate, delay, on_delivery) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,102 @@
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import delete, or_, select, update
+
+from app.extensions import db
+from app.model import (Answer, ArchivedAnswer, Option, Question, QuestionConstraint, QuestionFunnel, Response,
+                       Survey, SurveyAttempt, SurveyInvitation, survey_editors)
+
+purge_cli = AppGroup('purge', help='Physically remove soft-deleted surveys and questions.')
+
+
+class Throttle:
+    """Deletes in batches of `batch_size` rows, one short transaction each, sleeping `pause` seconds in between."""
+
+    def __init__(self, batch_size, pause):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.deleted = 0
+
+    def delete(self, model, *criteria):
+        while True:
+            ids = db.session.execute(
+                select(model.id).where(*criteria).limit(self.batch_size).execution_options(include_deleted=True)
+            ).scalars().all()
+            if not ids:
+                return
+            db.session.execute(delete(model).where(model.id.in_(ids)))
+            db.session.commit()
+            self.deleted += len(ids)
+            if len(ids) < self.batch_size:
+                return
+            if self.pause:
+                time.sleep(self.pause)
+
+
+def _purge_questions(throttle, question_ids):
+    """Delete questions and every row hanging off them."""
+    throttle.delete(Answer, Answer.question_id.in_(question_ids))
+    throttle.delete(ArchivedAnswer, ArchivedAnswer.question_id.in_(question_ids))
+    throttle.delete(QuestionConstraint, QuestionConstraint.question_id.in_(question_ids))
+    db.session.execute(delete(QuestionFunnel).where(QuestionFunnel.question_id.in_(question_ids)))
+    # Unhook branching before the options and questions it points at disappear
+    option_ids = select(Option.id).where(Option.question_id.in_(question_ids))
+    db.session.execute(
+        update(Question)
+        .where(or_(Question.parent_question_id.in_(question_ids), Question.parent_option_id.in_(option_ids)))
+        .values(parent_question_id=None, parent_option_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    throttle.delete(Option, Option.question_id.in_(question_ids))
+    throttle.delete(Question, Question.id.in_(question_ids))
+
+
+def purge_survey(throttle, survey_id):
+    throttle.delete(Answer, Answer.survey_id == survey_id)
+    throttle.delete(ArchivedAnswer, ArchivedAnswer.survey_id == survey_id)
+    throttle.delete(SurveyInvitation, SurveyInvitation.survey_id == survey_id)
+    throttle.delete(SurveyAttempt, SurveyAttempt.survey_id == survey_id)
+    throttle.delete(Response, Response.survey_id == survey_id)
+    question_ids = db.session.execute(
+        select(Question.id).where(Question.survey_id == survey_id).execution_options(include_deleted=True)
+    ).scalars().all()
+    _purge_questions(throttle, question_ids)
+    db.session.execute(delete(survey_editors).where(survey_editors.c.survey_id == survey_id))
+    db.session.execute(delete(Survey).where(Survey.id == survey_id))
+    db.session.commit()
+
+
+def purge_deleted(older_than_days=30, batch_size=1000, pause=0.1):
+    """Purge surveys and questions soft-deleted more than `older_than_days` ago; returns rows deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    throttle = Throttle(batch_size, pause)
+
+    def expired(model):
+        # Rows deleted before deleted_at existed have no timestamp and count as expired
+        return select(model.id).where(
+            model.is_deleted == True, or_(model.deleted_at <= cutoff, model.deleted_at.is_(None))
+        ).execution_options(include_deleted=True)
+
+    survey_ids = db.session.execute(expired(Survey)).scalars().all()
+    for survey_id in survey_ids:
+        purge_survey(throttle, survey_id)
+
+    question_ids = db.session.execute(expired(Question)).scalars().all()
+    for start in range(0, len(question_ids), batch_size):
+        _purge_questions(throttle, question_ids[start:start + batch_size])
+    return throttle.deleted
+
+
+@purge_cli.command('run')
+@click.option('--older-than-days', default=30, show_default=True, help='Only purge rows soft-deleted before this.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+@click.option('--pause', default=0.1, show_default=True, help='Seconds to sleep between batches.')
+@with_appcontext
+def run_command(older_than_days, batch_size, pause):
+    """Delete soft-deleted surveys and questions, in small throttled batches."""
+    deleted = purge_deleted(older_than_days, batch_size, pause)
+    click.echo(f"Purged {deleted} rows.")
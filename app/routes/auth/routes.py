@@ -1,6 +1,7 @@
 from flask_restx import Namespace, Resource, fields
 from flask import request, jsonify
-from app.util.sms_service import send_otp
+from app.decorator import rate_limit
+from app.util.sms_service import otp_request_mobile, otp_response, send_otp
 from app import db
 from app.model import User, Otp
 from app.schemas import user_schema
@@ -35,20 +36,13 @@ class RequestOtp(Resource):
     @auth_ns.expect(otp_request_model)
     @auth_ns.response(200, 'OTP sent successfully.', otp_response_model)
     @auth_ns.response(400, 'Mobile number is required.', otp_response_model)
+    @auth_ns.response(429, 'Too many requests.', otp_response_model)
+    @rate_limit('request_otp')
     def post(self):
         """Request an OTP for login"""
-        data = request.json
-        if not data or 'mobile' not in data:
-            db.session.rollback()
-            return {"message": "Mobile number is required."}, 400
-
-        mobile = data["mobile"]
+        mobile = otp_request_mobile(request.json)
         otp_value = Otp.create_otp(mobile)
-        status = send_otp(mobile, otp_value)
-
-        if status == 200:
-            return {"message": "OTP sent successfully."}, 200
-        return {"message": "Something went wrong, please try after some time."}, 400
+        return otp_response(send_otp(mobile, otp_value))
 
 
 @auth_ns.route('/verify_otp')
@@ -58,6 +52,8 @@ class VerifyOtp(Resource):
     @auth_ns.response(400, 'Mobile number and OTP are required.', otp_response_model)
     @auth_ns.response(400, 'Invalid OTP or OTP already used.', otp_response_model)
     @auth_ns.response(400, 'OTP has expired.', otp_response_model)
+    @auth_ns.response(429, 'Too many requests.', otp_response_model)
+    @rate_limit('verify_otp')
     def post(self):
         """Verify the OTP and login the user"""
         data = request.json
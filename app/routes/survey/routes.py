@@ -1,14 +1,33 @@
 from pprint import pprint
 from flask import current_app, request, jsonify
 from flask_restx import Resource, Namespace, fields
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
 import jwt
-from werkzeug.exceptions import Forbidden
-from app.decorator import token_required, verify_superadmin
-from app.model import db, Survey, Question, Option, Answer, QuestionConstraint, Role, User, SurveyAttempt
+from sqlalchemy import func, select, union_all
+from werkzeug.exceptions import BadRequest, Conflict, Forbidden, NotFound, ServiceUnavailable
+from app.decorator import invitation_or_token_required, rate_limit, token_required, verify_superadmin
+from app.model import (db, Survey, Question, Option, Answer, ArchivedAnswer, QuestionConstraint, Role, User, SurveyAttempt,
+                       MailCampaign)
 import datetime
 from . import survey_ns
-from app.schemas import surveys_schema,survey_schema,answers_schema
+from app.schemas import surveys_schema, survey_schema, answers_schema, archived_answers_schema
+from app.util.instrumentation import serialization_timer
+from app.util.dashboard import user_dashboard
+from app.util.funnel import survey_funnel
+from app.util.lookup import patient_records
+from app.util.invitations import (InvitedUser, create_invitations, invitation_stats, invitation_url,
+                                  revoke_invitations)
+from app.util.mail_service import TEMPLATES as mail_templates, campaign_counts, queue_survey_mail
+from app.util.tenancy import current_tenant
+from app.util.outbox import EVENT_TYPES, events_after
+from app.util.search import KINDS as search_kinds, search
+from app.util.idempotency import CLIENT_ATTEMPT_FIELD, REPLAYED_HEADER, idempotency_key
+from app.util.submission import (record_submission, replayed_submission, role_names, submission_survey, submitted,
+                                 validate_survey_submission_permission)
+
+MAX_INVITATIONS_PER_REQUEST = 10000
 
 # Swagger Models
 # Swagger Models with Complex Default Values
@@ -29,6 +48,7 @@ survey_model = survey_ns.model('Survey', {
     'title': fields.String(required=True, description='Title of the survey', default="Programming Language Survey"),
     'description': fields.String(description='Description of the survey', default="A survey to collect user preferences on programming languages."),
     'state': fields.String(required=True, description='State of the survey (create, testing, release, close)', default="create"),
+    'version': fields.Integer(description='Version the client last read, required to update; a newer survey is rejected with 409'),
     'questions': fields.List(fields.Nested(question_model), description='List of questions', default=[
         {
             "id": 1,
@@ -59,28 +79,168 @@ answer_model = survey_ns.model('Answer', {
 })
 
 answer_submission_model = survey_ns.model('AnswerSubmission', {
-    'answers': fields.List(fields.Nested(answer_model), required=True, description='List of answers to the survey questions')
+    'answers': fields.List(fields.Nested(answer_model), required=True, description='List of answers to the survey questions'),
+    CLIENT_ATTEMPT_FIELD: fields.String(description='Client-generated attempt ID; resubmitting it returns the original '
+                                                    'attempt. The Idempotency-Key header takes precedence.')
+})
+
+
+survey_status_model = survey_ns.model('SurveyStatus', {
+    'state': fields.String(required=True, description='New state (create, testing, release, close)', default="testing"),
+    'version': fields.Integer(required=True, description='Version the client last read; a newer survey is rejected with 409'),
+})
+
+survey_mail_model = survey_ns.model('SurveyMail', {
+    'template': fields.String(required=True, description='invitation or results_summary', default="invitation"),
+    'user_ids': fields.List(fields.String, description='Recipients; a results summary goes to all respondents by default'),
 })
 
+survey_invitations_model = survey_ns.model('SurveyInvitations', {
+    'user_ids': fields.List(fields.String, required=True, description=f"Users to invite, at most {MAX_INVITATIONS_PER_REQUEST}; use `flask invitations create` for more"),
+    'expires_in_days': fields.Integer(description='Days the invitations stay valid, INVITATION_TTL_DAYS by default'),
+    'email': fields.Boolean(description='Email each user their invitation link', default=False),
+})
+
+survey_invitations_revoke_model = survey_ns.model('SurveyInvitationsRevoke', {
+    'invitation_ids': fields.List(fields.String, description='Invitations to revoke; all of the survey when left out'),
+})
+
+# Partial edits: only the fields present are changed, each row carries the version the client last read
+question_patch_model = survey_ns.model('QuestionPatch', {
+    'id': fields.Integer(required=True, description='Question ID'),
+    'version': fields.Integer(required=True, description='Version of the question the client last read'),
+    'text': fields.String(description='Question text'),
+    'question_type': fields.String(description='Type of the question (e.g., single-choice, text)'),
+    'is_required': fields.Boolean(description='Is the question required?'),
+    'default_value': fields.String(description='Default value for the question'),
+})
+
+option_patch_model = survey_ns.model('OptionPatch', {
+    'id': fields.Integer(required=True, description='Option ID'),
+    'version': fields.Integer(required=True, description='Version of the option the client last read'),
+    'text': fields.String(description='Option text'),
+    'order': fields.Integer(description='Order of the option'),
+})
+
+survey_patch_model = survey_ns.model('SurveyPatch', {
+    'version': fields.Integer(description='Version of the survey the client last read, required with title/description'),
+    'title': fields.String(description='Title of the survey'),
+    'description': fields.String(description='Description of the survey'),
+    'questions': fields.List(fields.Nested(question_patch_model), description='Changed questions'),
+    'options': fields.List(fields.Nested(option_patch_model), description='Changed options'),
+})
+
+SURVEY_PATCH_FIELDS = ('title', 'description')
+# States a survey can move to from each state
+SURVEY_TRANSITIONS = {'create': ('testing',), 'testing': ('create', 'release'), 'release': ('close',)}
+QUESTION_PATCH_FIELDS = ('text', 'question_type', 'is_required', 'default_value')
+OPTION_PATCH_FIELDS = ('text', 'order')
 
 
 # Utility functions
+def validate_survey_owner(survey, user, action="edit this survey"):
+    """Check that the user created the survey or is one of its editors, in any state."""
+    if survey.created_by_user_id != user.id and user not in survey.editors:
+        raise Forbidden(f"Only the creator and editors can {action}.")
+    return True
+
+
 def validate_survey_edit_permission(survey, user):
     """Check if the user can edit the survey based on its state and user role."""
-    if survey.state == "create" and survey.created_by_user_id == user.id:
-        return True
-    if survey.state not in ["create"]:
+    if survey.status not in ["create"]:
         raise Forbidden("Editing is not allowed in this state.")
-    return False
+    return validate_survey_owner(survey, user)
+
+
+def check_version(row, expected, name):
+    """Reject an edit based on an outdated read of `row`."""
+    if expected is not None and expected != row.version:
+        raise Conflict(f"{name} {row.id} was modified by someone else (version {row.version}, you sent {expected}).")
+
+
+def apply_patch(row, data, field_names, name):
+    check_version(row, data.get('version'), name)
+    for field_name in field_names:
+        if field_name in data:
+            setattr(row, field_name, data[field_name])
+
+# Answer columns a client can pick for the normalized view (?fields=), in response order
+NORMALIZED_ANSWER_FIELDS = ('id', 'question_id', 'answer_text', 'answer_file', 'selected_option_id', 'created_at')
+
+
+def normalized_answers(survey, user_id, fields, page, per_page):
+    """The user's answers as flat rows grouped by attempt, with each referenced question sent once.
+
+    Pages over attempts (newest first), so an attempt is never split across pages. Runs four small
+    queries: the attempt page, the total, the answer rows and the questions with their options.
+    """
+    attempt_filter = (SurveyAttempt.user_id == user_id, SurveyAttempt.survey_id == survey.id)
+    total = db.session.execute(select(func.count(SurveyAttempt.id)).where(*attempt_filter)).scalar()
+    attempts = db.session.execute(
+        select(SurveyAttempt.id, SurveyAttempt.attempt_date).where(*attempt_filter)
+        .order_by(SurveyAttempt.id.desc()).limit(per_page).offset((page - 1) * per_page)
+    ).all()
+    attempt_ids = [attempt.id for attempt in attempts]
+
+    # question_id and attempt_id are always read; they key the questions dictionary and the grouping
+    columns = sorted(set(fields) | {'question_id'}, key=NORMALIZED_ANSWER_FIELDS.index)
+    sources = []
+    if survey.archived_at is None:
+        sources.append(Answer)
+    if survey.status == 'close':
+        sources.append(ArchivedAnswer)  # fully or partly moved by `flask archive run`
+    statements = [
+        select(model.attempt_id, *(getattr(model, name) for name in columns)).where(model.attempt_id.in_(attempt_ids))
+        for model in sources
+    ]
+    rows = db.session.execute(
+        union_all(*statements).order_by('attempt_id', 'question_id') if len(statements) > 1
+        else statements[0].order_by(sources[0].attempt_id, sources[0].question_id)
+    ).all() if attempt_ids else []
+
+    by_attempt = {attempt_id: [] for attempt_id in attempt_ids}
+    question_ids = set()
+    picked = [columns.index(name) for name in fields]
+    for row in rows:
+        values = row[1:]
+        question_ids.add(values[columns.index('question_id')])
+        by_attempt[row[0]].append([
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in (values[i] for i in picked)
+        ])
+
+    questions = {}
+    if question_ids:
+        for question in db.session.execute(
+                select(Question.id, Question.text, Question.question_type).where(Question.id.in_(question_ids))):
+            questions[str(question.id)] = {'text': question.text, 'question_type': question.question_type,
+                                           'options': {}}
+        for option in db.session.execute(
+                select(Option.id, Option.question_id, Option.text).where(Option.question_id.in_(question_ids))):
+            if str(option.question_id) in questions:  # absent if the question was soft-deleted
+                questions[str(option.question_id)]['options'][str(option.id)] = option.text
+
+    return {
+        'fields': list(fields),
+        'attempts': [{'attempt_id': attempt.id, 'attempt_date': attempt.attempt_date.isoformat(),
+                      'answers': by_attempt[attempt.id]} for attempt in attempts],
+        'questions': questions,
+        'page': page,
+        'per_page': per_page,
+        'total_attempts': total,
+    }
+
+
+def _int_arg(name, default, minimum, maximum):
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be an integer.")
+    if not minimum <= value <= maximum:
+        raise BadRequest(f"{name} must be between {minimum} and {maximum}.")
+    return value
 
-def validate_survey_submission_permission(survey, user):
-    """Check if the user can submit answers based on the survey state and their role."""
-    if survey.status == "testing" and user.role.name != "tester":
-        raise Forbidden("Only testers can submit answers for surveys in the testing phase.")
-    if survey.status == "release" and user.role.name not in ["normal", "tester"]:
-        raise Forbidden("Only normal or tester users can submit answers for surveys in the release phase.")
-    if survey.status == "close":
-        raise Forbidden("This survey is closed and cannot accept responses.")
 
 # Resource Classes
 @survey_ns.route('/')
@@ -138,8 +298,58 @@ class SurveyResource(Resource):
     def get(self):
         """Fetch all surveys"""
         surveys = Survey.query.all()
-        
-        return surveys_schema.dump(surveys), 200
+
+        with serialization_timer():
+            result = surveys_schema.dump(surveys)
+        return result, 200
+
+@survey_ns.route('/dashboard')
+class SurveyDashboardResource(Resource):
+    @survey_ns.doc(
+        summary="Fetch the current user's survey history",
+        description="Every survey the user attempted, with attempt count, last attempt time and completion percentage.",
+        responses={
+            200: 'Dashboard',
+            401: 'Unauthorized'
+        }
+    )
+    @token_required
+    def get(self, current_user):
+        """Fetch the current user's dashboard"""
+        return user_dashboard(current_user.id), 200
+
+@survey_ns.route('/search')
+class SurveySearchResource(Resource):
+    @survey_ns.doc(
+        summary="Full-text search over surveys, questions and answers",
+        description="Ranked, every word must match; end a word with * for a prefix search. "
+                    "Answers are limited to the user's own and those of surveys they created or edit.",
+        params={
+            'q': 'Search words, e.g. "fever cou*"',
+            'kind': 'Comma separated: survey, question, answer (default: all)',
+            'survey_id': 'Only search within this survey',
+            'page': 'Page number, from 1',
+            'per_page': 'Results per page (1-100, default 20)',
+        },
+        responses={
+            200: 'Search results',
+            400: 'Bad request',
+            401: 'Unauthorized'
+        }
+    )
+    @token_required
+    def get(self, current_user):
+        """Search surveys, questions and answers"""
+        kind_names = [name for name in request.args.get('kind', ','.join(search_kinds)).split(',') if name]
+        unknown = set(kind_names).difference(search_kinds)
+        if unknown or not kind_names:
+            raise BadRequest(f"kind must be a non-empty list of: {', '.join(search_kinds)}")
+        survey_id = _int_arg('survey_id', 1, 1, 2 ** 31 - 1) if 'survey_id' in request.args else None
+        page = _int_arg('page', 1, 1, 1000)
+        per_page = _int_arg('per_page', 20, 1, 100)
+        results, has_more = search(request.args.get('q'), {search_kinds[name] for name in kind_names},
+                                   user_id=current_user.id, survey_id=survey_id, page=page, per_page=per_page)
+        return {'results': results, 'page': page, 'per_page': per_page, 'has_more': has_more}, 200
 
 @survey_ns.route('/<int:survey_id>')
 @survey_ns.param('survey_id', 'The Survey ID')
@@ -156,7 +366,9 @@ class SingleSurveyResource(Resource):
         """Fetch a specific survey"""
         survey = Survey.query.get_or_404(survey_id)
 
-        return survey_schema.dump(survey), 200
+        with serialization_timer():
+            result = survey_schema.dump(survey)
+        return result, 200
 
     @survey_ns.expect(survey_model, validate=True)
     @survey_ns.doc(
@@ -165,26 +377,87 @@ class SingleSurveyResource(Resource):
         responses={
             200: 'Survey updated successfully',
             400: 'Bad request',
-            404: 'Survey not found'
+            403: 'Forbidden',
+            404: 'Survey not found',
+            409: 'Survey was modified by someone else'
         }
     )
-    def put(self, survey_id):
+    @token_required
+    def put(self, current_user, survey_id):
         """Update a survey"""
         data = request.json
         survey = Survey.query.get_or_404(survey_id)
 
         # Check permissions
-        validate_survey_edit_permission(survey, request.user)
+        validate_survey_edit_permission(survey, current_user)
+        if data.get('version') is None:
+            raise BadRequest("version is required when updating the survey.")
+        check_version(survey, data['version'], 'Survey')
 
         survey.title = data.get('title', survey.title)
         survey.description = data.get('description', survey.description)
 
         db.session.commit()
-        return {"message": "Survey updated successfully"}, 200
+        return {"message": "Survey updated successfully", "version": survey.version}, 200
+
+    @survey_ns.expect(survey_patch_model, validate=True)
+    @survey_ns.doc(
+        summary="Partially update a survey",
+        description="Change only the given fields of the survey, its questions and its options. Every changed row "
+                    "must carry the version the client last read; if any of them changed since, nothing is "
+                    "saved and 409 is returned.",
+        responses={
+            200: 'Survey updated successfully',
+            400: 'Bad request',
+            403: 'Forbidden',
+            404: 'Survey, question or option not found',
+            409: 'Survey, question or option was modified by someone else'
+        }
+    )
+    @token_required
+    def patch(self, current_user, survey_id):
+        """Partially update a survey"""
+        data = request.json
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_edit_permission(survey, current_user)
+
+        if any(field_name in data for field_name in SURVEY_PATCH_FIELDS):
+            if data.get('version') is None:
+                raise BadRequest("version is required when changing the survey.")
+            apply_patch(survey, data, SURVEY_PATCH_FIELDS, 'Survey')
+
+        question_patches = {patch['id']: patch for patch in data.get('questions') or []}
+        questions = Question.query.filter(
+            Question.id.in_(question_patches), Question.survey_id == survey.id
+        ).all() if question_patches else []
+        if len(questions) != len(question_patches):
+            raise NotFound("Question not found in this survey.")
+        for question in questions:
+            apply_patch(question, question_patches[question.id], QUESTION_PATCH_FIELDS, 'Question')
+
+        option_patches = {patch['id']: patch for patch in data.get('options') or []}
+        options = Option.query.join(Option.question).filter(
+            Option.id.in_(option_patches), Question.survey_id == survey.id
+        ).all() if option_patches else []
+        if len(options) != len(option_patches):
+            raise NotFound("Option not found in this survey.")
+        for option in options:
+            apply_patch(option, option_patches[option.id], OPTION_PATCH_FIELDS, 'Option')
+        if questions or options:
+            survey.questions_version += 1  # attempts from here on count toward a new funnel
+
+        # Each UPDATE is guarded by "AND version = <read version>"; a concurrent writer makes it raise StaleDataError
+        db.session.commit()
+        return {
+            "message": "Survey updated successfully",
+            "version": survey.version,
+            "questions": {str(question.id): question.version for question in questions},
+            "options": {str(option.id): option.version for option in options},
+        }, 200
 
     @survey_ns.doc(
         summary="Delete a survey",
-        description="Delete a survey by its ID.",
+        description="Soft-delete a survey by its ID. Its data is removed later by `flask purge run`.",
         responses={
             200: 'Survey deleted successfully',
             404: 'Survey not found'
@@ -193,7 +466,7 @@ class SingleSurveyResource(Resource):
     def delete(self, survey_id):
         """Delete a survey"""
         survey = Survey.query.get_or_404(survey_id)
-        db.session.delete(survey)
+        survey.soft_delete()
         db.session.commit()
         return {"message": "Survey deleted successfully"}, 200
 
@@ -207,70 +480,388 @@ class SurveyAnswersResource(Resource):
         responses={
             201: 'Answers submitted successfully',
             400: 'Bad request',
-            403: 'Forbidden'
+            403: 'Forbidden',
+            409: 'Idempotency key already used for another survey, or invitation already used',
+            429: 'Too many requests'
         }
     )
-    @token_required
+    @invitation_or_token_required
+    @rate_limit('submit_answers')
     def post(self, current_user, survey_id):
-        """Submit multiple answers for different questions in a survey"""
+        """Submit multiple answers for different questions in a survey
+
+        Respondents invited to the survey can send `Authorization: Invitation <token>` instead of logging in.
+        """
         data = request.json
-        survey = Survey.query.get_or_404(survey_id)
+        survey = submission_survey(db.session.connection(), survey_id)
+        roles = () if isinstance(current_user, InvitedUser) else role_names(
+            db.session.connection(bind_arguments={'mapper': Role}), current_user.id)
+        validate_survey_submission_permission(survey, current_user, roles)
 
-        # Validate submission permissions
-        validate_survey_submission_permission(survey, current_user)
+        # A retried submission returns the attempt recorded the first time
+        key = idempotency_key(request.headers, data)
+        cache = current_app.extensions['idempotency_cache']
+        replayed = replayed_submission(db.session.connection(), cache, current_user.id, key, survey.id)
+        if replayed is not None:
+            return replayed, 201, {REPLAYED_HEADER: 'true'}
 
-        # Record the survey attempt
-        attempt = SurveyAttempt(
-            user_id=current_user.id,
-            survey_id=survey.id,
-            attempt_date=datetime.datetime.utcnow()
-        )
-        db.session.add(attempt)
-        db.session.flush()  # Generate `attempt.id` before adding answers
-
-        # Batch insert answers
-        answers_to_insert = []
-        for answer_data in data['answers']:
-            question = Question.query.filter_by(
-                id=answer_data['question_id'], survey_id=survey_id
-            ).first_or_404()
-            
-            answers_to_insert.append(Answer(
-                survey_id=survey.id,
-                question_id=question.id,
-                answer_text=answer_data.get('answer_text'),
-                answer_file=answer_data.get('answer_file'),
-                selected_option_id = answer_data.get('selected_option_id'),
-                attempt_id=attempt.id
-            ))
-
-        # Add all answers at once
-        db.session.bulk_save_objects(answers_to_insert)
-        db.session.commit()
+        # Record the attempt and all answers in one transaction
+        try:
+            attempt_id, answers_count = record_submission(db.session.connection(), survey.id, current_user,
+                                                          data['answers'], key)
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent request with the same key committed first (possibly in another worker)
+            db.session.rollback()
+            replayed = replayed_submission(db.session.connection(), cache, current_user.id, key, survey.id, 'conflict')
+            if replayed is None:
+                raise
+            return replayed, 201, {REPLAYED_HEADER: 'true'}
 
-        return {
-            "message": "Answers submitted successfully",
-            "attempt_id": attempt.id,
-            "answers_count": len(answers_to_insert)
-        }, 201
+        return submitted(cache, current_user.id, key, survey.id, attempt_id, answers_count), 201
 
     @survey_ns.doc(
         summary="Fetch all answers for a survey",
-        description="Fetch a list of all answers submitted for the specified survey.",
+        description="Fetch a list of all answers submitted for the specified survey. With view=normalized, "
+                    "answers are flat rows grouped by attempt, paginated by attempt, with a questions "
+                    "dictionary sent once.",
+        params={
+            'view': "'full' (default, nested question objects) or 'normalized'",
+            'fields': f"Normalized view only: comma-separated answer columns from {', '.join(NORMALIZED_ANSWER_FIELDS)}",
+            'page': 'Normalized view only: page of attempts, starting at 1',
+            'per_page': 'Normalized view only: attempts per page (max 100)',
+        },
         responses={
-            200: 'List of answers'
+            200: 'List of answers',
+            400: 'Bad request'
         }
     )
     @token_required
     def get(self,current_user, survey_id):
         """Fetch all answers for a survey"""
-        answers = (
-            Answer.query
-                .join(SurveyAttempt, SurveyAttempt.id == Answer.attempt_id)
-                .filter(SurveyAttempt.user_id == current_user.id, SurveyAttempt.survey_id == survey_id)
-                .options(joinedload(Answer.question))  # Optional: Load related question data
-                .all()
-        )
-        return answers_schema.dump(answers), 200
+        survey = Survey.query.get_or_404(survey_id)
+
+        view = request.args.get('view', 'full')
+        if view == 'normalized':
+            fields = [name for name in request.args.get('fields', 'question_id,answer_text,selected_option_id')
+                      .split(',') if name]
+            unknown = set(fields).difference(NORMALIZED_ANSWER_FIELDS)
+            if unknown or not fields:
+                raise BadRequest(f"fields must be a non-empty list of: {', '.join(NORMALIZED_ANSWER_FIELDS)}")
+            page = _int_arg('page', 1, 1, 10 ** 6)
+            per_page = _int_arg('per_page', 20, 1, 100)
+            return normalized_answers(survey, current_user.id, fields, page, per_page), 200
+        if view != 'full':
+            raise BadRequest("view must be 'full' or 'normalized'.")
+
+        answers = []
+        if survey.archived_at is None:
+            answers = (
+                Answer.query
+                    .join(SurveyAttempt, SurveyAttempt.id == Answer.attempt_id)
+                    .filter(SurveyAttempt.user_id == current_user.id, SurveyAttempt.survey_id == survey_id)
+                    .options(joinedload(Answer.question))  # Optional: Load related question data
+                    .all()
+            )
+
+        # Answers of closed surveys may have been moved to the archive, fully or partly (flask archive run)
+        archived = []
+        if survey.status == 'close':
+            archived = (
+                ArchivedAnswer.query
+                    .join(SurveyAttempt, SurveyAttempt.id == ArchivedAnswer.attempt_id)
+                    .filter(SurveyAttempt.user_id == current_user.id, SurveyAttempt.survey_id == survey_id)
+                    .options(joinedload(ArchivedAnswer.question))
+                    .all()
+            )
+
+        with serialization_timer():
+            result = answers_schema.dump(answers) + archived_answers_schema.dump(archived)
+        return result, 200
+
+
+@survey_ns.route('/<int:survey_id>/status')
+@survey_ns.param('survey_id', 'The Survey ID')
+class SurveyStatusResource(Resource):
+    @survey_ns.expect(survey_status_model, validate=True)
+    @survey_ns.doc(
+        summary="Move a survey to another state",
+        description="create -> testing -> release -> close; testing can go back to create. Consumers of the "
+                    "event outbox are notified in the same transaction.",
+        responses={
+            200: 'Survey state changed',
+            400: 'Bad request',
+            403: 'Forbidden',
+            404: 'Survey not found',
+            409: 'Transition not allowed or survey modified by someone else'
+        }
+    )
+    @token_required
+    def put(self, current_user, survey_id):
+        """Change the state of a survey"""
+        data = request.json
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "change the state of this survey")
+        check_version(survey, data['version'], 'Survey')
+        if data['state'] not in SURVEY_TRANSITIONS.get(survey.status, ()):
+            raise Conflict(f"A survey in state {survey.status} cannot move to {data['state']}.")
+
+        survey.status = data['state']
+        db.session.commit()
+        return {"message": "Survey state changed", "state": survey.status, "version": survey.version}, 200
+
+
+@survey_ns.route('/events')
+class SurveyEventsResource(Resource):
+    @survey_ns.doc(
+        summary="Read the event outbox",
+        description="Events in commit order after the cursor `after`. Consumers keep next_after and send it as "
+                    "`after` on their next call; events are kept for OUTBOX_RETENTION_DAYS. Superadmins only.",
+        params={
+            'after': 'Return events with a larger id (default 0)',
+            'limit': 'Maximum events (1-1000, default 100)',
+            'survey_id': 'Only events of this survey',
+            'type': f"Comma separated: {', '.join(EVENT_TYPES)} (default: all)",
+        },
+        responses={
+            200: 'Events',
+            400: 'Bad request',
+            401: 'Unauthorized',
+            403: 'Forbidden'
+        }
+    )
+    @verify_superadmin
+    def get(self):
+        """Read events after a cursor"""
+        after = _int_arg('after', 0, 0, 2 ** 63 - 1)
+        limit = _int_arg('limit', 100, 1, 1000)
+        survey_id = _int_arg('survey_id', 1, 1, 2 ** 31 - 1) if 'survey_id' in request.args else None
+        event_types = [name for name in request.args.get('type', '').split(',') if name]
+        unknown = set(event_types).difference(EVENT_TYPES)
+        if unknown:
+            raise BadRequest(f"type must be a list of: {', '.join(EVENT_TYPES)}")
+        events = events_after(after, limit, survey_id=survey_id, event_types=event_types)
+        return {'events': events, 'next_after': events[-1]['id'] if events else after}, 200
+
+
+@survey_ns.route('/<int:survey_id>/funnel')
+@survey_ns.param('survey_id', 'The Survey ID')
+class SurveyFunnelResource(Resource):
+    @survey_ns.doc(
+        summary="Completion funnel of a survey",
+        description="Per question in topological order: attempts that reached it, answered it and stopped at it "
+                    "(exited). Read from counters maintained on every submission.",
+        params={'version': 'Questions version of the survey (default: the current one)'},
+        responses={
+            200: 'Funnel',
+            401: 'Unauthorized',
+            403: 'Forbidden',
+            404: 'Survey not found'
+        }
+    )
+    @token_required
+    def get(self, current_user, survey_id):
+        """Fetch the completion funnel of a survey"""
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "see the funnel of this survey")
+        version = _int_arg('version', 1, 1, 2 ** 31 - 1) if 'version' in request.args else None
+        return survey_funnel(survey, version), 200
+
+
+@survey_ns.route('/<int:survey_id>/respondents')
+@survey_ns.param('survey_id', 'The Survey ID')
+class SurveyRespondentsResource(Resource):
+    @survey_ns.doc(
+        summary="Respondents of a survey with their patient identity",
+        description="Users who submitted the survey, most recent first, with their UHID and patient details "
+                    "from the CDAC and UHID services. Identities are served from cache; those still being "
+                    "looked up have status 'pending' and show up on a later call.",
+        params={
+            'page': 'Page number (default 1)',
+            'per_page': 'Respondents per page (1-100, default 20)',
+        },
+        responses={
+            200: 'Respondents',
+            401: 'Unauthorized',
+            403: 'Forbidden',
+            404: 'Survey not found'
+        }
+    )
+    @token_required
+    def get(self, current_user, survey_id):
+        """Fetch the respondents of a survey"""
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "see the respondents of this survey")
+        page = _int_arg('page', 1, 1, 10 ** 6)
+        per_page = _int_arg('per_page', 20, 1, 100)
+
+        last_attempt_at = func.max(SurveyAttempt.attempt_date)
+        rows = db.session.execute(
+            select(SurveyAttempt.user_id, User.first_name, User.last_name, User.mobile,
+                   func.count(SurveyAttempt.id).label('attempts'), last_attempt_at.label('last_attempt_at'))
+            .join(User, User.id == SurveyAttempt.user_id)
+            .where(SurveyAttempt.survey_id == survey.id)
+            .group_by(SurveyAttempt.user_id, User.first_name, User.last_name, User.mobile)
+            .order_by(last_attempt_at.desc(), SurveyAttempt.user_id)
+            .limit(per_page + 1).offset((page - 1) * per_page)
+        ).all()
+        identities = patient_records([row.mobile for row in rows[:per_page]])
+        return {
+            'respondents': [{
+                'user_id': row.user_id,
+                'first_name': row.first_name,
+                'last_name': row.last_name,
+                'attempts': row.attempts,
+                'last_attempt_at': row.last_attempt_at.isoformat(),
+                'identity': identities[row.mobile],
+            } for row in rows[:per_page]],
+            'page': page,
+            'per_page': per_page,
+            'has_more': len(rows) > per_page,
+        }, 200
+
+
+@survey_ns.route('/<int:survey_id>/mail')
+@survey_ns.param('survey_id', 'The Survey ID')
+class SurveyMailResource(Resource):
+    @survey_ns.doc(
+        summary="Mailings of a survey",
+        description="Campaigns sent for the survey, newest first, with their messages per status "
+                    "(queued, sent, failed, bounced).",
+        responses={
+            200: 'Campaigns',
+            401: 'Unauthorized',
+            403: 'Forbidden',
+            404: 'Survey not found'
+        }
+    )
+    @token_required
+    def get(self, current_user, survey_id):
+        """List the mailings of a survey"""
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "see the mailings of this survey")
+        campaigns = db.session.execute(
+            select(MailCampaign.id, MailCampaign.template, MailCampaign.created_at)
+            .where(MailCampaign.survey_id == survey.id, MailCampaign.tenant_id == current_tenant())
+            .order_by(MailCampaign.id.desc()).limit(100)
+        ).all()
+        counts = campaign_counts([campaign.id for campaign in campaigns])
+        return {'campaigns': [{
+            'campaign_id': campaign.id,
+            'template': campaign.template,
+            'created_at': campaign.created_at.isoformat(),
+            'messages': counts[campaign.id],
+        } for campaign in campaigns]}, 200
+
+    @survey_ns.expect(survey_mail_model, validate=True)
+    @survey_ns.doc(
+        summary="Email an invitation or a results summary",
+        description="Queues one email per recipient with an address; they are sent in the background. "
+                    "Addresses that bounced before are skipped.",
+        responses={
+            202: 'Queued',
+            400: 'Bad request',
+            403: 'Forbidden',
+            404: 'Survey not found',
+            503: 'Mail is disabled'
+        }
+    )
+    @token_required
+    def post(self, current_user, survey_id):
+        """Email the users of a survey"""
+        if not current_app.config['MAIL_SERVICE']:
+            raise ServiceUnavailable("Mail is disabled.")
+        data = request.json
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "email the users of this survey")
+        if data['template'] not in mail_templates:
+            raise BadRequest(f"template must be one of: {', '.join(mail_templates)}")
+        user_ids = data.get('user_ids')
+        if user_ids is None and data['template'] == 'invitation':
+            raise BadRequest("user_ids is required for invitations.")
+        return queue_survey_mail(survey, data['template'], user_ids, current_user.id), 202
+
+
+@survey_ns.route('/<int:survey_id>/invitations')
+@survey_ns.param('survey_id', 'The Survey ID')
+class SurveyInvitationsResource(Resource):
+    @survey_ns.doc(
+        summary="Invitation counts of a survey",
+        description="How many invitations were issued, accepted (answered), revoked or expired, and how many "
+                    "are still pending.",
+        responses={
+            200: 'Counts',
+            401: 'Unauthorized',
+            403: 'Forbidden',
+            404: 'Survey not found'
+        }
+    )
+    @token_required
+    def get(self, current_user, survey_id):
+        """Count the invitations of a survey"""
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "see the invitations of this survey")
+        return invitation_stats(survey.id), 200
+
+    @survey_ns.expect(survey_invitations_model, validate=True)
+    @survey_ns.doc(
+        summary="Invite users to answer a survey",
+        description="Issues each user a signed link that answers the survey without logging in, once. Users "
+                    "who already hold a valid invitation are skipped. The links are returned and, with email, "
+                    "mailed to the users who have an address.",
+        responses={
+            201: 'Invitations created',
+            400: 'Bad request',
+            403: 'Forbidden',
+            404: 'Survey not found',
+            503: 'Mail is disabled'
+        }
+    )
+    @token_required
+    def post(self, current_user, survey_id):
+        """Invite users to a survey"""
+        data = request.json
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "invite users to this survey")
+        if len(data['user_ids']) > MAX_INVITATIONS_PER_REQUEST:
+            raise BadRequest(f"At most {MAX_INVITATIONS_PER_REQUEST} users can be invited per request.")
+        days = data.get('expires_in_days') or current_app.config['INVITATION_TTL_DAYS']
+        if not 1 <= days <= 365:
+            raise BadRequest("expires_in_days must be between 1 and 365.")
+        if data.get('email') and not current_app.config['MAIL_SERVICE']:
+            raise ServiceUnavailable("Mail is disabled.")
+
+        invitations = []
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=days)
+        stats = create_invitations(survey, data['user_ids'], expires_at, email=data.get('email', False),
+                                   created_by=current_user.id, on_batch=invitations.extend)
+        return {**stats, 'expires_at': expires_at.isoformat(), 'invitations': [{
+            'invitation_id': invitation_id,
+            'user_id': user_id,
+            'link': invitation_url(current_app.config, survey.id, token),
+        } for invitation_id, user_id, token in invitations]}, 201
+
+    @survey_ns.expect(survey_invitations_revoke_model, validate=True)
+    @survey_ns.doc(
+        summary="Revoke invitations",
+        description="Revoked invitations are refused within INVITATION_DENYLIST_REFRESH seconds on every worker.",
+        responses={
+            200: 'Invitations revoked',
+            403: 'Forbidden',
+            404: 'Survey not found'
+        }
+    )
+    @token_required
+    def delete(self, current_user, survey_id):
+        """Revoke invitations to a survey"""
+        survey = Survey.query.get_or_404(survey_id)
+        validate_survey_owner(survey, current_user, "revoke invitations to this survey")
+        invitation_ids = (request.get_json(silent=True) or {}).get('invitation_ids')
+        return {'revoked': revoke_invitations(survey.id, invitation_ids)}, 200
 
 
+@survey_ns.errorhandler(StaleDataError)
+def handle_stale_data(error):
+    """A row changed between our read and our versioned UPDATE."""
+    db.session.rollback()
+    return {"message": "The survey was modified by someone else, reload it and retry."}, 409
@@ -1,5 +1,5 @@
 from app.extensions import ma
-from app.model import Answer, Survey, Question, Option, QuestionConstraint, User, Role, Otp
+from app.model import Answer, ArchivedAnswer, Survey, Question, Option, QuestionConstraint, User, Role, Otp
 
 # Schemas
 
@@ -82,6 +82,15 @@ class AnswerSchema(ma.SQLAlchemyAutoSchema):
     survey = ma.Nested(SurveySchema, exclude=('answers',))  # Prevent circular reference
     question = ma.Nested(QuestionSchema, exclude=('answers',))  # Exclude answers to prevent circular reference
 
+# Archived Answer Schema, same shape as AnswerSchema plus archived_at
+class ArchivedAnswerSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = ArchivedAnswer
+        include_fk = True
+        load_instance = True
+
+    question = ma.Nested(QuestionSchema, exclude=('answers',))
+
 
 # Schema Instances
 user_schema = UserSchema()
@@ -107,3 +116,4 @@ constraints_schema = QuestionConstraintSchema(many=True)
 
 answer_schema = AnswerSchema()
 answers_schema = AnswerSchema(many=True)
+archived_answers_schema = ArchivedAnswerSchema(many=True)
@@ -0,0 +1,88 @@
+import random
+import re
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select
+
+from app.extensions import db
+from app.model import Answer, Question
+from app.util.search import KINDS, search
+from app.util.tenancy import tenant_engine
+
+search_cli = AppGroup('search', help='Full-text search index maintenance.')
+
+
+def _backend():
+    backend = current_app.extensions['search']
+    if backend is None:
+        raise click.ClickException(f"Search is not supported on {db.engine.dialect.name}.")
+    return backend
+
+
+@search_cli.command('rebuild')
+@with_appcontext
+def rebuild_command():
+    """Rebuild the full-text index from the survey, question and answer tables.
+
+    Needed once for databases created before search existed, or after writing to the tables with
+    the triggers disabled. Writes are indexed as they happen otherwise. Rebuilds the index of the
+    SPARS_TENANT database, the default one when unset.
+    """
+    backend = _backend()
+    started = time.perf_counter()
+    with tenant_engine().begin() as connection:
+        backend.rebuild(connection)
+    click.echo(f"Rebuilt the {backend.name} index in {time.perf_counter() - started:.1f}s.")
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@search_cli.command('bench')
+@click.option('--queries', default=50, show_default=True, help='Queries per query shape.')
+@click.option('--per-page', default=20, show_default=True)
+@click.option('--seed', default=0, show_default=True, help='Random seed for picking query words.')
+@with_appcontext
+def bench_command(queries, per_page, seed):
+    """Time ranked searches over the current data, by query shape.
+
+    Query words are sampled from stored answers and questions, so common words are picked about as
+    often as users would type them. Use `flask seed` to get a realistic volume first.
+    """
+    _backend()
+    rng = random.Random(seed)
+    max_id = db.session.execute(select(func.max(Answer.id))).scalar() or 0
+    texts = db.session.execute(
+        select(Answer.answer_text).where(Answer.id.in_([rng.randint(1, max_id) for _ in range(2000)]),
+                                         Answer.answer_text.isnot(None))
+    ).scalars().all()
+    texts += db.session.execute(select(Question.text).limit(200)).scalars().all()
+    words = [word.lower() for text in texts for word in re.findall(r'[^\W\d_]{3,}', text)]
+    if not words:
+        raise click.ClickException("No text to sample query words from, run `flask seed` first.")
+
+    shapes = {
+        'one word': lambda: rng.choice(words),
+        'two words': lambda: f"{rng.choice(words)} {rng.choice(words)}",
+        'prefix': lambda: rng.choice(words)[:3] + '*',
+        'page 5': lambda: rng.choice(words),
+    }
+    indexed = db.session.execute(select(func.count(Answer.id)).where(Answer.answer_text.isnot(None))).scalar()
+    click.echo(f"{indexed} answers with text, {queries} queries per shape, {per_page} results per page")
+    for shape, make_query in shapes.items():
+        page = 5 if shape == 'page 5' else 1
+        timings, hits = [], 0
+        for _ in range(queries):
+            query = make_query()
+            started = time.perf_counter()
+            rows, _ = search(query, set(KINDS.values()), page=page, per_page=per_page)
+            timings.append((time.perf_counter() - started) * 1000)
+            hits += bool(rows)
+            db.session.rollback()
+        click.echo(f"{shape:>10}: p50 {_percentile(timings, 0.5):.1f}ms  p95 {_percentile(timings, 0.95):.1f}ms  "
+                   f"max {max(timings):.1f}ms  ({hits}/{queries} with results)")
@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+logger = logging.getLogger('spars.startup')
+
+
+class StartupTimer:
+    """Records how long each phase of create_app took, starting from the first import of the app package."""
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = []
+        self._last = started
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        return {
+            'pid': os.getpid(),
+            'total_ms': round((self._last - self.started) * 1000, 2),
+            'phases_ms': {phase: round(seconds * 1000, 2) for phase, seconds in self.phases},
+        }
+
+
+def warm_up(app, api=None):
+    """Build everything that is otherwise created on first use.
+
+    Used when gunicorn preloads the app, so the work happens once in the master and workers
+    inherit it through copy-on-write instead of paying for it after fork.
+    """
+    from sqlalchemy.orm import configure_mappers
+
+    import requests  # noqa: F401  imported lazily by the SMS service
+
+    configure_mappers()
+    if api is not None:
+        with app.test_request_context():
+            api.__schema__  # flask-restx caches the Swagger spec on first access
+
+
+@click.command('startup-report')
+@with_appcontext
+def startup_report_command():
+    """Print the cold-start timing of this process."""
+    click.echo(json.dumps(current_app.extensions['startup_timing'], indent=2))
@@ -0,0 +1,93 @@
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import select, update
+
+from app.extensions import db
+from app.model import User
+from app.util.tenancy import DEFAULT, fan_out, merge_counts, sync_users, tenant_stats, tenants
+
+tenants_cli = AppGroup('tenants', help='Tenant databases: users, statistics and schema migrations.')
+
+
+def _tenant(name):
+    if name not in current_app.config['TENANT_DATABASES']:
+        raise click.ClickException(f"Unknown tenant {name!r}, configure it in TENANT_DATABASES.")
+    return name
+
+
+@tenants_cli.command('list')
+@with_appcontext
+def list_command():
+    """Show the configured tenants and where their data lives."""
+    click.echo(f"{DEFAULT:>20}: {db.engine.url.render_as_string()}")
+    for tenant in tenants():
+        database = current_app.config['TENANT_DATABASES'][tenant]
+        if isinstance(database, dict):
+            database = f"{database['url']}" + (f" schema {database['schema']}" if database.get('schema') else '')
+        click.echo(f"{tenant:>20}: {database}")
+
+
+@tenants_cli.command('assign')
+@click.argument('tenant')
+@click.argument('mobiles', nargs=-1, required=True)
+@with_appcontext
+def assign_command(tenant, mobiles):
+    """Move users, by mobile number, to TENANT ("default" for the default database).
+
+    Only new survey data goes to the tenant's database; existing data stays where it is. Users get
+    the new tenant with their next token.
+    """
+    tenant = None if tenant == DEFAULT else _tenant(tenant)
+    found = db.session.execute(select(User.id, User.mobile).where(User.mobile.in_(mobiles))).all()
+    unknown = set(mobiles).difference(row.mobile for row in found)
+    if unknown:
+        raise click.ClickException(f"No user with mobile {', '.join(sorted(unknown))}.")
+    user_ids = [row.id for row in found]
+    db.session.execute(update(User).where(User.id.in_(user_ids)).values(tenant_id=tenant))
+    db.session.commit()
+    if tenant is not None:
+        sync_users(tenant, user_ids)
+    click.echo(f"Assigned {len(user_ids)} users to {tenant or DEFAULT}.")
+
+
+@tenants_cli.command('sync-users')
+@click.option('--tenant', 'names', multiple=True, help='Only this tenant (repeatable).')
+@with_appcontext
+def sync_users_command(names):
+    """Refresh each tenant's replica of its users from the default database.
+
+    Creating and changing users refreshes them; run this after changing users in the database directly.
+    """
+    for tenant in [_tenant(name) for name in names] or tenants():
+        started = time.perf_counter()
+        click.echo(f"{tenant}: {sync_users(tenant)} users copied in {time.perf_counter() - started:.1f}s")
+
+
+@tenants_cli.command('stats')
+@with_appcontext
+def stats_command():
+    """Users, surveys, attempts and answers per tenant, counted on all databases in parallel."""
+    results = fan_out(tenant_stats)
+    for tenant, counts in dict(results, total=merge_counts(results)).items():
+        click.echo(f"{tenant:>20}: " + ', '.join(f"{value} {name}" for name, value in counts.items()))
+
+
+@tenants_cli.command('upgrade')
+@click.option('--tenant', 'names', multiple=True,
+              help='Only this tenant (repeatable, "default" for the default database).')
+@click.option('--revision', default='head', show_default=True, help='Revision to upgrade to.')
+@with_appcontext
+def upgrade_command(names, revision):
+    """Run the migrations on the default database and every tenant database, one after the other.
+
+    The same as `flask db upgrade -x tenant=<name>` for each tenant; tenant databases only run the
+    part of each revision that touches the shard tables.
+    """
+    from flask_migrate import upgrade  # alembic is only needed here
+
+    for tenant in [None if name == DEFAULT else _tenant(name) for name in names] or [None, *tenants()]:
+        click.echo(f"{tenant or DEFAULT}: upgrading to {revision}")
+        upgrade(revision=revision, x_arg=[f"tenant={tenant}"] if tenant is not None else None)
@@ -0,0 +1,192 @@
+import csv
+import json
+import re
+import time
+import uuid
+from datetime import date, datetime
+from itertools import islice
+
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import insert, or_, select, update
+
+from app.extensions import db
+from app.model import Role, User, user_roles
+from app.util.tenancy import replicate_users
+
+users_cli = AppGroup('users', help='Bulk user provisioning.')
+
+PROFILE_FIELDS = ('first_name', 'middle_name', 'last_name', 'dob', 'gender', 'aadhar', 'email')
+_MOBILE = re.compile(r'^\+?\d{6,14}$')
+_AADHAR = re.compile(r'^\d{12}$')
+_EMAIL = re.compile(r'^[!-?A-~]+@[!-?A-~]+\.[!-?A-~]+$')  # printable ASCII, one @
+
+
+def _read_records(fh, fmt):
+    """Yield (line number, raw dict) from a CSV (with header) or NDJSON file, one record at a time."""
+    if fmt == 'csv':
+        for number, record in enumerate(csv.DictReader(fh), start=2):
+            yield number, record
+    else:
+        for number, line in enumerate(fh, start=1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+
+def _clean(record):
+    """Validate one raw record; returns (mobile, profile fields, role names) or raises ValueError."""
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+
+    def text(name):
+        value = record.get(name)
+        value = str(value).strip() if value is not None else ''
+        return value or None
+
+    mobile = text('mobile')
+    if mobile is None or not _MOBILE.match(mobile):
+        raise ValueError(f"invalid mobile {mobile!r}")
+    profile = {name: text(name) for name in PROFILE_FIELDS}
+    if profile['aadhar'] is not None and not _AADHAR.match(profile['aadhar']):
+        raise ValueError(f"invalid aadhar {profile['aadhar']!r}")
+    if profile['email'] is not None:
+        if len(profile['email']) > 254 or not _EMAIL.match(profile['email']):
+            raise ValueError(f"invalid email {profile['email']!r}")
+        profile['email'] = profile['email'].lower()
+    if profile['dob'] is not None:
+        profile['dob'] = date.fromisoformat(profile['dob'])
+
+    roles = record.get('roles') or []
+    if isinstance(roles, str):
+        roles = re.split(r'[;|,]', roles)
+    return mobile, profile, {role.strip().upper() for role in roles if role and role.strip()}
+
+
+class ImportStats:
+    def __init__(self):
+        self.rows = self.inserted = self.updated = self.skipped = self.roles_added = 0
+        self.started = time.perf_counter()
+
+    def line(self):
+        elapsed = time.perf_counter() - self.started
+        return (f"{self.rows} rows: {self.inserted} inserted, {self.updated} updated, {self.skipped} skipped, "
+                f"{self.roles_added} roles added ({self.rows / elapsed if elapsed else 0:.0f} rows/s)")
+
+
+def import_chunk(records, role_ids, stats, report):
+    """Upsert one chunk of cleaned records and their role links in a handful of statements.
+
+    Users are matched on mobile; a row whose aadhar already belongs to another mobile is skipped.
+    Empty cells never overwrite existing values, and roles are only ever added.
+    """
+    # Within a chunk the last record for a mobile wins
+    by_mobile = {}
+    for number, mobile, profile, roles in records:
+        by_mobile[mobile] = (number, profile, roles)
+
+    aadhars = [profile['aadhar'] for _, profile, _ in by_mobile.values() if profile['aadhar']]
+    existing = db.session.execute(
+        select(User.id, User.mobile, User.aadhar).where(or_(User.mobile.in_(by_mobile), User.aadhar.in_(aadhars)))
+    ).all()
+    id_by_mobile = {row.mobile: row.id for row in existing}
+    aadhar_owner = {row.aadhar: row.mobile for row in existing if row.aadhar}
+
+    now = datetime.utcnow()
+    inserts, updates, user_roles_wanted = [], {}, []
+    for mobile, (number, profile, roles) in by_mobile.items():
+        owner = aadhar_owner.get(profile['aadhar'])
+        if owner is not None and owner != mobile:
+            stats.skipped += 1
+            report(number, f"aadhar already registered to {owner}")
+            continue
+        if profile['aadhar']:
+            aadhar_owner[profile['aadhar']] = mobile
+
+        user_id = id_by_mobile.get(mobile)
+        if user_id is None:
+            user_id = str(uuid.uuid4())
+            inserts.append(dict(profile, id=user_id, mobile=mobile, created_at=now, updated_at=now))
+        else:
+            changes = {name: value for name, value in profile.items() if value is not None}
+            # Executemany needs the same columns in every row, so group updates by the columns they set
+            updates.setdefault(frozenset(changes), []).append(dict(changes, id=user_id, updated_at=now))
+        user_roles_wanted.extend((user_id, role_ids[role]) for role in roles)
+
+    if inserts:
+        db.session.execute(insert(User), inserts)
+    for rows in updates.values():
+        db.session.execute(update(User), rows)
+
+    if user_roles_wanted:
+        user_ids = {user_id for user_id, _ in user_roles_wanted}
+        linked = set(db.session.execute(
+            select(user_roles.c.user_id, user_roles.c.role_id).where(user_roles.c.user_id.in_(user_ids))
+        ).all())
+        missing = [{'user_id': user_id, 'role_id': role_id}
+                   for user_id, role_id in set(user_roles_wanted) - linked]
+        if missing:
+            db.session.execute(insert(user_roles), missing)
+        stats.roles_added += len(missing)
+
+    db.session.commit()
+    # Tenant replicas keep a copy of the profiles
+    replicate_users([row['id'] for rows in updates.values() for row in rows])
+    stats.inserted += len(inserts)
+    stats.updated += sum(len(rows) for rows in updates.values())
+
+
+@users_cli.command('import')
+@click.argument('source', type=click.File(encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format; guessed from the file extension by default.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Records upserted per transaction.')
+@click.option('--create-roles', is_flag=True, help='Create roles that do not exist yet instead of rejecting the row.')
+@click.option('--max-errors', default=20, show_default=True, help='Rejected rows printed before going quiet.')
+@with_appcontext
+def import_command(source, fmt, chunk_size, create_roles, max_errors):
+    """Create or update users and their roles from a CSV or NDJSON file.
+
+    Columns/keys: mobile (required), aadhar, first_name, middle_name, last_name, dob (YYYY-MM-DD),
+    gender, email and roles (a list, or names separated by ";" in CSV). Use "-" to read from stdin.
+    """
+    if fmt is None:
+        fmt = 'ndjson' if source.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    role_ids = dict(db.session.execute(select(Role.name, Role.id)).all())
+    stats = ImportStats()
+
+    def report(number, message):
+        if stats.skipped <= max_errors:
+            click.echo(f"line {number}: {message}", err=True)
+
+    records = _read_records(source, fmt)
+    while True:
+        batch = list(islice(records, chunk_size))
+        if not batch:
+            break
+        chunk = []
+        for number, record in batch:
+            stats.rows += 1
+            try:
+                mobile, profile, roles = _clean(record)
+            except ValueError as e:
+                stats.skipped += 1
+                report(number, str(e))
+                continue
+            unknown = roles.difference(role_ids)
+            if unknown and not create_roles:
+                stats.skipped += 1
+                report(number, f"unknown role(s) {', '.join(sorted(unknown))}")
+                continue
+            for name in unknown:
+                role_ids[name] = db.session.execute(insert(Role).values(
+                    name=name, created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+                )).inserted_primary_key[0]
+            chunk.append((number, mobile, profile, roles))
+        if chunk:
+            import_chunk(chunk, role_ids, stats, report)
+        click.echo(stats.line())
+
+    click.echo(f"Done. {stats.line()}")
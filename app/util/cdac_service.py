@@ -0,0 +1,27 @@
+from app.util.lookup import LookupClient, lookup_client
+
+
+class CdacClient(LookupClient):
+    """e-Hospital (CDAC) registrations by mobile number, which give the patient's UHID.
+
+    GET /registrations/<mobile> returns {"mobile": ..., "uhid": ..., "registered_on": ..., ...} or a
+    404; POST /registrations/_batch {"ids": [mobiles]} returns {"registrations": [...]} without the
+    unknown ones.
+    """
+    name = 'cdac'
+    path = '/registrations/{key}'
+    batch_path = '/registrations/_batch'
+    collection = 'registrations'
+    key_field = 'mobile'
+
+
+def get_registration(mobile):
+    """Registration of `mobile`, None when unknown or the service is disabled; raises LookupFailed."""
+    client = lookup_client('cdac')
+    return client.get(mobile) if client is not None else None
+
+
+def get_registrations(mobiles):
+    """{mobile: registration or None} in batches; empty when the service is disabled; raises LookupFailed."""
+    client = lookup_client('cdac')
+    return client.get_many(mobiles) if client is not None else {}
@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, gzip is always available
+    zstandard = None
+
+
+class CompressedBodyCache:
+    """Thread-safe LRU of compressed bodies keyed by (etag, encoding), bounded in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None:
+                self._items.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+def _build_encoders(config):
+    """Return {encoding: compress_fn} in server preference order."""
+    encoders = OrderedDict()
+    if brotli is not None:
+        level = config['COMPRESSION_BR_LEVEL']
+        encoders['br'] = lambda data: brotli.compress(data, quality=level)
+    if zstandard is not None:
+        level = config['COMPRESSION_ZSTD_LEVEL']
+        encoders['zstd'] = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    level = config['COMPRESSION_GZIP_LEVEL']
+    encoders['gzip'] = lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    return encoders
+
+
+def negotiate_encoding(accept_encodings, available):
+    """Pick the best encoding the client accepts, preferring server order on ties."""
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def init_compression(app):
+    """Register gzip/brotli/zstd compression and strong ETags for GET responses."""
+    config = app.config
+    encoders = _build_encoders(config)
+    cache = CompressedBodyCache(config['COMPRESSION_CACHE_SIZE'])
+    app.extensions['compression_cache'] = cache
+
+    min_size = config['COMPRESSION_MIN_SIZE']
+    mimetypes = set(config['COMPRESSION_MIMETYPES'])
+    cacheable_endpoints = set(config['COMPRESSION_CACHE_ENDPOINTS'])
+    etag_enabled = config['ETAG_SERVICE']
+    compression_enabled = config['COMPRESSION_SERVICE']
+
+    @app.after_request
+    def compress_response(response):
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        if response.mimetype not in mimetypes:
+            return response
+
+        body = response.get_data()
+        etag = None
+        if etag_enabled and request.method in ('GET', 'HEAD') and response.status_code == 200 \
+                and 'ETag' not in response.headers:
+            etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+        encoding = None
+        if compression_enabled:
+            response.vary.add('Accept-Encoding')
+            if (len(body) >= min_size and 200 <= response.status_code < 300
+                    and response.status_code not in (204, 206)
+                    and 'Content-Encoding' not in response.headers
+                    and 'no-transform' not in response.headers.get('Cache-Control', '')):
+                encoding = negotiate_encoding(request.accept_encodings, encoders)
+
+        if etag is not None:
+            # Each content coding is a different representation, so it gets its own strong ETag
+            response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+        if encoding is None:
+            return response
+
+        cache_key = (etag, encoding) if etag and request.endpoint in cacheable_endpoints else None
+        compressed = cache.get(cache_key) if cache_key else None
+        if compressed is None:
+            compressed = encoders[encoding](body)
+            if cache_key:
+                cache.set(cache_key, compressed)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,87 @@
+from flask import current_app
+from sqlalchemy import func, select
+
+from app.extensions import db
+from app.model import Answer, Question, Survey, SurveyAttempt
+from app.util.cache import TTLCache
+from app.util.tenancy import current_tenant
+
+
+def _latest_attempt_id(user_id):
+    return db.session.execute(
+        select(func.max(SurveyAttempt.id)).where(SurveyAttempt.user_id == user_id)
+    ).scalar()
+
+
+def build_dashboard(user_id):
+    """Every survey the user attempted, with attempt counts, last attempt and completion, in one query.
+
+    Completion is the best attempt's answers over the survey's live questions, capped at 100%.
+    """
+    attempted = select(SurveyAttempt.survey_id).where(SurveyAttempt.user_id == user_id)
+    question_counts = (
+        select(Question.survey_id, func.count(Question.id).label('questions'))
+        .where(Question.survey_id.in_(attempted))  # soft-deleted questions are filtered globally
+        .group_by(Question.survey_id)
+        .subquery()
+    )
+    # answers_count is stored with each attempt; older attempts fall back to counting their answers
+    answered = func.coalesce(
+        SurveyAttempt.answers_count,
+        select(func.count(Answer.id)).where(Answer.attempt_id == SurveyAttempt.id).scalar_subquery(),
+    )
+    last_attempt_at = func.max(SurveyAttempt.attempt_date)
+    rows = db.session.execute(
+        select(
+            Survey.id, Survey.title, Survey.status,
+            func.count(SurveyAttempt.id).label('attempts'),
+            last_attempt_at.label('last_attempt_at'),
+            func.max(SurveyAttempt.id).label('last_attempt_id'),
+            func.max(answered).label('answered'),
+            func.coalesce(question_counts.c.questions, 0).label('questions'),
+        )
+        .join(SurveyAttempt, SurveyAttempt.survey_id == Survey.id)
+        .outerjoin(question_counts, question_counts.c.survey_id == Survey.id)
+        .where(SurveyAttempt.user_id == user_id)
+        .group_by(Survey.id, Survey.title, Survey.status, question_counts.c.questions)
+        .order_by(last_attempt_at.desc())
+    ).all()
+
+    surveys = [{
+        'survey_id': row.id,
+        'title': row.title,
+        'status': row.status,
+        'attempts': row.attempts,
+        'last_attempt_at': row.last_attempt_at.isoformat(),
+        'questions': row.questions,
+        'completion': min(100.0, round(100.0 * (row.answered or 0) / row.questions, 1)) if row.questions else None,
+    } for row in rows]
+    return {
+        'surveys': surveys,
+        'total_attempts': sum(survey['attempts'] for survey in surveys),
+    }
+
+
+def user_dashboard(user_id):
+    """Cached build_dashboard.
+
+    Entries are keyed by the user's latest attempt id, so a submission through any worker or the
+    ASGI app invalidates them; checking that id is a single indexed lookup instead of the aggregate.
+    """
+    cache = current_app.extensions['dashboard_cache']
+    latest = _latest_attempt_id(user_id)
+    # Attempt ids are per tenant database, and superadmins may look at several tenants
+    key = (current_tenant(), user_id)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == latest:
+        return cached[1]
+
+    dashboard = build_dashboard(user_id)
+    cache.set(key, (latest, dashboard))
+    return dashboard
+
+
+def init_dashboard(app):
+    app.extensions['dashboard_cache'] = TTLCache(
+        app.config['DASHBOARD_CACHE_SIZE'], app.config['DASHBOARD_CACHE_TTL']
+    )
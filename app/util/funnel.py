@@ -0,0 +1,236 @@
+from collections import defaultdict
+
+from sqlalchemy import delete, func, select, union_all
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from app.extensions import db
+from app.model import Answer, ArchivedAnswer, Question, QuestionFunnel, Survey, SurveyAttempt
+
+COUNTERS = ('reached', 'answered', 'exited')
+# Submissions spread their increments over this many rows per question, so concurrent attempts on
+# one survey rarely wait for each other's row locks; reads sum the slots.
+FUNNEL_SLOTS = 8
+_UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def load_questions(connection, survey_id):
+    """{question_id: (parent_question_id, parent_option_id)} of the survey's live questions."""
+    return {
+        row.id: (row.parent_question_id, row.parent_option_id)
+        for row in connection.execute(
+            select(Question.id, Question.parent_question_id, Question.parent_option_id)
+            .where(Question.survey_id == survey_id, Question.is_deleted == False)
+        )
+    }
+
+
+def question_order(questions):
+    """Question ids in topological order: depth first, so branching questions follow the question
+    they depend on, and siblings keep creation (id) order."""
+    children = defaultdict(list)
+    roots = []
+    for question_id, (parent_id, _) in questions.items():
+        if parent_id in questions and parent_id != question_id:
+            children[parent_id].append(question_id)
+        else:
+            roots.append(question_id)
+    order = []
+    stack = sorted(roots, reverse=True)
+    while stack:
+        question_id = stack.pop()
+        order.append(question_id)
+        stack.extend(sorted(children[question_id], reverse=True))
+    # A parent cycle (bad data) cannot be ordered; keep those questions at the end
+    order += sorted(set(questions).difference(order))
+    return order
+
+
+class FunnelCounter:
+    """Funnel of `attempt_count` attempts, computed on bitsets.
+
+    Each question's attempts are a bitset (a Python int), so once the answers are in, a stage costs
+    a few AND/OR/popcounts over all attempts instead of a loop over them:
+    - visible: root questions, or the branch condition holds (or the attempt answered it anyway);
+    - reached: visible and the attempt has not dropped out before;
+    - exited: reached but nothing from here on answered, i.e. the attempt stopped at this question.
+    """
+
+    def __init__(self, questions, order, attempt_count):
+        self.questions = questions
+        self.order = order
+        self.attempt_count = attempt_count
+        size = (attempt_count + 7) // 8
+        self.answered_bits = {question_id: bytearray(size) for question_id in questions}
+        self.selected_bits = defaultdict(lambda: bytearray(size))
+
+    def add(self, index, question_id, option_id):
+        """Record that attempt number `index` answered `question_id`, choosing `option_id`."""
+        bits = self.answered_bits.get(question_id)
+        if bits is None:
+            return  # answer to a question deleted since
+        bits[index >> 3] |= 1 << (index & 7)
+        if option_id is not None:
+            self.selected_bits[option_id][index >> 3] |= 1 << (index & 7)
+
+    def counts(self):
+        """(question_id, reached, answered, exited) per question, in order."""
+        answered = {question_id: int.from_bytes(bits, 'little') for question_id, bits in self.answered_bits.items()}
+        everyone = (1 << self.attempt_count) - 1
+        visible = {}
+        for question_id in self.order:
+            parent_id, option_id = self.questions[question_id]
+            if parent_id not in visible:
+                gate = everyone
+            elif option_id is not None:
+                gate = visible[parent_id] & int.from_bytes(self.selected_bits.get(option_id, b''), 'little')
+            else:
+                gate = visible[parent_id] & answered[parent_id]
+            visible[question_id] = gate | answered[question_id]
+
+        answered_from = []
+        later = 0
+        for question_id in reversed(self.order):
+            later |= answered[question_id]
+            answered_from.append(later)
+        answered_from.reverse()
+
+        counts = []
+        stopped = 0
+        for question_id, answered_later in zip(self.order, answered_from):
+            reached = visible[question_id] & ~stopped
+            exited = reached & ~answered_later
+            stopped |= exited
+            counts.append((question_id, reached.bit_count(), answered[question_id].bit_count(), exited.bit_count()))
+        return counts
+
+
+def _add_counts(connection, survey_id, version, slot, counts):
+    """Add counts onto the funnel rows with one upsert."""
+    table = QuestionFunnel.__table__
+    rows = [{'survey_id': survey_id, 'survey_version': version, 'question_id': question_id, 'slot': slot,
+             'position': position, 'reached': reached, 'answered': answered, 'exited': exited}
+            for position, (question_id, reached, answered, exited) in enumerate(counts, start=1)]
+    if not rows:
+        return
+    dialect = connection.dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(
+            {name: table.c[name] + statement.inserted[name] for name in COUNTERS})
+    else:
+        statement = _UPSERTS[dialect](table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={name: table.c[name] + statement.excluded[name] for name in COUNTERS})
+    connection.execute(statement, rows)
+
+
+def add_attempt(connection, survey_id, version, questions, attempt_id, answers):
+    """Count one new attempt into the funnel of its questions version, in the caller's transaction."""
+    counter = FunnelCounter(questions, question_order(questions), 1)
+    for answer in answers:
+        counter.add(0, answer['question_id'], answer.get('selected_option_id'))
+    _add_counts(connection, survey_id, version, attempt_id % FUNNEL_SLOTS, counter.counts())
+
+
+def _in_surveys(column, survey_ids):
+    """Filter criteria restricting `column` to `survey_ids`; none when survey_ids is None (all surveys)."""
+    return () if survey_ids is None else (column.in_(survey_ids),)
+
+
+def _count_attempts(connection, survey_ids, structures, after_id=0):
+    """FunnelCounters per (survey_id, version) over the attempts with an id above `after_id`.
+
+    Reads the attempts, then streams all their answers in a single scan. Attempts recorded before
+    versions were tracked count toward the current questions version. Returns (counters, last attempt id).
+    """
+    attempts = connection.execute(
+        select(SurveyAttempt.id, SurveyAttempt.survey_id,
+               func.coalesce(SurveyAttempt.survey_version, Survey.questions_version))
+        .join(Survey, Survey.id == SurveyAttempt.survey_id)
+        .where(SurveyAttempt.id > after_id, *_in_surveys(SurveyAttempt.survey_id, survey_ids))
+        .order_by(SurveyAttempt.id)
+    ).all()
+    by_version = defaultdict(list)
+    for attempt_id, survey_id, version in attempts:
+        by_version[survey_id, version].append(attempt_id)
+
+    counters, located = {}, {}
+    for key, attempt_ids in by_version.items():
+        questions = structures.get(key[0], {})
+        counter = counters[key] = FunnelCounter(questions, question_order(questions), len(attempt_ids))
+        for index, attempt_id in enumerate(attempt_ids):
+            located[attempt_id] = (counter, index)
+    if not attempts:
+        return counters, after_id
+
+    last_id = attempts[-1].id
+    # Answers of closed surveys may have been moved to answer_archive, fully or partly
+    sources = union_all(*(
+        select(model.attempt_id, model.question_id, model.selected_option_id)
+        .where(model.attempt_id > after_id, model.attempt_id <= last_id, *_in_surveys(model.survey_id, survey_ids))
+        for model in (Answer, ArchivedAnswer)
+    ))
+    result = connection.execute(sources.execution_options(stream_results=True))
+    for partition in result.partitions(10000):
+        for attempt_id, question_id, option_id in partition:
+            hit = located.get(attempt_id)
+            if hit is not None:
+                hit[0].add(hit[1], question_id, option_id)
+    return counters, last_id
+
+
+def rebuild_funnels(survey_ids=None):
+    """Recompute the funnels of `survey_ids` (all surveys by default) in one pass over the answers.
+
+    Counting runs before the write transaction; attempts committed in between are counted at the
+    end. Returns the number of survey versions rebuilt.
+    """
+    structures = defaultdict(dict)
+    for row in db.session.execute(
+            select(Question.survey_id, Question.id, Question.parent_question_id, Question.parent_option_id)
+            .where(*_in_surveys(Question.survey_id, survey_ids))):
+        structures[row.survey_id][row.id] = (row.parent_question_id, row.parent_option_id)
+
+    counters, last_id = _count_attempts(db.session.connection(), survey_ids, structures)
+    db.session.commit()
+
+    connection = db.session.connection()
+    connection.execute(delete(QuestionFunnel).where(*_in_surveys(QuestionFunnel.survey_id, survey_ids)))
+    for (survey_id, version), counter in counters.items():
+        _add_counts(connection, survey_id, version, 0, counter.counts())
+    late, _ = _count_attempts(connection, survey_ids, structures, after_id=last_id)
+    for (survey_id, version), counter in late.items():
+        _add_counts(connection, survey_id, version, 0, counter.counts())
+    db.session.commit()
+    return len(counters.keys() | late.keys())
+
+
+def survey_funnel(survey, version=None):
+    """The funnel of one questions version of the survey (the current one by default), one indexed aggregate."""
+    version = survey.questions_version if version is None else version
+    rows = db.session.execute(
+        select(QuestionFunnel.question_id, Question.text, func.min(QuestionFunnel.position).label('position'),
+               *(func.sum(getattr(QuestionFunnel, name)).label(name) for name in COUNTERS))
+        .join(Question, Question.id == QuestionFunnel.question_id)
+        .where(QuestionFunnel.survey_id == survey.id, QuestionFunnel.survey_version == version)
+        .group_by(QuestionFunnel.question_id, Question.text)
+        .order_by('position')
+    ).all()
+    attempts = rows[0].reached if rows else 0
+    exited = sum(row.exited for row in rows)
+    return {
+        'survey_id': survey.id,
+        'survey_version': version,
+        'attempts': attempts,
+        'completed': attempts - exited,
+        'questions': [{
+            'question_id': row.question_id,
+            'text': row.text,
+            'position': row.position,
+            'reached': row.reached,
+            'answered': row.answered,
+            'exited': row.exited,
+            'drop_off': round(row.exited / row.reached, 4) if row.reached else None,
+        } for row in rows],
+    }
@@ -11,6 +11,8 @@ def generate_jwt_token(user):
     expiration_time = datetime.utcnow() + timedelta(days=1)  # Token expires in 1 day
     payload = {
         'sub': user.id,  # 'sub' is the subject claim, i.e., the user ID
+        'roles': [role.name.lower() for role in user.roles],  # Checked by verify_superadmin
+        'tenant': user.tenant_id,  # Database of the user's survey data, see app/util/tenancy.py
         'iat': datetime.utcnow(),  # Issued at time
         'exp': expiration_time  # Expiration time
     }
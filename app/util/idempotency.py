@@ -0,0 +1,62 @@
+import re
+
+from werkzeug.exceptions import BadRequest, Conflict
+
+from app.model import SurveyAttempt
+from app.util.cache import TTLCache
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Body field accepted when the client cannot set headers; the header wins when both are sent
+CLIENT_ATTEMPT_FIELD = 'client_attempt_id'
+_KEY_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+
+def idempotency_key(headers, data):
+    """Return the client's idempotency key from the header or the request body, None if it sent none."""
+    key = headers.get(IDEMPOTENCY_HEADER)
+    if key is None and isinstance(data, dict):
+        key = data.get(CLIENT_ATTEMPT_FIELD)
+    if key is None:
+        return None
+    if not isinstance(key, str) or not _KEY_PATTERN.match(key):
+        raise BadRequest("Idempotency key must be 1-64 letters, digits or ._:- characters.")
+    return key
+
+
+def remember_attempt(cache, user_id, key, survey_id, attempt_id, answers_count):
+    attempt = {'survey_id': survey_id, 'attempt_id': attempt_id, 'answers_count': answers_count}
+    cache.set((user_id, key), attempt)
+    return attempt
+
+
+def find_attempt(connection, cache, user_id, key):
+    """Look up the attempt recorded for a key, in `cache` first and then in the database.
+
+    Returns {survey_id, attempt_id, answers_count} or None.
+    """
+    attempt = cache.get((user_id, key))
+    if attempt is None:
+        row = SurveyAttempt.find_by_key(connection, user_id, key)
+        if row is not None:
+            attempt = remember_attempt(cache, user_id, key, row.survey_id, row.id, row.answers_count)
+    return attempt
+
+
+def replay_result(attempt, survey_id):
+    """Body of the original submission, or 409 if the key was used for another survey."""
+    if attempt['survey_id'] != survey_id:
+        raise Conflict("Idempotency key was already used for another survey.")
+    return {
+        "message": "Answers submitted successfully",
+        "attempt_id": attempt['attempt_id'],
+        "answers_count": attempt['answers_count']
+    }
+
+
+def init_idempotency(app):
+    # Answers retries hitting the same worker without a query; the unique constraint on
+    # survey_attempts(user_id, idempotency_key) is what deduplicates across workers.
+    app.extensions['idempotency_cache'] = TTLCache(
+        app.config['IDEMPOTENCY_CACHE_SIZE'], app.config['IDEMPOTENCY_CACHE_TTL']
+    )
@@ -0,0 +1,178 @@
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, got_request_exception, has_request_context, request
+from pythonjsonlogger import jsonlogger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('spars.request')
+
+_engine_listeners_installed = False
+
+
+class RequestStats:
+    """Timings collected for the current request."""
+
+    __slots__ = ('start', 'db_time', 'queries', 'serialization_time', 'statements')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_time = 0.0
+        self.queries = 0
+        self.serialization_time = 0.0
+        self.statements = Counter()
+
+
+def current_stats():
+    """Return the RequestStats of the active request, or None outside instrumented requests."""
+    if not has_request_context():
+        return None
+    return g.get('request_stats')
+
+
+@contextmanager
+def serialization_timer():
+    """Count the wrapped block as serialization time of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.serialization_time += time.perf_counter() - start
+
+
+def timed_representation(represent):
+    """Wrap a flask-restx representation function so JSON encoding counts as serialization."""
+    @wraps(represent)
+    def wrapper(*args, **kwargs):
+        with serialization_timer():
+            return represent(*args, **kwargs)
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is None or not conn.info.get('query_start_time'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    stats.db_time += elapsed
+    stats.queries += 1
+    stats.statements[statement] += 1
+
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_THRESHOLD_MS']:
+        logger.warning('slow query', extra={
+            'event': 'slow_query',
+            'route': request.url_rule.rule if request.url_rule else request.path,
+            'duration_ms': round(elapsed * 1000, 2),
+            'statement': statement,
+        })
+
+
+def _install_engine_listeners():
+    global _engine_listeners_installed
+    if _engine_listeners_installed:
+        return
+    # Listening on the Engine class covers every engine Flask-SQLAlchemy creates, including binds
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _engine_listeners_installed = True
+
+
+def _configure_logger(level):
+    # Configured on the "spars" parent so spars.request, spars.startup, etc. share the JSON handler
+    root = logging.getLogger('spars')
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        root.addHandler(handler)
+    root.setLevel(level)
+    root.propagate = False
+
+
+def init_instrumentation(app, api=None):
+    """Register per-request timing, query counting and JSON request logging."""
+    config = app.config
+    if not config['LOGGING']:
+        return
+
+    _configure_logger(config['LOG_LEVEL'])
+    _install_engine_listeners()
+
+    if api is not None:
+        api.representations['application/json'] = timed_representation(api.representations['application/json'])
+
+    slow_request_ms = config['SLOW_REQUEST_THRESHOLD_MS']
+    n_plus_one = config['N_PLUS_ONE_THRESHOLD']
+    server_timing = config['SERVER_TIMING_HEADER']
+
+    @app.before_request
+    def start_request_timer():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def log_request(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+
+        total = time.perf_counter() - stats.start
+        route = request.url_rule.rule if request.url_rule else request.path
+
+        if server_timing:
+            response.headers['Server-Timing'] = (
+                f"db;dur={stats.db_time * 1000:.2f}, ser;dur={stats.serialization_time * 1000:.2f}, "
+                f"total;dur={total * 1000:.2f}"
+            )
+            response.headers['X-Query-Count'] = str(stats.queries)
+
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= n_plus_one]
+        for statement, count in repeated:
+            logger.warning('possible N+1 query', extra={
+                'event': 'n_plus_one',
+                'route': route,
+                'count': count,
+                'statement': statement,
+            })
+
+        if config['REQUEST_LOGGING']:
+            record = {
+                'event': 'request',
+                'method': request.method,
+                'route': route,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration_ms': round(total * 1000, 2),
+                'db_ms': round(stats.db_time * 1000, 2),
+                'queries': stats.queries,
+                'serialization_ms': round(stats.serialization_time * 1000, 2),
+                'remote_addr': request.remote_addr,
+            }
+            if config['RESPONSE_LOGGING']:
+                record['response_bytes'] = response.calculate_content_length()
+                record['content_type'] = response.mimetype
+                record['content_encoding'] = response.headers.get('Content-Encoding')
+            level = logging.WARNING if total * 1000 >= slow_request_ms else logging.INFO
+            logger.log(level, 'request', extra=record)
+
+        return response
+
+    if config['ERROR_LOGGING']:
+        def log_exception(sender, exception, **extra):
+            logger.error('unhandled exception', exc_info=exception, extra={
+                'event': 'error',
+                'method': request.method,
+                'route': request.url_rule.rule if request.url_rule else request.path,
+                'error': repr(exception),
+            })
+
+        got_request_exception.connect(log_exception, app, weak=False)
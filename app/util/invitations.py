@@ -0,0 +1,332 @@
+"""Survey invitations: signed tokens that let a user answer one survey without the OTP login.
+
+A token is a JWT for the audience "spars:invitation", signed with INVITATION_SECRET (by default a key
+derived from SECRET_KEY, so a login token never passes for an invitation or the other way round).
+It names the invitation (jti), the user, the survey and the tenant, and is checked without reading
+the database. Revocations reach request handlers through a per-worker Bloom filter of the revoked
+ids, refreshed every INVITATION_DENYLIST_REFRESH seconds; only ids the filter (possibly falsely)
+contains are looked up. Submitting answers with an invitation accepts it, once.
+"""
+import hashlib
+import hmac
+import math
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+
+import jwt
+from flask import current_app, g, request
+from sqlalchemy import case, func, insert, select, update
+from werkzeug.exceptions import Conflict, Forbidden, ServiceUnavailable, Unauthorized
+
+from app.extensions import db
+from app.model import SurveyInvitation, User
+from app.util.tenancy import current_tenant, sync_users
+
+SCHEME = 'Invitation'  # Authorization: Invitation <token>
+AUDIENCE = 'spars:invitation'
+
+# current_user of requests made with an invitation; the user row is not read
+InvitedUser = namedtuple('InvitedUser', ['id', 'invitation_id'])
+
+
+def _secret(config):
+    if config['INVITATION_SECRET']:
+        return config['INVITATION_SECRET']
+    return hmac.new(config['SECRET_KEY'].encode(), b'spars survey invitation', hashlib.sha256).hexdigest()
+
+
+def issue_token(config, invitation_id, survey_id, user_id, tenant, expires_at):
+    """The token of an invitation; the same for the same invitation, so it can be issued again."""
+    return jwt.encode({'jti': invitation_id, 'sub': user_id, 'survey': survey_id, 'tenant': tenant,
+                       'aud': AUDIENCE, 'exp': expires_at}, _secret(config), algorithm='HS256')
+
+
+def read_token(config, token):
+    """Claims of a valid, unexpired invitation token; raises Unauthorized otherwise."""
+    try:
+        return jwt.decode(token, _secret(config), algorithms=['HS256'], audience=AUDIENCE,
+                          options={'require': ['jti', 'sub', 'survey', 'exp']})
+    except jwt.InvalidTokenError as e:
+        raise Unauthorized(f"Invalid invitation: {e}")
+
+
+def invitation_url(config, survey_id, token):
+    return config['INVITATION_URL'].format(survey_id=survey_id, token=token)
+
+
+class BloomFilter:
+    """Set of strings with no false negatives and about `error_rate` false positives up to `capacity` items.
+
+    A million ids at 0.1% take 1.8MB.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DenyList:
+    """Ids of the revoked, unexpired invitations of one database, polled into a Bloom filter."""
+
+    def __init__(self, capacity, error_rate, refresh_interval):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.bloom = None
+        self.since = None  # revocations from here on are loaded by the next refresh
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _revoked(connection, since):
+        criteria = [SurveyInvitation.revoked_at.isnot(None), SurveyInvitation.expires_at > datetime.utcnow()]
+        if since is not None:
+            criteria.append(SurveyInvitation.revoked_at >= since)
+        return connection.execute(select(SurveyInvitation.id).where(*criteria)).scalars().all()
+
+    def refresh(self, connection, force=False):
+        if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+                return  # another thread refreshed it meanwhile
+            started = datetime.utcnow()
+            # A revocation commits shortly after its revoked_at; overlapping the windows re-adds a few ids
+            since = None if self.bloom is None else self.since - timedelta(seconds=60)
+            ids = self._revoked(connection, since)
+            if self.bloom is None or self.bloom.count + len(ids) > self.bloom.capacity:
+                if since is not None:
+                    ids = self._revoked(connection, None)  # rebuilt from scratch, expired ones drop out
+                bloom = BloomFilter(max(self.capacity, 2 * len(ids)), self.error_rate)
+            else:
+                bloom = self.bloom
+            for invitation_id in ids:
+                bloom.add(invitation_id)
+            self.bloom, self.since, self._checked_at = bloom, started, time.monotonic()
+
+    def add(self, invitation_ids):
+        with self._lock:
+            if self.bloom is not None:
+                for invitation_id in invitation_ids:
+                    self.bloom.add(invitation_id)
+
+    def __contains__(self, invitation_id):
+        return self.bloom is not None and invitation_id in self.bloom
+
+
+def deny_list(tenant):
+    lists = current_app.extensions['invitation_deny_lists']
+    if tenant not in lists:
+        config = current_app.config
+        lists.setdefault(tenant, DenyList(config['INVITATION_DENYLIST_CAPACITY'], config['INVITATION_DENYLIST_ERROR_RATE'],
+                                          config['INVITATION_DENYLIST_REFRESH']))
+    return lists[tenant]
+
+
+def is_revoked(connection, tenant, invitation_id):
+    """Whether an invitation of `tenant`'s database (on `connection`) was revoked.
+
+    Reads the database only to refresh the deny list and for ids the filter contains.
+    """
+    revoked = deny_list(tenant)
+    revoked.refresh(connection)
+    if invitation_id not in revoked:
+        return False
+    return connection.execute(
+        select(SurveyInvitation.revoked_at).where(SurveyInvitation.id == invitation_id)).scalar() is not None
+
+
+def check_token(token, survey_id):
+    """Claims of an invitation token for `survey_id`, checked without the database."""
+    claims = read_token(current_app.config, token)
+    if claims['survey'] != survey_id:
+        raise Forbidden("This invitation is for another survey.")
+    return claims
+
+
+def invited_user(connection, tenant, token, survey_id):
+    """current_user of a request to `survey_id` with an invitation token; `connection` is on `tenant`'s database."""
+    claims = check_token(token, survey_id)
+    if is_revoked(connection, tenant, claims['jti']):
+        raise Forbidden("This invitation was revoked.")
+    return InvitedUser(claims['sub'], claims['jti'])
+
+
+def accept_invitation(connection, invitation_id, attempt_id):
+    """Mark the invitation accepted with `attempt_id`, in the submission's transaction."""
+    accepted = connection.execute(
+        update(SurveyInvitation)
+        .where(SurveyInvitation.id == invitation_id, SurveyInvitation.accepted_at.is_(None),
+               SurveyInvitation.revoked_at.is_(None))
+        .values(accepted_at=datetime.utcnow(), attempt_id=attempt_id)
+    ).rowcount
+    if not accepted:
+        raise Conflict("This invitation was already used or revoked.")
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def create_invitations(survey, user_ids, expires_at, email=False, created_by=None, on_batch=None):
+    """Invite `user_ids` (any iterable, read a batch at a time) to `survey`, in the current tenant.
+
+    Unknown users and users who already have a live invitation to the survey are skipped. Each
+    batch of INVITATION_BATCH_SIZE is written in one transaction, with its invitation emails when
+    `email` is set. `on_batch` gets [(invitation id, user id, token)] of each batch once committed.
+    Returns counts.
+    """
+    from app.util.mail_service import add_recipients, start_campaign, survey_context, user_recipients
+
+    config = current_app.config
+    tenant = current_tenant()
+    stats = {'invited': 0, 'skipped': 0, 'unknown': 0}
+    campaign = None
+    if email:
+        stats.update(campaign_id=None, emails_queued=0, suppressed=0, without_email=0)
+    for batch in _batches(user_ids, config['INVITATION_BATCH_SIZE']):
+        batch = list(dict.fromkeys(batch))  # repeats across batches find the invitation of the earlier one
+        known = set(db.session.execute(select(User.id).where(User.id.in_(batch))).scalars())
+        invited = set(db.session.execute(select(SurveyInvitation.user_id).where(
+            SurveyInvitation.survey_id == survey.id, SurveyInvitation.user_id.in_(batch),
+            SurveyInvitation.revoked_at.is_(None), SurveyInvitation.expires_at > datetime.utcnow())).scalars())
+        new = [user_id for user_id in batch if user_id in known and user_id not in invited]
+        stats['unknown'] += len(batch) - len(known)
+        stats['skipped'] += len(known & invited)
+        if not new:
+            continue
+        if tenant is not None:
+            sync_users(tenant, new)  # survey data references the tenant's replica of its users
+
+        now = datetime.utcnow()
+        rows = [{'id': uuid.uuid4().hex, 'survey_id': survey.id, 'user_id': user_id, 'created_at': now,
+                 'expires_at': expires_at} for user_id in new]
+        db.session.execute(insert(SurveyInvitation), rows)
+        issued = None
+        if email or on_batch is not None:
+            issued = [(row['id'], row['user_id'],
+                       issue_token(config, row['id'], survey.id, row['user_id'], tenant, expires_at)) for row in rows]
+        if email:
+            if campaign is None:
+                campaign = start_campaign('invitation', survey_context(survey), survey.id, created_by)
+                stats['campaign_id'] = campaign.id
+            recipients, without_email = user_recipients(
+                new, {user_id: {'link': invitation_url(config, survey.id, token)} for _, user_id, token in issued})
+            queued, blocked = add_recipients(campaign, recipients)
+            stats['emails_queued'] += queued
+            stats['suppressed'] += blocked
+            stats['without_email'] += without_email
+        db.session.commit()
+        stats['invited'] += len(rows)
+        if on_batch is not None:
+            on_batch(issued)
+    return stats
+
+
+def live_invitations(survey_id, batch_size=10000):
+    """Yield batches of (invitation id, user id, expires_at) of the survey's unrevoked, unexpired,
+    unaccepted invitations, to issue their tokens again."""
+    after = ''
+    while True:
+        rows = db.session.execute(
+            select(SurveyInvitation.id, SurveyInvitation.user_id, SurveyInvitation.expires_at)
+            .where(SurveyInvitation.survey_id == survey_id, SurveyInvitation.id > after,
+                   SurveyInvitation.revoked_at.is_(None), SurveyInvitation.accepted_at.is_(None),
+                   SurveyInvitation.expires_at > datetime.utcnow())
+            .order_by(SurveyInvitation.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1].id
+
+
+def revoke_invitations(survey_id, invitation_ids=None):
+    """Revoke the given unused invitations of the survey, or all of them; returns how many were revoked.
+
+    This worker rejects them at once, the others within INVITATION_DENYLIST_REFRESH seconds.
+    """
+    criteria = [SurveyInvitation.survey_id == survey_id, SurveyInvitation.revoked_at.is_(None),
+                SurveyInvitation.accepted_at.is_(None)]
+    if invitation_ids is not None:
+        criteria.append(SurveyInvitation.id.in_(invitation_ids))
+    revoked = db.session.execute(
+        update(SurveyInvitation).where(*criteria).values(revoked_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    revoked_list = deny_list(current_tenant())
+    if invitation_ids is not None:
+        revoked_list.add(invitation_ids)
+    else:
+        revoked_list.refresh(db.session.connection(bind_arguments={'mapper': SurveyInvitation}), force=True)
+    return revoked
+
+
+def invitation_stats(survey_id):
+    """Invitations of the survey: invited, accepted, revoked, expired and pending (still usable)."""
+    now = datetime.utcnow()
+    accepted = SurveyInvitation.accepted_at.isnot(None)
+    revoked = SurveyInvitation.revoked_at.isnot(None) & SurveyInvitation.accepted_at.is_(None)
+    expired = (SurveyInvitation.expires_at <= now) & SurveyInvitation.accepted_at.is_(None) \
+        & SurveyInvitation.revoked_at.is_(None)
+    row = db.session.execute(
+        select(func.count(SurveyInvitation.id),
+               func.sum(case((accepted, 1), else_=0)),
+               func.sum(case((revoked, 1), else_=0)),
+               func.sum(case((expired, 1), else_=0)))
+        .where(SurveyInvitation.survey_id == survey_id)
+    ).one()
+    invited, accepted, revoked, expired = (value or 0 for value in row)
+    return {'invited': invited, 'accepted': accepted, 'revoked': revoked, 'expired': expired,
+            'pending': invited - accepted - revoked - expired}
+
+
+def invitation_tenant(config, token):
+    """Tenant named by a valid invitation token, None for an invalid one (authentication rejects it later)."""
+    try:
+        tenant = jwt.decode(token, _secret(config), algorithms=['HS256'], audience=AUDIENCE).get('tenant')
+    except jwt.InvalidTokenError:
+        return None
+    if tenant is not None and tenant not in config['TENANT_DATABASES']:
+        raise ServiceUnavailable(f"The database of tenant {tenant!r} is not configured.")
+    return tenant
+
+
+def init_invitations(app):
+    """Give requests made with an invitation the tenant of the invitation; registered after init_tenancy."""
+    app.extensions['invitation_deny_lists'] = {}
+    if not app.config['TENANT_DATABASES']:
+        return
+
+    @app.before_request
+    def _set_invitation_tenant():
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme == SCHEME and token:
+            g.tenant = invitation_tenant(app.config, token)
@@ -0,0 +1,376 @@
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context, jsonify, request
+from sqlalchemy import case, delete, insert, inspect, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.decorator import verify_superadmin
+from app.extensions import db
+from app.model import JobRun, Otp, SchedulerLease
+from app.util.metrics import JOB_DURATION, JOB_LAST_SUCCESS
+from app.util.tenancy import each_tenant
+
+logger = logging.getLogger('spars.jobs')
+
+LEASE_NAME = 'scheduler'
+JOBSTORE_TABLE = 'apscheduler_jobs'
+_app = None  # app whose context jobs run in; spawned pool processes build their own
+_leader = None
+
+
+def cleanup():
+    """Delete expired OTPs, old job runs and old outgoing mail."""
+    from app.util.mail_service import prune_messages
+
+    config = current_app.config
+    otps = db.session.execute(delete(Otp).where(
+        Otp.expiration_time < datetime.utcnow() - timedelta(hours=config['OTP_RETENTION_HOURS']))).rowcount
+    runs = db.session.execute(delete(JobRun).where(
+        JobRun.started_at < datetime.utcnow() - timedelta(days=config['SCHEDULER_RUN_RETENTION_DAYS']))).rowcount
+    db.session.commit()
+    return {'otps': otps, 'job_runs': runs, 'mail_messages': prune_messages(config['MAIL_RETENTION_DAYS'])}
+
+
+def _dispatch_mail():
+    from app.util.mail_service import dispatch
+
+    return dispatch()  # the mail queue is in the default database
+
+
+# Survey data is per tenant database: the jobs below go through each of them in turn, returning
+# {tenant: result}. cleanup only touches the default database.
+
+def _archive():
+    from app.archive import archive_closed_surveys
+
+    return each_tenant(lambda: sum(archive_closed_surveys().values()))
+
+
+def _purge():
+    from app.purge import purge_deleted
+
+    return each_tenant(purge_deleted)
+
+
+def _rebuild_funnels():
+    from app.util.funnel import rebuild_funnels
+
+    return each_tenant(rebuild_funnels)
+
+
+def _dispatch_outbox():
+    from app.util.outbox import dispatch
+
+    return each_tenant(dispatch) if current_app.config['OUTBOX_WEBHOOKS'] else {}
+
+
+def _prune_outbox():
+    from app.util.outbox import prune_events
+
+    return each_tenant(lambda: prune_events(current_app.config['OUTBOX_RETENTION_DAYS']))
+
+
+# Job id -> (function, executor). CPU-heavy jobs run in the process pool so they neither hold the
+# GIL of the worker serving requests nor share its memory; schedules are in SCHEDULER_JOBS.
+JOBS = {
+    'cleanup': (cleanup, 'default'),
+    'outbox_dispatch': (_dispatch_outbox, 'default'),
+    'outbox_prune': (_prune_outbox, 'default'),
+    'mail_dispatch': (_dispatch_mail, 'default'),
+    'archive_closed_surveys': (_archive, 'processpool'),
+    'purge_deleted': (_purge, 'processpool'),
+    'funnel_rebuild': (_rebuild_funnels, 'processpool'),
+}
+
+
+def _job_app():
+    global _app
+    if _app is None:
+        from app import create_app
+
+        _app = create_app()
+    return _app
+
+
+def run_job(job_id):
+    """Run a registered job in an app context, recording it in job_run and the job metrics.
+
+    The scheduler stores a reference to this function, so it runs the same way in the leader's threads,
+    in pool processes and from `flask jobs run`. Returns the job's result.
+    """
+    function, _ = JOBS[job_id]
+    with (current_app._get_current_object() if has_app_context() else _job_app()).app_context():
+        started_at = datetime.utcnow()
+        run_id = db.session.execute(insert(JobRun).values(
+            job_id=job_id, status='running', host=f"{socket.gethostname()}:{os.getpid()}", started_at=started_at,
+        )).inserted_primary_key[0]
+        db.session.commit()
+
+        started = time.perf_counter()
+        result, error = None, None
+        try:
+            result = function()
+        except Exception:
+            db.session.rollback()
+            error = traceback.format_exc()
+            logger.exception('job failed', extra={'event': 'job', 'job': job_id})
+        duration = time.perf_counter() - started
+        status = 'failed' if error else 'success'
+
+        db.session.execute(update(JobRun).where(JobRun.id == run_id).values(
+            status=status, finished_at=datetime.utcnow(), duration_ms=round(duration * 1000, 2),
+            result=json.dumps(result, default=str), error=error,
+        ))
+        db.session.commit()
+        db.session.remove()
+        JOB_DURATION.labels(job=job_id, status=status).observe(duration)
+        if error is None:
+            JOB_LAST_SUCCESS.labels(job=job_id).set(time.time())
+        logger.info('job', extra={'event': 'job', 'job': job_id, 'status': status,
+                                  'duration_ms': round(duration * 1000, 2)})
+        return result
+
+
+def _trigger(schedule):
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    options = dict(schedule)
+    trigger = options.pop('trigger')
+    if trigger == 'interval':
+        return IntervalTrigger(timezone='UTC', **options)
+    if trigger == 'cron':
+        return CronTrigger(timezone='UTC', **options)
+    raise ValueError(f"Unknown trigger {trigger!r}, use interval or cron.")
+
+
+def _build_scheduler(app):
+    from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    config = app.config
+    return BackgroundScheduler(
+        jobstores={'default': SQLAlchemyJobStore(engine=db.engine, tablename=JOBSTORE_TABLE)},
+        executors={
+            'default': ThreadPoolExecutor(config['SCHEDULER_THREADS']),
+            # spawn, not fork: the leader is a multi-threaded server worker with open connections
+            'processpool': ProcessPoolExecutor(config['SCHEDULER_PROCESSES'],
+                                               pool_kwargs={'mp_context': multiprocessing.get_context('spawn')}),
+        },
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': config['SCHEDULER_MISFIRE_GRACE']},
+        timezone='UTC',
+    )
+
+
+def _sync_jobs(scheduler, schedules):
+    """Make the job store match SCHEDULER_JOBS.
+
+    Unchanged jobs keep their stored next run time, so a new leader neither reruns nor skips them;
+    runs missed while no leader was up are done once (coalesce) if within the misfire grace time.
+    """
+    for job in scheduler.get_jobs():
+        if job.id not in schedules:
+            scheduler.remove_job(job.id)
+    for job_id, schedule in schedules.items():
+        trigger = _trigger(schedule)
+        executor = JOBS[job_id][1]
+        job = scheduler.get_job(job_id)
+        if job is not None and str(job.trigger) == str(trigger) and job.executor == executor:
+            continue
+        scheduler.add_job(run_job, trigger, args=[job_id], id=job_id, name=job_id, executor=executor,
+                          replace_existing=True)
+
+
+class SchedulerLeader(threading.Thread):
+    """Competes for the leader lease and runs the scheduler while holding it.
+
+    Every server process runs one; the lease row makes exactly one of them the leader. The leader
+    renews it every third of the lease, and a process that dies stops renewing, so another takes
+    over within SCHEDULER_LEASE_SECONDS. Lease times come from each host's clock, which must agree
+    to within a few seconds.
+    """
+
+    def __init__(self, app):
+        super().__init__(name='spars-scheduler-leader', daemon=True)
+        self.app = app
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease = app.config['SCHEDULER_LEASE_SECONDS']
+        self.scheduler = None
+        self._stopped = threading.Event()
+
+    def _acquire(self):
+        """Take or renew the lease; returns whether this process holds it."""
+        now = datetime.utcnow()
+        values = {'holder': self.holder, 'expires_at': now + timedelta(seconds=self.lease)}
+        with db.engine.begin() as connection:
+            held = connection.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == LEASE_NAME,
+                       or_(SchedulerLease.holder == self.holder, SchedulerLease.expires_at < now))
+                .values(acquired_at=case((SchedulerLease.holder == self.holder, SchedulerLease.acquired_at), else_=now),
+                        **values)
+            ).rowcount
+            if held or connection.execute(select(SchedulerLease.name).where(SchedulerLease.name == LEASE_NAME)).first():
+                return bool(held)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(SchedulerLease).values(name=LEASE_NAME, acquired_at=now, **values))
+            return True
+        except IntegrityError:
+            return False  # another process inserted it first
+
+    def run(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    leader = self._acquire()
+                except Exception:
+                    logger.exception('scheduler lease check failed', extra={'event': 'scheduler'})
+                    leader = False
+                if leader and self.scheduler is None:
+                    self._start()
+                elif not leader and self.scheduler is not None:
+                    logger.warning('scheduler lease lost', extra={'event': 'scheduler', 'holder': self.holder})
+                    self._shutdown()
+                self._stopped.wait(self.lease / 3)
+            self._shutdown()
+            self._release()
+
+    def _start(self):
+        logger.info('scheduler leader', extra={'event': 'scheduler', 'holder': self.holder})
+        self.scheduler = _build_scheduler(self.app)
+        self.scheduler.start(paused=True)
+        _sync_jobs(self.scheduler, self.app.config['SCHEDULER_JOBS'])
+        self.scheduler.resume()
+
+    def _shutdown(self):
+        if self.scheduler is not None:
+            # Running jobs finish in the background; jobs are written to be safe to rerun
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+
+    def _release(self):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(delete(SchedulerLease).where(SchedulerLease.name == LEASE_NAME,
+                                                                SchedulerLease.holder == self.holder))
+        except Exception:
+            logger.exception('scheduler lease release failed', extra={'event': 'scheduler'})
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
+
+
+def start_scheduler(app):
+    """Start competing for scheduler leadership in this process; a no-op when SCHEDULER_ENABLED is off.
+
+    Called by gunicorn's post_worker_init hook and by `flask jobs worker`.
+    """
+    global _app, _leader
+    if not app.config['SCHEDULER_ENABLED'] or _leader is not None:
+        return _leader
+    _app = app
+    _leader = SchedulerLeader(app)
+    _leader.start()
+    return _leader
+
+
+def stop_scheduler(timeout=10):
+    """Stop the scheduler and hand the lease over right away instead of letting it expire."""
+    global _leader
+    if _leader is not None:
+        _leader.stop(timeout)
+        _leader = None
+
+
+def _stored_jobs():
+    """{job_id: APScheduler job} as last written by the leader; empty before the first leader ran."""
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+
+    if not inspect(db.engine).has_table(JOBSTORE_TABLE):
+        return {}
+    return {job.id: job for job in SQLAlchemyJobStore(engine=db.engine, tablename=JOBSTORE_TABLE).get_all_jobs()}
+
+
+def _run_dict(run):
+    return {
+        'id': run.id,
+        'status': run.status,
+        'host': run.host,
+        'started_at': run.started_at.isoformat(),
+        'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+        'duration_ms': run.duration_ms,
+        'result': json.loads(run.result) if run.result else None,
+        'error': run.error,
+    }
+
+
+def job_status():
+    """Leader, schedule, next run and last run of every job."""
+    lease = db.session.get(SchedulerLease, LEASE_NAME)
+    stored = _stored_jobs()
+    schedules = current_app.config['SCHEDULER_JOBS']
+    latest = select(JobRun.job_id, db.func.max(JobRun.id).label('id')).group_by(JobRun.job_id).subquery()
+    last_runs = {run.job_id: run for run in db.session.execute(
+        select(JobRun).join(latest, latest.c.id == JobRun.id)).scalars()}
+    jobs = []
+    for job_id, (_, executor) in JOBS.items():
+        job = stored.get(job_id)
+        jobs.append({
+            'id': job_id,
+            'executor': executor,
+            'schedule': str(job.trigger) if job is not None else None,
+            'next_run_at': job.next_run_time.isoformat() if job is not None and job.next_run_time else None,
+            'last_run': _run_dict(last_runs[job_id]) if job_id in last_runs else None,
+            'enabled': job_id in schedules,
+        })
+    return {
+        'leader': None if lease is None or lease.expires_at < datetime.utcnow() else {
+            'holder': lease.holder, 'acquired_at': lease.acquired_at.isoformat(),
+            'expires_at': lease.expires_at.isoformat()},
+        'jobs': jobs,
+    }
+
+
+@verify_superadmin
+def jobs_view():
+    """Scheduler leader and the state of every job."""
+    return jsonify(job_status())
+
+
+@verify_superadmin
+def job_runs_view(job_id):
+    """Most recent runs of one job, newest first."""
+    if job_id not in JOBS:
+        return jsonify({'error': f"Unknown job {job_id}."}), 404
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    runs = db.session.execute(
+        select(JobRun).where(JobRun.job_id == job_id).order_by(JobRun.started_at.desc(), JobRun.id.desc()).limit(limit)
+    ).scalars()
+    return jsonify([_run_dict(run) for run in runs])
+
+
+def init_jobs(app):
+    """Check SCHEDULER_JOBS and register the internal job status endpoints.
+
+    The scheduler itself is started per server process by start_scheduler, never in the gunicorn
+    master: its threads would not survive the fork.
+    """
+    for job_id, schedule in app.config['SCHEDULER_JOBS'].items():
+        if job_id not in JOBS:
+            raise ValueError(f"SCHEDULER_JOBS has unknown job {job_id!r}; known jobs: {', '.join(JOBS)}")
+        if schedule.get('trigger') not in ('interval', 'cron'):
+            raise ValueError(f"SCHEDULER_JOBS[{job_id!r}] needs trigger 'interval' or 'cron'.")
+    app.add_url_rule('/spars/jobs', 'jobs', jobs_view)
+    app.add_url_rule('/spars/jobs/<job_id>/runs', 'job_runs', job_runs_view)
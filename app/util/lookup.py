@@ -0,0 +1,283 @@
+"""Client for the external patient identity services (UHID, CDAC), see uhid_sevice.py and cdac_service.py.
+
+Lookups go over a pooled keep-alive HTTP session with timeouts, through a circuit breaker, and their
+results are cached per worker: records for LOOKUP_CACHE_TTL, "not found" for LOOKUP_NEGATIVE_TTL.
+Request handlers use `peek`, which answers from the cache at once and fetches the rest in the
+background, so a slow or failing service never holds up a request.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from flask import current_app
+
+from app.util.cache import TTLCache
+from app.util.metrics import LOOKUP_CACHE, LOOKUP_CIRCUIT_OPEN, LOOKUP_DURATION
+
+logger = logging.getLogger('spars.lookup')
+
+_NOT_FOUND = object()  # negative cache entry
+
+
+class LookupFailed(Exception):
+    """The service could not be reached or answered with an error."""
+
+
+class CircuitOpen(LookupFailed):
+    """The service failed repeatedly; calls are refused until the breaker lets a trial through."""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `reset_timeout` seconds one trial call is let
+    through (half-open), which closes the circuit on success and opens it again on failure."""
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+        LOOKUP_CIRCUIT_OPEN.labels(service=self.name).set(0)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._trial = False
+        if self.opened_at is not None:
+            LOOKUP_CIRCUIT_OPEN.labels(service=self.name).set(1)
+
+
+class LookupClient:
+    """Records of one service by key, singly (GET `path`) or in batches (POST `batch_path`).
+
+    The service answers GET <server><path> with the record or a 404, and POST <server><batch_path>
+    {"ids": [...]} with {<collection>: [records]}, leaving out unknown ids; records carry their key
+    in `key_field`.
+    """
+    name = None
+    path = None
+    batch_path = None
+    collection = None
+    key_field = None
+
+    def __init__(self, server, token, config):
+        self.server = server.rstrip('/')
+        self.token = token
+        self.timeout = tuple(config['LOOKUP_TIMEOUT'])
+        self.pool_size = config['LOOKUP_POOL_SIZE']
+        self.batch_size = config['LOOKUP_BATCH_SIZE']
+        self.found = TTLCache(config['LOOKUP_CACHE_SIZE'], config['LOOKUP_CACHE_TTL'])
+        self.missing = TTLCache(config['LOOKUP_CACHE_SIZE'], config['LOOKUP_NEGATIVE_TTL'])
+        self.breaker = CircuitBreaker(self.name, config['LOOKUP_BREAKER_THRESHOLD'], config['LOOKUP_BREAKER_RESET'])
+        self.prefetch_threads = config['LOOKUP_PREFETCH_THREADS']
+        self._session = None
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _http(self):
+        """requests.Session of this worker, created on first use so it is never shared across a fork."""
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept'] = 'application/json'
+            if self.token:
+                session.headers['Authorization'] = f"Bearer {self.token}"
+            self._session = session
+        return self._session
+
+    def _call(self, operation, method, url, not_found_ok=False, **kwargs):
+        """One request through the circuit breaker; returns the response (2xx, or 404 if `not_found_ok`)."""
+        import requests
+
+        if not self.breaker.allow():
+            LOOKUP_DURATION.labels(service=self.name, operation=operation, outcome='rejected').observe(0)
+            raise CircuitOpen(f"{self.name} lookups are suspended after repeated failures.")
+        started = time.perf_counter()
+        try:
+            response = self._http().request(method, url, timeout=self.timeout, **kwargs)
+            if response.status_code != 404 or not not_found_ok:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            self.breaker.failure()
+            outcome = 'timeout' if isinstance(e, requests.Timeout) else 'error'
+            LOOKUP_DURATION.labels(service=self.name, operation=operation, outcome=outcome).observe(
+                time.perf_counter() - started)
+            raise LookupFailed(f"{self.name} lookup failed: {type(e).__name__}: {e}") from e
+        self.breaker.success()
+        LOOKUP_DURATION.labels(service=self.name, operation=operation, outcome='ok').observe(
+            time.perf_counter() - started)
+        return response
+
+    def _cached(self, keys):
+        """({key: record or None} for cached keys, [keys to fetch])."""
+        results, misses, negative = {}, [], 0
+        for key in dict.fromkeys(keys):
+            record = self.found.get(key)
+            if record is None and self.missing.get(key) is not None:
+                record = _NOT_FOUND
+                negative += 1
+            if record is None:
+                misses.append(key)
+            else:
+                results[key] = None if record is _NOT_FOUND else record
+        LOOKUP_CACHE.labels(service=self.name, result='hit').inc(len(results) - negative)
+        LOOKUP_CACHE.labels(service=self.name, result='negative_hit').inc(negative)
+        LOOKUP_CACHE.labels(service=self.name, result='miss').inc(len(misses))
+        return results, misses
+
+    def _store(self, keys, records):
+        for key in keys:
+            record = records.get(key)
+            if record is None:
+                self.missing.set(key, _NOT_FOUND)
+            else:
+                self.found.set(key, record)
+                self.missing.delete(key)
+
+    def _fetch(self, keys):
+        try:
+            if len(keys) == 1:
+                response = self._call('get', 'GET', f"{self.server}{self.path.format(key=quote(keys[0], safe=''))}",
+                                      not_found_ok=True)
+                return {} if response.status_code == 404 else {keys[0]: response.json()}
+            response = self._call('batch', 'POST', f"{self.server}{self.batch_path}", json={'ids': keys})
+            wanted = set(keys)
+            return {str(record[self.key_field]): record for record in response.json().get(self.collection, [])
+                    if str(record.get(self.key_field)) in wanted}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise LookupFailed(f"{self.name} answered with an unexpected body: {type(e).__name__}: {e}") from e
+
+    def get_many(self, keys):
+        """Records of `keys`: {key: record, or None when the service does not know it}.
+
+        Misses are fetched in batches of LOOKUP_BATCH_SIZE. Raises LookupFailed (CircuitOpen while
+        the breaker is open) when the service fails; batches fetched before that stay cached.
+        """
+        results, misses = self._cached(str(key).strip() for key in keys)
+        for start in range(0, len(misses), self.batch_size):
+            chunk = misses[start:start + self.batch_size]
+            records = self._fetch(chunk)
+            self._store(chunk, records)
+            results.update((key, records.get(key)) for key in chunk)
+        return results
+
+    def get(self, key):
+        return self.get_many([key]).get(str(key).strip())
+
+    def peek(self, keys, then=None):
+        """Cached records of `keys`, without waiting for the service.
+
+        Returns {key: record or None} for the keys already looked up; the others are left out and
+        fetched in the background (unless the circuit is open), so a later call finds them. `then`
+        is called with the fetched records once they are in.
+        """
+        results, misses = self._cached(str(key).strip() for key in keys)
+        if misses and self.breaker.state != 'open':
+            with self._lock:
+                misses = [key for key in misses if key not in self._pending]
+                self._pending.update(misses)
+                if misses and self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.prefetch_threads, thread_name_prefix=f"{self.name}-lookup")
+            if misses:
+                self._executor.submit(self._prefetch, misses, then)
+        return results
+
+    def _prefetch(self, keys, then):
+        try:
+            records = self.get_many(keys)
+            if then is not None:
+                then(records)
+        except LookupFailed as e:
+            logger.warning('prefetch failed', extra={'event': 'lookup', 'service': self.name, 'error': str(e)})
+        finally:
+            with self._lock:
+                self._pending.difference_update(keys)
+
+    def status(self):
+        return {'server': self.server, 'circuit': self.breaker.state, 'consecutive_failures': self.breaker.failures,
+                'cached': len(self.found), 'cached_not_found': len(self.missing),
+                'pending': len(self._pending)}
+
+
+def lookup_client(name):
+    """The app's client for service `name` ('uhid' or 'cdac'); None when disabled or not configured."""
+    return current_app.extensions['lookup_clients'].get(name)
+
+
+def patient_records(mobiles):
+    """Patient records of respondents by mobile number, from cache only (see LookupClient.peek).
+
+    CDAC registrations map mobiles to UHIDs, and the UHID service has the patient details. Returns
+    {mobile: {'status': ..., 'uhid': ..., 'patient': ...}}, where status is found, not_found,
+    pending (being looked up, ask again) or unavailable (services disabled).
+    """
+    cdac, uhid = lookup_client('cdac'), lookup_client('uhid')
+    if cdac is None:
+        return {mobile: {'status': 'unavailable', 'uhid': None, 'patient': None} for mobile in mobiles}
+
+    def uhids_of(registrations):
+        return {mobile: str(record['uhid']) for mobile, record in registrations.items() if record and record.get('uhid')}
+
+    # Patients of registrations fetched in the background are prefetched right after them
+    registrations = cdac.peek(mobiles, then=(lambda fetched: uhid.peek(uhids_of(fetched).values())) if uhid else None)
+    uhids = uhids_of(registrations)
+    patients = uhid.peek(uhids.values()) if uhid is not None else {}
+
+    results = {}
+    for mobile in mobiles:
+        if mobile not in registrations:
+            results[mobile] = {'status': 'pending', 'uhid': None, 'patient': None}
+        elif mobile not in uhids:
+            results[mobile] = {'status': 'not_found', 'uhid': None, 'patient': None}
+        else:
+            number = uhids[mobile]
+            pending = uhid is not None and number not in patients
+            results[mobile] = {'status': 'pending' if pending else 'found', 'uhid': number,
+                               'patient': patients.get(number)}
+    return results
+
+
+def init_lookups(app):
+    """Create the clients of the enabled services that have a server configured."""
+    from app.util.cdac_service import CdacClient
+    from app.util.uhid_sevice import UhidClient
+
+    clients = {}
+    for name, client_class, enabled in (('uhid', UhidClient, 'UHID_SERVICE'), ('cdac', CdacClient, 'CDAC_SERVICE')):
+        server = app.config[f"{name.upper()}_SERVER"]
+        if app.config[enabled] and server:
+            clients[name] = client_class(server, app.config[f"{name.upper()}_TOKEN"], app.config)
+    app.extensions['lookup_clients'] = clients
@@ -0,0 +1,546 @@
+"""Bulk email: survey invitations and result summaries, queued in the database and sent over SMTP.
+
+A campaign's template (app/templates/mail/<name>.subject.txt, <name>.txt and optionally <name>.html)
+is rendered with Jinja once, with the campaign's context, and kept in a per-process cache together
+with its MIME layout; each message only substitutes its recipient's $variables into the result and
+encodes it. Messages wait in mail_message
+until `dispatch` claims a batch of them under a lease and sends it over a few persistent SMTP
+connections, at most MAIL_RATE_LIMIT a second. Temporary failures are retried with backoff;
+rejected recipients and reported bounces are recorded in mail_suppression.
+"""
+import base64
+import json
+import logging
+import os
+import random
+import smtplib
+import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.header import Header
+from email.utils import formataddr, formatdate, parseaddr
+from html import escape
+
+from flask import current_app
+from jinja2 import TemplateNotFound
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+
+from app.extensions import db
+from app.model import MailCampaign, MailMessage, MailSuppression, SurveyAttempt, User
+from app.util.cache import TTLCache
+from app.util.metrics import MAIL_SEND_DURATION, MAIL_SENT
+from app.util.tenancy import current_tenant
+
+logger = logging.getLogger('spars.mail')
+
+TEMPLATES = ('invitation', 'results_summary')
+STATUSES = ('queued', 'sent', 'failed', 'bounced')
+MESSAGE_HEADER = 'X-Spars-Message'  # id of the mail_message, to match bounce reports
+
+
+def _escape_dollars(value):
+    """Keep "$" in campaign values literal: they are rendered before the recipient's $variables."""
+    if isinstance(value, str):
+        return value.replace('$', '$$')
+    if isinstance(value, dict):
+        return {key: _escape_dollars(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_escape_dollars(item) for item in value]
+    return value
+
+
+def _header_value(value):
+    if value.isascii() and len(value) < 900:
+        return value
+    return Header(value, 'utf-8').encode(linesep='\r\n')
+
+
+def recipient_address(email):
+    """`email` as written in the envelope and the To header: (address, whether it needs SMTPUTF8).
+
+    The domain is IDNA-encoded; a non-ASCII local part can only be sent with SMTPUTF8. Raises
+    ValueError for what is not a single address, such as values with line breaks.
+    """
+    local, at, domain = email.rpartition('@')
+    if not at or not local or not domain or not email.isprintable() or any(char.isspace() for char in email):
+        raise ValueError(f"Invalid recipient address {email!r}")
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError as e:
+        raise ValueError(f"Invalid recipient domain {domain!r}: {e}")
+    return f"{local}@{domain}", not local.isascii()
+
+
+def _text_part(subtype, body):
+    encoded = base64.encodebytes(body.encode('utf-8')).decode('ascii').rstrip('\n').replace('\n', '\r\n')
+    return [f'Content-Type: text/{subtype}; charset="utf-8"', 'Content-Transfer-Encoding: base64', '', encoded]
+
+
+class CampaignTemplate:
+    """A template rendered with its campaign's context, waiting for the recipient's $variables.
+
+    Messages are put together from strings: building them with the email package costs about a
+    millisecond each, mostly parsing back the headers it was just given.
+    """
+
+    def __init__(self, subject, text, html):
+        self.subject = string.Template(subject)
+        self.text = string.Template(text)
+        self.html = string.Template(html) if html is not None else None
+        self.boundary = f"=_spars_{uuid.uuid4().hex}"  # "_" never occurs in base64 bodies
+
+    @classmethod
+    def render(cls, name, context):
+        env = current_app.jinja_env
+        context = _escape_dollars(context)
+        try:
+            html = env.get_template(f"mail/{name}.html").render(**context)
+        except TemplateNotFound:
+            html = None
+        return cls(env.get_template(f"mail/{name}.subject.txt").render(**context),
+                   env.get_template(f"mail/{name}.txt").render(**context), html)
+
+    def substitute(self, variables):
+        """(subject, text, html or None) for one recipient."""
+        # Header values must be one line, whatever the template or a recipient's name contains
+        return (' '.join(self.subject.safe_substitute(variables).split()), self.text.safe_substitute(variables),
+                self.html.safe_substitute({name: escape(str(value)) for name, value in variables.items()})
+                if self.html is not None else None)
+
+    def message(self, headers, variables, utf8=False):
+        """The complete message for one recipient, as bytes, below the given header lines.
+
+        Only header lines may contain non-ASCII characters, and only in a message sent with SMTPUTF8 (`utf8`).
+        """
+        subject, text, html = self.substitute(variables)
+        lines = headers + [f"Subject: {_header_value(subject)}", 'MIME-Version: 1.0']
+        if html is None:
+            lines += _text_part('plain', text)
+        else:
+            boundary = self.boundary
+            lines += [f'Content-Type: multipart/alternative; boundary="{boundary}"', '', f"--{boundary}",
+                      *_text_part('plain', text), f"--{boundary}", *_text_part('html', html), f"--{boundary}--", '']
+        return '\r\n'.join(lines).encode('utf-8' if utf8 else 'ascii')
+
+
+class Throttle:
+    """Spaces calls of all threads to at most `rate` a second; 0 for no limit."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SmtpPool:
+    """Persistent SMTP connections of this process, each used by one sending thread at a time."""
+
+    def __init__(self, config):
+        self.host = config['MAIL_SMTP_HOST']
+        self.port = config['MAIL_SMTP_PORT']
+        self.username = config['MAIL_SMTP_USERNAME']
+        self.password = config['MAIL_SMTP_PASSWORD']
+        self.starttls = config['MAIL_SMTP_STARTTLS']
+        self.timeout = config['MAIL_SMTP_TIMEOUT']
+        self.messages_per_connection = config['MAIL_MESSAGES_PER_CONNECTION']
+        self._idle = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.starttls and smtp.has_extn('starttls'):
+            smtp.starttls()
+            smtp.ehlo()
+        if self.username:
+            smtp.login(self.username, self.password)
+        smtp.spars_sent = 0
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def exhausted(self, smtp):
+        return smtp.spars_sent >= self.messages_per_connection
+
+    @contextmanager
+    def connection(self):
+        """An open connection; it goes back to the pool unless it failed or sent its share of messages."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle, self._pid = [], os.getpid()  # inherited across a fork, the parent owns those sockets
+            smtp = self._idle.pop() if self._idle else None
+        if smtp is not None:
+            try:
+                smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()  # the server timed the idle connection out
+                smtp = None
+        if smtp is None:
+            smtp = self._connect()
+        try:
+            yield smtp
+        except BaseException:
+            smtp.close()
+            raise
+        if self.exhausted(smtp):
+            self._close(smtp)
+        else:
+            with self._lock:
+                self._idle.append(smtp)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp in idle:
+            self._close(smtp)
+
+
+class Mailer:
+    """Per-process sending state: the SMTP pool, the throttle and the rendered campaign templates."""
+
+    def __init__(self, config):
+        self.pool = SmtpPool(config)
+        self.throttle = Throttle(config['MAIL_RATE_LIMIT'])
+        self.templates = TTLCache(config['MAIL_TEMPLATE_CACHE_SIZE'], config['MAIL_TEMPLATE_CACHE_TTL'])
+        self.connections = config['MAIL_SMTP_CONNECTIONS']
+        name, self.envelope_sender = parseaddr(config['MAIL_SENDER'])
+        self.sender = formataddr((name, self.envelope_sender), charset='utf-8')
+        self.domain = self.envelope_sender.partition('@')[2] or 'localhost'
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def campaign_templates(self, campaign_ids):
+        """{campaign id: CampaignTemplate}, rendering the campaigns not cached yet."""
+        templates = {campaign_id: self.templates.get(campaign_id) for campaign_id in set(campaign_ids)}
+        missing = [campaign_id for campaign_id, template in templates.items() if template is None]
+        if missing:
+            for campaign in db.session.execute(select(MailCampaign).where(MailCampaign.id.in_(missing))).scalars():
+                templates[campaign.id] = CampaignTemplate.render(campaign.template, json.loads(campaign.context))
+                self.templates.set(campaign.id, templates[campaign.id])
+        return templates
+
+    def build(self, template, message_id, recipient, variables):
+        """(id, envelope recipient, message bytes, MAIL options) of one queued message.
+
+        Raises ValueError if the recipient address cannot be sent to.
+        """
+        address, utf8 = recipient_address(recipient)
+        return message_id, address, template.message([
+            f"From: {self.sender}",
+            f"To: {address}",
+            f"Date: {formatdate(usegmt=True)}",
+            f"Message-ID: <{message_id}.{uuid.uuid4().hex}@{self.domain}>",
+            f"{MESSAGE_HEADER}: {message_id}",
+        ], variables, utf8), ('SMTPUTF8',) if utf8 else ()
+
+    def _send_share(self, messages):
+        """Send messages (see `build`) over pooled connections; returns {id: (outcome, error)}.
+
+        Outcomes: sent, bounced (recipient rejected for good), failed (message rejected for good) and
+        retry. A lost connection leaves the message in flight and the rest of the share to retry.
+        """
+        results = {}
+        pending = list(reversed(messages))
+        try:
+            while pending:
+                with self.pool.connection() as smtp:
+                    while pending and not self.pool.exhausted(smtp):
+                        message_id, recipient, message, mail_options = pending[-1]
+                        self.throttle.wait()
+                        started = time.perf_counter()
+                        try:
+                            smtp.sendmail(self.envelope_sender, [recipient], message, mail_options)
+                            results[message_id] = ('sent', None)
+                        except smtplib.SMTPNotSupportedError as e:
+                            results[message_id] = ('failed', str(e))  # SMTPUTF8, raised before anything is sent
+                        except smtplib.SMTPRecipientsRefused as e:
+                            code, reason = next(iter(e.recipients.values()))
+                            results[message_id] = _rejection('bounced', code, reason)
+                        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                            results[message_id] = _rejection('failed', e.smtp_code, e.smtp_error)
+                        MAIL_SEND_DURATION.observe(time.perf_counter() - started)
+                        smtp.spars_sent += 1
+                        pending.pop()
+        except (smtplib.SMTPException, OSError) as e:
+            error = f"{type(e).__name__}: {e}"
+            logger.warning('smtp connection failed', extra={'event': 'mail', 'error': error})
+            results.update((message_id, ('retry', error)) for message_id, *_ in pending)
+        return results
+
+    def send(self, messages):
+        """Send messages (see `build`) over up to MAIL_SMTP_CONNECTIONS connections in parallel."""
+        shares = [messages[index::self.connections] for index in range(self.connections)]
+        shares = [share for share in shares if share]
+        if len(shares) <= 1:
+            return self._send_share(messages)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.connections, thread_name_prefix='smtp')
+        results = {}
+        for share_results in self._executor.map(self._send_share, shares):
+            results.update(share_results)
+        return results
+
+
+def _rejection(permanent_outcome, code, reason):
+    if isinstance(reason, bytes):
+        reason = reason.decode('utf-8', 'replace')
+    return (permanent_outcome if 500 <= code < 600 else 'retry', f"{code} {reason}")
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+def suppressed(emails):
+    """The addresses among `emails` that get no more mail."""
+    emails = list(emails)
+    found = set()
+    for start in range(0, len(emails), 1000):
+        found.update(db.session.execute(select(MailSuppression.email).where(
+            MailSuppression.email.in_(emails[start:start + 1000]), MailSuppression.suppressed)).scalars())
+    return found
+
+
+def record_bounce(email, permanent, reason=None):
+    """Count a bounce of `email`: a hard one suppresses it, soft ones past MAIL_SOFT_BOUNCE_LIMIT too.
+
+    For rejections by our SMTP server and for bounce reports (DSNs) arriving later. The caller commits.
+    """
+    email = normalize_email(email)
+    entry = db.session.get(MailSuppression, email)
+    if entry is None:
+        entry = MailSuppression(email=email, soft_bounces=0, suppressed=False)
+        db.session.add(entry)
+    if not permanent:
+        entry.soft_bounces += 1
+    entry.suppressed = entry.suppressed or permanent or entry.soft_bounces >= current_app.config['MAIL_SOFT_BOUNCE_LIMIT']
+    entry.reason = reason
+    return entry
+
+
+def user_recipients(user_ids, variables=None, chunk_size=1000):
+    """(user id, email, $variables) of the users with an email, and the number of those without.
+
+    Every message has $first_name, $last_name and $email; `variables` adds more per user id.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    recipients = []
+    for start in range(0, len(user_ids), chunk_size):
+        for row in db.session.execute(
+                select(User.id, User.first_name, User.last_name, User.email)
+                .where(User.id.in_(user_ids[start:start + chunk_size]), User.email.isnot(None), User.email != '')):
+            recipients.append((row.id, row.email, dict(
+                (variables or {}).get(row.id, {}),
+                first_name=row.first_name or '', last_name=row.last_name or '', email=row.email)))
+    return recipients, len(user_ids) - len(recipients)
+
+
+def start_campaign(template, context, survey_id=None, created_by=None):
+    """A new campaign, flushed but not committed, to queue messages for with `add_recipients`."""
+    if template not in TEMPLATES:
+        raise ValueError(f"Unknown mail template {template!r}.")
+    campaign = MailCampaign(template=template, context=json.dumps(context), survey_id=survey_id,
+                            tenant_id=current_tenant(), created_by_user_id=created_by)
+    db.session.add(campaign)
+    db.session.flush()
+    return campaign
+
+
+def add_recipients(campaign, recipients, chunk_size=1000):
+    """Queue a message of `campaign` for each of `recipients`, [(user id, email, $variables)].
+
+    Each address gets one message; suppressed addresses get none. Does not commit. Returns
+    (messages queued, addresses suppressed).
+    """
+    by_email = {}
+    for user_id, email, variables in recipients:
+        by_email.setdefault(normalize_email(email), (user_id, variables))
+    blocked = suppressed(by_email)
+    now = datetime.utcnow()
+    rows = [{'campaign_id': campaign.id, 'user_id': user_id, 'recipient': email, 'variables': json.dumps(variables),
+             'status': 'queued', 'attempts': 0, 'created_at': now}
+            for email, (user_id, variables) in by_email.items() if email not in blocked]
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(insert(MailMessage), rows[start:start + chunk_size])
+    return len(rows), len(blocked)
+
+
+def create_campaign(template, recipients, context, survey_id=None, created_by=None):
+    """Queue `template` for `recipients` (see `add_recipients`) in one transaction.
+
+    Returns (campaign, messages queued, addresses suppressed).
+    """
+    campaign = start_campaign(template, context, survey_id, created_by)
+    queued, blocked = add_recipients(campaign, recipients)
+    db.session.commit()
+    return campaign, queued, blocked
+
+
+def survey_context(survey):
+    return {
+        'survey': {'id': survey.id, 'title': survey.title, 'description': survey.description or ''},
+        'url': current_app.config['MAIL_SURVEY_URL'].format(survey_id=survey.id),
+    }
+
+
+def queue_survey_mail(survey, template, user_ids=None, created_by=None):
+    """Queue an invitation to `survey`, or a summary of its results, for the given users.
+
+    Invitations link to the survey ($link; see app/util/invitations.py for links with a token).
+    Results summaries go to the survey's respondents unless `user_ids` are given, with their own
+    $attempts and $last_attempt. Returns the counts of create_campaign plus users without an email.
+    """
+    context = survey_context(survey)
+    variables = {}
+    if template == 'invitation':
+        variables = {user_id: {'link': context['url']} for user_id in user_ids or []}
+    elif template == 'results_summary':
+        rows = db.session.execute(
+            select(SurveyAttempt.user_id, func.count(SurveyAttempt.id), func.max(SurveyAttempt.attempt_date))
+            .where(SurveyAttempt.survey_id == survey.id).group_by(SurveyAttempt.user_id)).all()
+        variables = {user_id: {'attempts': count, 'last_attempt': last.strftime('%d %b %Y')}
+                     for user_id, count, last in rows}
+        context.update(respondents=len(rows), attempts=sum(count for _, count, _ in rows))
+        if user_ids is None:
+            user_ids = list(variables)
+        for user_id in user_ids:
+            variables.setdefault(user_id, {'attempts': 0, 'last_attempt': '-'})
+    recipients, without_email = user_recipients(user_ids or [], variables)
+    campaign, queued, blocked = create_campaign(template, recipients, context, survey.id, created_by)
+    return {'campaign_id': campaign.id, 'queued': queued, 'suppressed': blocked, 'without_email': without_email}
+
+
+def campaign_counts(campaign_ids):
+    """{campaign id: {status: messages}}."""
+    counts = {campaign_id: dict.fromkeys(STATUSES, 0) for campaign_id in campaign_ids}
+    for campaign_id, status, count in db.session.execute(
+            select(MailMessage.campaign_id, MailMessage.status, func.count(MailMessage.id))
+            .where(MailMessage.campaign_id.in_(campaign_ids))
+            .group_by(MailMessage.campaign_id, MailMessage.status)):
+        counts[campaign_id][status] = count
+    return counts
+
+
+def _claim(batch_size, lease_seconds):
+    """Lease up to `batch_size` due messages to this dispatcher; returns their rows."""
+    now = datetime.utcnow()
+    token = str(uuid.uuid4())
+    due = and_(MailMessage.status == 'queued',
+               or_(MailMessage.next_attempt_at.is_(None), MailMessage.next_attempt_at <= now),
+               or_(MailMessage.locked_until.is_(None), MailMessage.locked_until < now))
+    ids = db.session.execute(select(MailMessage.id).where(due).order_by(MailMessage.id).limit(batch_size)).scalars().all()
+    if not ids:
+        return []
+    # Another dispatcher may have taken some of them since the select; the update only takes the rest
+    db.session.execute(update(MailMessage).where(MailMessage.id.in_(ids), due)
+                       .values(claimed_by=token, locked_until=now + timedelta(seconds=lease_seconds)))
+    db.session.commit()
+    return db.session.execute(
+        select(MailMessage.id, MailMessage.campaign_id, MailMessage.recipient, MailMessage.variables,
+               MailMessage.attempts)
+        .where(MailMessage.claimed_by == token).order_by(MailMessage.id)).all()
+
+
+def _record(rows, results, config):
+    """Store the outcome of each claimed message and release it."""
+    now = datetime.utcnow()
+    updates, counts = [], {}
+    for row in rows:
+        outcome, error = results[row.id]
+        attempts = row.attempts + 1
+        next_attempt_at = None
+        if outcome == 'retry':
+            if attempts >= config['MAIL_MAX_ATTEMPTS']:
+                outcome = 'failed'
+            else:
+                delay = min(config['MAIL_RETRY_MAX_DELAY'], config['MAIL_RETRY_BASE_DELAY'] * 2 ** (attempts - 1))
+                next_attempt_at = now + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+        elif outcome == 'bounced' and error != 'suppressed':
+            record_bounce(row.recipient, True, error)
+        counts[outcome] = counts.get(outcome, 0) + 1
+        updates.append({'id': row.id, 'status': 'queued' if outcome == 'retry' else outcome, 'attempts': attempts,
+                        'next_attempt_at': next_attempt_at, 'last_error': error,
+                        'sent_at': now if outcome == 'sent' else None, 'locked_until': None})
+    db.session.execute(update(MailMessage), updates)
+    db.session.commit()
+    for outcome, count in counts.items():
+        MAIL_SENT.labels(outcome=outcome).inc(count)
+    return counts
+
+
+def dispatch(max_batches=50):
+    """Send due messages, a batch of MAIL_BATCH_SIZE at a time, until none are due or after `max_batches`.
+
+    Several dispatchers can run at once, each message is leased to one of them. Returns {outcome:
+    messages}; nothing is sent while MAIL_SMTP_HOST is unset.
+    """
+    config = current_app.config
+    if not config['MAIL_SERVICE'] or not config['MAIL_SMTP_HOST']:
+        return {}
+    mailer = current_app.extensions['mailer']
+    totals = {}
+    for _ in range(max_batches):
+        rows = _claim(config['MAIL_BATCH_SIZE'], config['MAIL_LEASE_SECONDS'])
+        if not rows:
+            break
+        # Addresses may have bounced since the messages were queued
+        blocked = suppressed(row.recipient for row in rows)
+        results = {row.id: ('bounced', 'suppressed') for row in rows if row.recipient in blocked}
+        templates = mailer.campaign_templates(row.campaign_id for row in rows)
+        messages = []
+        for row in rows:
+            if row.id in results:
+                continue
+            # A message that cannot be built fails on its own, the batch still goes out and is recorded
+            try:
+                messages.append(mailer.build(templates[row.campaign_id], row.id, row.recipient,
+                                             json.loads(row.variables)))
+            except Exception as e:
+                results[row.id] = ('failed', f"{type(e).__name__}: {e}")
+        results.update(mailer.send(messages))
+        counts = _record(rows, results, config)
+        for outcome, count in counts.items():
+            totals[outcome] = totals.get(outcome, 0) + count
+        # Stop when the server failed the whole batch rather than spend the attempts of the next ones
+        if len(rows) < config['MAIL_BATCH_SIZE'] or counts.get('retry') == len(rows):
+            break
+    return totals
+
+
+def prune_messages(retention_days, batch_size=5000):
+    """Delete sent, bounced and failed messages older than `retention_days`; returns how many."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        ids = db.session.execute(select(MailMessage.id).where(
+            MailMessage.status != 'queued', MailMessage.created_at < cutoff).limit(batch_size)).scalars().all()
+        if not ids:
+            return deleted
+        db.session.execute(delete(MailMessage).where(MailMessage.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+
+
+def init_mail(app):
+    app.extensions['mailer'] = Mailer(app.config)
@@ -0,0 +1,137 @@
+import os
+import time
+
+from flask import Response, abort, current_app, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+# Metrics are aggregated across gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set (see gunicorn_config.py).
+# Gauges use "livesum" so values of dead workers drop out of the total.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'spars_request_duration_seconds', 'Request latency per flask-restx resource',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'spars_requests_in_flight', 'Requests currently being handled', multiprocess_mode='livesum'
+)
+DB_POOL_CONNECTIONS = Gauge(
+    'spars_db_pool_connections', 'Open DBAPI connections held by connection pools', multiprocess_mode='livesum'
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'spars_db_pool_checked_out', 'Pooled connections currently checked out', multiprocess_mode='livesum'
+)
+OTP_SENT = Counter('spars_otp_sent_total', 'OTP messages sent', ['status'])
+SURVEY_ATTEMPTS_INGESTED = Counter('spars_survey_attempts_ingested_total', 'Survey attempts recorded')
+ANSWERS_INGESTED = Counter('spars_answers_ingested_total', 'Answers recorded')
+RATE_LIMITED = Counter('spars_rate_limited_total', 'Requests rejected by a rate limit', ['resource', 'scope'])
+SUBMISSIONS_REPLAYED = Counter(
+    'spars_answer_submissions_replayed_total', 'Duplicate submissions answered from an earlier attempt', ['source']
+)
+
+JOB_DURATION = Histogram(
+    'spars_job_duration_seconds', 'Background job run time', ['job', 'status'],
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+)
+JOB_LAST_SUCCESS = Gauge(
+    'spars_job_last_success_timestamp_seconds', 'When each background job last succeeded', ['job'],
+    multiprocess_mode='max'
+)
+LOOKUP_DURATION = Histogram(
+    'spars_lookup_duration_seconds', 'External identity service calls (UHID, CDAC)', ['service', 'operation', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+LOOKUP_CACHE = Counter('spars_lookup_cache_total', 'Identity lookups by cache result', ['service', 'result'])
+LOOKUP_CIRCUIT_OPEN = Gauge(
+    'spars_lookup_circuit_open', 'Whether the circuit breaker of an identity service is open', ['service'],
+    multiprocess_mode='max'
+)
+MAIL_SENT = Counter('spars_mail_messages_total', 'Queued emails by delivery outcome', ['outcome'])
+MAIL_SEND_DURATION = Histogram(
+    'spars_mail_send_duration_seconds', 'Time to hand one email to the SMTP server', buckets=LATENCY_BUCKETS
+)
+
+_pool_listeners_installed = False
+
+
+def _on_connect(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.inc()
+
+
+def _on_close(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.dec()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def _install_pool_listeners():
+    global _pool_listeners_installed
+    if _pool_listeners_installed:
+        return
+    event.listen(Pool, 'connect', _on_connect)
+    event.listen(Pool, 'close', _on_close)
+    event.listen(Pool, 'checkout', _on_checkout)
+    event.listen(Pool, 'checkin', _on_checkin)
+    _pool_listeners_installed = True
+
+
+def metrics_registry():
+    """Return a registry that merges every worker's values in multiprocess mode."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view():
+    """Expose metrics in the Prometheus text format."""
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """Register request metrics hooks and the internal /spars/metrics endpoint."""
+    if not app.config['METRICS_SERVICE']:
+        return
+    _install_pool_listeners()
+
+    @app.before_request
+    def start_metrics_timer():
+        g.metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.get('metrics_start')
+        if start is not None:
+            REQUEST_LATENCY.labels(
+                endpoint=request.endpoint or 'unmatched',
+                method=request.method,
+                status=response.status_code,
+            ).observe(time.perf_counter() - start)
+        return response
+
+    @app.teardown_request
+    def finish_metrics(exc):
+        if g.pop('metrics_start', None) is not None:
+            REQUESTS_IN_FLIGHT.dec()
+
+    if app.config['METRICS_REQUIRE_TOKEN'] and not app.config['METRICS_TOKEN']:
+        # Route traffic, database timings and lookup circuit states are not for the public
+        app.logger.warning("METRICS_TOKEN is not set, /spars/metrics is disabled.")
+        return
+    # Plain Flask route so the endpoint stays out of the public Swagger spec
+    app.add_url_rule('/spars/metrics', 'metrics', metrics_view)
@@ -0,0 +1,231 @@
+import hashlib
+import hmac
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, event, func, inspect, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.extensions import db
+from app.model import OutboxCursor, OutboxEvent, Survey
+from app.util.tenancy import current_tenant
+
+EVENT_TYPES = ('attempt.submitted', 'survey.published', 'survey.status_changed')
+SIGNATURE_HEADER = 'X-Spars-Signature'
+TIMESTAMP_HEADER = 'X-Spars-Timestamp'
+_requests_session = None
+
+
+def add_event(connection, event_type, survey_id, payload):
+    """Insert an outbox event on `connection`, so it commits or rolls back with the caller's change."""
+    connection.execute(insert(OutboxEvent).values(event_type=event_type, survey_id=survey_id,
+                                                  payload=json.dumps(payload), created_at=datetime.utcnow()))
+
+
+@event.listens_for(Session, 'before_flush')
+def _record_status_changes(session, flush_context, instances):
+    """Add an event for every survey whose status changes in this flush, whichever code changed it."""
+    for survey in session.dirty:
+        if not isinstance(survey, Survey):
+            continue
+        history = inspect(survey).attrs.status.history
+        if not history.deleted or survey.status == history.deleted[0]:
+            continue
+        session.add(OutboxEvent(
+            event_type='survey.published' if survey.status == 'release' else 'survey.status_changed',
+            survey_id=survey.id,
+            payload=json.dumps({'from': history.deleted[0], 'to': survey.status, 'title': survey.title}),
+        ))
+
+
+def _settled(rows, after, settle_seconds):
+    """Cut `rows` (ordered by id) at the first recent gap in the ids.
+
+    Ids are handed out at insert but become visible at commit, so a gap may be an event whose
+    transaction is still open; consumers must not move their cursor past it. A gap older than
+    `settle_seconds` is taken to be a rolled back or pruned event.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=settle_seconds)
+    expected = after + 1
+    for index, row in enumerate(rows):
+        if row.id != expected and row.created_at > cutoff:
+            return rows[:index]
+        expected = row.id + 1
+    return rows
+
+
+def events_after(after, limit, survey_id=None, event_types=None):
+    """Up to `limit` events with an id above `after`, oldest first, as dictionaries."""
+    criteria = [OutboxEvent.id > after]
+    if survey_id is not None:
+        criteria.append(OutboxEvent.survey_id == survey_id)
+    if event_types:
+        criteria.append(OutboxEvent.event_type.in_(event_types))
+    rows = db.session.execute(
+        select(OutboxEvent.id, OutboxEvent.event_type, OutboxEvent.survey_id, OutboxEvent.payload,
+               OutboxEvent.created_at)
+        .where(*criteria).order_by(OutboxEvent.id).limit(limit)
+    ).all()
+    # With filters, gaps are expected; only the unfiltered feed can tell an open transaction apart
+    if survey_id is None and not event_types:
+        rows = _settled(rows, after, current_app.config['OUTBOX_SETTLE_SECONDS'])
+    return [{
+        'id': row.id,
+        'type': row.event_type,
+        'survey_id': row.survey_id,
+        'created_at': row.created_at.isoformat(),
+        'data': json.loads(row.payload),
+    } for row in rows]
+
+
+def sign(secret, timestamp, body):
+    """HMAC-SHA256 of "<timestamp>.<body>", the value of the signature header."""
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def verify_signature(secret, headers, body, tolerance=300):
+    """Check a delivery's signature and that it is at most `tolerance` seconds old; for consumers and the stub."""
+    timestamp = headers.get(TIMESTAMP_HEADER, '')
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > tolerance:
+        return False
+    return hmac.compare_digest(sign(secret, timestamp, body), headers.get(SIGNATURE_HEADER, ''))
+
+
+def _http():
+    """Process-wide requests.Session, so deliveries reuse keep-alive connections to each consumer."""
+    global _requests_session
+    if _requests_session is None:
+        import requests
+
+        _requests_session = requests.Session()
+    return _requests_session
+
+
+def _claim(consumer, lease_seconds):
+    """Take the delivery lease of `consumer` if it is free and not backing off; returns its cursor or None."""
+    now = datetime.utcnow()
+    if db.session.get(OutboxCursor, consumer) is None:
+        try:
+            db.session.add(OutboxCursor(consumer=consumer, last_event_id=0, failures=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # another dispatcher created it first
+    claimed = db.session.execute(
+        update(OutboxCursor)
+        .where(OutboxCursor.consumer == consumer,
+               or_(OutboxCursor.locked_until.is_(None), OutboxCursor.locked_until < now),
+               or_(OutboxCursor.next_attempt_at.is_(None), OutboxCursor.next_attempt_at <= now))
+        .values(locked_until=now + timedelta(seconds=lease_seconds))
+    ).rowcount
+    db.session.commit()
+    return db.session.get(OutboxCursor, consumer, populate_existing=True) if claimed else None
+
+
+def _deliver(consumer, webhook, cursor, config):
+    """POST the next batch after the cursor to the webhook. Returns (events delivered, ok)."""
+    events = events_after(cursor.last_event_id, config['OUTBOX_BATCH_SIZE'])
+    if not events:
+        return 0, True
+
+    tenant = current_tenant()
+    body = json.dumps({'consumer': consumer, 'tenant': tenant, 'events': events}, separators=(',', ':')).encode()
+    timestamp = str(int(time.time()))
+    headers = {
+        'Content-Type': 'application/json',
+        TIMESTAMP_HEADER: timestamp,
+        SIGNATURE_HEADER: sign(webhook['secret'], timestamp, body),
+        'X-Spars-Delivery': f"{consumer}:{tenant + ':' if tenant else ''}{events[0]['id']}-{events[-1]['id']}",
+    }
+    import requests
+
+    try:
+        response = _http().post(webhook['url'], data=body, headers=headers, timeout=config['OUTBOX_TIMEOUT'])
+        error = None if 200 <= response.status_code < 300 else f"HTTP {response.status_code}: {response.text[:200]}"
+    except requests.RequestException as e:
+        error = f"{type(e).__name__}: {e}"
+
+    if error is None:
+        cursor.last_event_id = events[-1]['id']
+        cursor.failures = 0
+        cursor.next_attempt_at = None
+        cursor.last_error = None
+    else:
+        # Exponential backoff with jitter; the cursor stays, so the same events are retried in order
+        cursor.failures += 1
+        delay = min(config['OUTBOX_RETRY_MAX_DELAY'], config['OUTBOX_RETRY_BASE_DELAY'] * 2 ** (cursor.failures - 1))
+        cursor.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+        cursor.last_error = error
+    db.session.commit()
+    return (len(events), True) if error is None else (0, False)
+
+
+def dispatch(consumers=None, max_batches=100):
+    """Deliver pending events to the configured webhooks (or the named `consumers`).
+
+    Each consumer is served by one dispatcher at a time, under a lease on its cursor row, and gets its
+    events in id order, so a survey's events arrive in the order they were committed. A failed batch
+    is retried with backoff before anything newer is sent. Delivery is at least once: consumers
+    should skip event ids they already processed. Events and cursors are per tenant database (see
+    app/util/tenancy.py), so ids are unique per the "tenant" of the delivery, and this delivers the
+    current tenant's events. Returns {consumer: events delivered}.
+    """
+    config = current_app.config
+    webhooks = config['OUTBOX_WEBHOOKS']
+    delivered = {}
+    for consumer in consumers or webhooks:
+        cursor = _claim(consumer, config['OUTBOX_LEASE_SECONDS'])
+        if cursor is None:
+            continue
+        delivered[consumer] = 0
+        try:
+            for _ in range(max_batches):
+                count, ok = _deliver(consumer, webhooks[consumer], cursor, config)
+                delivered[consumer] += count
+                if not ok or count < config['OUTBOX_BATCH_SIZE']:
+                    break
+        finally:
+            cursor.locked_until = None
+            db.session.commit()
+    return delivered
+
+
+def prune_events(retention_days, batch_size=5000):
+    """Delete events older than `retention_days` that every webhook consumer has received.
+
+    The newest event is always kept, so ids keep growing on databases that reset the counter to
+    max(id) + 1 on restart. Returns the number of events deleted.
+    """
+    bound = db.session.execute(select(func.max(OutboxEvent.id))).scalar() or 0
+    consumers = list(current_app.config['OUTBOX_WEBHOOKS'])
+    if consumers:
+        positions = db.session.execute(
+            select(OutboxCursor.last_event_id).where(OutboxCursor.consumer.in_(consumers))).scalars().all()
+        # A consumer without a cursor has not received anything yet
+        bound = min(positions + [bound]) if len(positions) == len(consumers) else 0
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    deleted = 0
+    while True:
+        ids = db.session.execute(
+            select(OutboxEvent.id).where(OutboxEvent.id < bound, OutboxEvent.created_at < cutoff)
+            .order_by(OutboxEvent.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return deleted
+        db.session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+
+
+def init_outbox(app):
+    """Check the webhook configuration; importing this module registers the survey status listener."""
+    for consumer, webhook in app.config['OUTBOX_WEBHOOKS'].items():
+        if not isinstance(webhook, dict) or not webhook.get('url') or not webhook.get('secret'):
+            raise ValueError(f"OUTBOX_WEBHOOKS[{consumer!r}] needs a url and a secret.")
+        if len(consumer) > 50:
+            raise ValueError(f"OUTBOX_WEBHOOKS consumer name {consumer!r} is longer than 50 characters.")
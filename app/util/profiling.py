@@ -0,0 +1,214 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import abort, current_app, g, jsonify, request, send_from_directory
+
+from app.decorator import verify_superadmin
+
+PROFILE_HEADER = 'X-Spars-Profile'
+PROFILE_MODES = ('cpu', 'sample', 'alloc')
+
+# File extension of each downloadable artifact
+ARTIFACTS = {
+    'pstats': '.pstats',        # cProfile output, load with pstats/snakeviz
+    'collapsed': '.collapsed',  # folded stacks, feed to flamegraph.pl or speedscope
+    'alloc': '.alloc.txt',      # top allocation sites between request start and end
+    'snapshot': '.tracemalloc',  # raw tracemalloc snapshot, load with tracemalloc.Snapshot.load
+}
+
+# tracemalloc is process-wide, so one request at a time profiles allocations; others skip 'alloc'
+_alloc_lock = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+def _authorized():
+    """Run the verify_superadmin check; returns None when allowed, the error response otherwise."""
+    return verify_superadmin(lambda: None)()
+
+
+def _profile_dir():
+    return current_app.config['PROFILING_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+
+
+def _prune(directory, keep):
+    metadata = sorted((name for name in os.listdir(directory) if name.endswith('.json')),
+                      key=lambda name: os.path.getmtime(os.path.join(directory, name)))
+    for name in metadata[:-keep] if keep else metadata:
+        profile_id = name[:-len('.json')]
+        for suffix in ('.json',) + tuple(ARTIFACTS.values()):
+            try:
+                os.remove(os.path.join(directory, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def start_profiling():
+    modes = {mode.strip() for mode in request.headers.get(PROFILE_HEADER, '').split(',') if mode.strip()}
+    if not modes:
+        return None
+    unknown = modes.difference(PROFILE_MODES)
+    if unknown:
+        return {"error": f"Unknown profile mode(s): {', '.join(sorted(unknown))}"}, 400
+    denied = _authorized()
+    if denied is not None:
+        return denied
+
+    state = {'modes': modes, 'start': time.perf_counter(), 'skipped': []}
+    if 'alloc' in modes and not _alloc_lock.acquire(blocking=False):
+        state['skipped'].append('alloc')
+    elif 'alloc' in modes:
+        state['started_tracemalloc'] = not tracemalloc.is_tracing()
+        if state['started_tracemalloc']:
+            tracemalloc.start(current_app.config['PROFILING_TRACEMALLOC_FRAMES'])
+        state['alloc_before'] = tracemalloc.take_snapshot()
+    if 'sample' in modes:
+        state['sampler'] = StackSampler(threading.get_ident(), current_app.config['PROFILING_SAMPLE_INTERVAL'])
+        state['sampler'].start()
+    if 'cpu' in modes:
+        state['cpu'] = cProfile.Profile()
+        state['cpu'].enable()
+    g.profiling = state
+    return None
+
+
+def _stop_alloc(state):
+    if state.pop('started_tracemalloc', False):
+        tracemalloc.stop()
+    _alloc_lock.release()
+
+
+def abandon_profiling(exc):
+    """Stop the profilers of a request that ended without finish_profiling."""
+    state = g.pop('profiling', None)
+    if state is None:
+        return
+    if 'cpu' in state:
+        state['cpu'].disable()
+    if 'sampler' in state:
+        state['sampler'].stop()
+    if 'alloc_before' in state:
+        _stop_alloc(state)
+
+
+def finish_profiling(response):
+    state = g.pop('profiling', None)
+    if state is None:
+        return response
+
+    if 'cpu' in state:
+        state['cpu'].disable()
+    if 'sampler' in state:
+        state['sampler'].stop()
+    duration = time.perf_counter() - state['start']
+    # Snapshot before writing any artifact so the dumps below are not counted as request allocations
+    after = tracemalloc.take_snapshot() if 'alloc_before' in state else None
+
+    directory = _profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    base = os.path.join(directory, profile_id)
+    artifacts = []
+
+    if 'cpu' in state:
+        state['cpu'].dump_stats(base + ARTIFACTS['pstats'])
+        artifacts.append('pstats')
+    if 'sampler' in state:
+        with open(base + ARTIFACTS['collapsed'], 'w') as fh:
+            fh.write(state['sampler'].collapsed())
+        artifacts.append('collapsed')
+    if after is not None:
+        _stop_alloc(state)
+        top = after.compare_to(state['alloc_before'], 'lineno')[:current_app.config['PROFILING_ALLOC_TOP']]
+        with open(base + ARTIFACTS['alloc'], 'w') as fh:
+            fh.write(''.join(f"{stat}\n" for stat in top))
+        after.dump(base + ARTIFACTS['snapshot'])
+        artifacts.extend(['alloc', 'snapshot'])
+
+    with open(base + '.json', 'w') as fh:
+        json.dump({
+            'id': profile_id,
+            'created_at': datetime.utcnow().isoformat(),
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else request.path,
+            'path': request.full_path,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+            'modes': sorted(state['modes']),
+            'skipped': state['skipped'],
+            'artifacts': artifacts,
+        }, fh)
+    _prune(directory, current_app.config['PROFILING_MAX_PROFILES'])
+
+    response.headers['X-Spars-Profile-Id'] = profile_id
+    return response
+
+
+@verify_superadmin
+def list_profiles():
+    """List stored profiles, newest first."""
+    directory = _profile_dir()
+    if not os.path.isdir(directory):
+        return jsonify([])
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name)) as fh:
+                profiles.append(json.load(fh))
+    profiles.sort(key=lambda profile: profile['created_at'], reverse=True)
+    return jsonify(profiles)
+
+
+@verify_superadmin
+def download_profile(profile_id, artifact):
+    """Download one artifact of a stored profile."""
+    if artifact not in ARTIFACTS:
+        abort(404)
+    return send_from_directory(_profile_dir(), profile_id + ARTIFACTS[artifact], as_attachment=True)
+
+
+def init_profiling(app):
+    """Register on-demand request profiling; nothing is hooked in when PROFILING_ENABLED is off."""
+    if not app.config['PROFILING_ENABLED']:
+        return
+
+    app.before_request(start_profiling)
+    app.after_request(finish_profiling)
+    app.teardown_request(abandon_profiling)
+    app.add_url_rule('/spars/profiles', 'list_profiles', list_profiles)
+    app.add_url_rule('/spars/profiles/<profile_id>/<artifact>', 'download_profile', download_profile)
@@ -0,0 +1,154 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from app.util.metrics import RATE_LIMITED
+
+# One bucket per slot: key fingerprint, tokens left, time of the last refill
+_SLOT = struct.Struct('<Qdd')
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(spec):
+    """"5/minute" -> (capacity, tokens per second); the bucket starts full, so the capacity is also the burst."""
+    count, _, period = spec.partition('/')
+    count = int(count)
+    if count < 1 or period not in _PERIODS:
+        raise ValueError(f"Invalid rate limit {spec!r}, expected e.g. '5/minute'")
+    return count, count / _PERIODS[period]
+
+
+class SharedBuckets:
+    """Token buckets in a memory-mapped file shared by every worker on the host.
+
+    The file is a direct-mapped table of fixed-size slots. A take locks only its slot with an
+    fcntl byte-range lock (across processes) and a striped thread lock (fcntl locks are held per
+    process, not per thread). Two keys hashing to the same slot share a bucket until one of them
+    overwrites it, so the table should be much larger than the number of active keys.
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._map = None
+        self._pid = None
+        self._open_lock = threading.Lock()
+        self._thread_locks = [threading.Lock() for _ in range(64)]
+
+    def _open(self):
+        # Reopen after fork so the child has its own descriptor and mapping
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+            size = self.slots * _SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)  # new pages read as zeros, i.e. empty slots
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self._fd = fd
+            self._pid = os.getpid()
+
+    @contextmanager
+    def _slot(self, key):
+        """Lock the slot of `key`; yields (fingerprint of the key, byte offset of the slot)."""
+        if self._pid != os.getpid():
+            self._open()
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        slot = digest % self.slots
+        offset = slot * _SLOT.size
+        with self._thread_locks[slot % len(self._thread_locks)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _SLOT.size, offset)
+            try:
+                yield digest, offset
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _SLOT.size, offset)
+
+    def take(self, key, capacity, rate, now=None):
+        """Take one token from the bucket of `key`; returns 0 if allowed, else seconds until a token is free."""
+        with self._slot(key) as (digest, offset):
+            now = time.time() if now is None else now
+            fingerprint, tokens, updated = _SLOT.unpack_from(self._map, offset)
+            if fingerprint != digest:
+                tokens, updated = capacity, now
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            if tokens >= 1:
+                _SLOT.pack_into(self._map, offset, digest, tokens - 1, now)
+                return 0
+            _SLOT.pack_into(self._map, offset, digest, tokens, now)
+            return (1 - tokens) / rate
+
+    def refund(self, key, capacity):
+        """Give back a token taken from the bucket of `key`, unless another key took over the slot meanwhile."""
+        with self._slot(key) as (digest, offset):
+            fingerprint, tokens, updated = _SLOT.unpack_from(self._map, offset)
+            if fingerprint == digest:
+                _SLOT.pack_into(self._map, offset, digest, min(capacity, tokens + 1), updated)
+
+
+class RateLimiter:
+    """Applies the limits configured per resource in RATELIMIT_LIMITS."""
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = {
+            resource: {scope: parse_limit(spec) for scope, spec in scopes.items()}
+            for resource, scopes in limits.items()
+        }
+
+    def check(self, resource, identities):
+        """Take a token for each configured scope of `resource`.
+
+        `identities` maps a scope ('mobile', 'user', 'ip') to the caller's value; scopes without a
+        value are skipped. Returns None if allowed, else the Retry-After value in whole seconds. A
+        rejected request gives back the tokens it took from the other scopes.
+        """
+        taken = []
+        for scope, (capacity, rate) in self.limits.get(resource, {}).items():
+            identity = identities.get(scope)
+            if identity is None:
+                continue
+            key = f"{resource}:{scope}:{identity}"
+            wait = self.buckets.take(key, capacity, rate)
+            if wait:
+                for taken_key, taken_capacity in taken:
+                    self.buckets.refund(taken_key, taken_capacity)
+                RATE_LIMITED.labels(resource=resource, scope=scope).inc()
+                return max(1, math.ceil(wait))
+            taken.append((key, capacity))
+        return None
+
+
+def client_address(remote_addr, forwarded_for, trusted_hops):
+    """The client's address as ProxyFix(x_for=trusted_hops) sets request.remote_addr, for the ASGI handlers."""
+    if trusted_hops:
+        hops = [hop.strip() for hop in (forwarded_for or '').split(',') if hop.strip()]
+        if len(hops) >= trusted_hops:
+            return hops[-trusted_hops]
+    return remote_addr
+
+
+def too_many_requests(retry_after):
+    return {"message": "Too many requests, please try again later."}, 429, {'Retry-After': str(retry_after)}
+
+
+def init_rate_limiting(app):
+    """Build the limiter; the shared file is opened lazily in each worker."""
+    if not app.config['RATELIMIT_ENABLED']:
+        return
+    path = app.config['RATELIMIT_STORAGE_PATH'] or os.path.join(
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'spars_ratelimit'
+    )
+    app.extensions['rate_limiter'] = RateLimiter(
+        SharedBuckets(path, app.config['RATELIMIT_SLOTS']), app.config['RATELIMIT_LIMITS']
+    )
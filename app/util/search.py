@@ -0,0 +1,213 @@
+import re
+
+from flask import current_app
+from sqlalchemy import Float, Integer, and_, case, event, literal, literal_column, or_, select, table, text, union_all
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import BadRequest, NotImplemented as NotImplementedHTTP
+
+from app.extensions import db
+from app.model import Answer, Question, Survey, SurveyAttempt, survey_editors
+
+SURVEY, QUESTION, ANSWER = 1, 2, 3
+KINDS = {'survey': SURVEY, 'question': QUESTION, 'answer': ANSWER}
+KIND_NAMES = {value: name for name, value in KINDS.items()}
+MAX_TERMS = 8
+# A term is a run of word characters; a trailing * makes it a prefix query
+_TERM = re.compile(r'(\w+)(\*?)')
+
+
+def parse_query(query):
+    """Split a user query into (term, is_prefix) pairs; every term must match."""
+    terms = _TERM.findall(query or '')
+    if not terms:
+        raise BadRequest("q must contain at least one word.")
+    if len(terms) > MAX_TERMS:
+        raise BadRequest(f"q can have at most {MAX_TERMS} words.")
+    return [(term.lower(), bool(star)) for term, star in terms]
+
+
+def _column(row, name):
+    return name if name == 'NULL' else f"{row}.{name}"
+
+
+class Fts5Backend:
+    """SQLite: one contentless FTS5 table over all three sources, kept in sync by triggers.
+
+    The FTS rowid encodes the source row as id * 4 + kind, so triggers and result lookups never
+    scan the index. Contentless means the text is not stored twice; deletes hand the old values
+    back to FTS5, which is why the index must always mirror the tables (soft-deleted rows included).
+    """
+    name = 'fts5'
+    # Survey titles and question texts go to the title column, which ranks higher than body
+    TITLE_WEIGHT = 4.0
+    SOURCES = (
+        # kind, table, title column, body column
+        (SURVEY, 'survey', 'title', 'description'),
+        (QUESTION, 'question', 'text', 'NULL'),
+        (ANSWER, 'answer', 'NULL', 'answer_text'),
+    )
+
+    def install(self, connection):
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "title, body, content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+        )
+        for kind, source, title, body in self.SOURCES:
+            # Answers of choice questions have no text and stay out of the index
+            new_row, old_row = (
+                (f"{row}.id * 4 + {kind}, {_column(row, title)}, {_column(row, body)}",
+                 f"{row}.answer_text IS NOT NULL" if kind == ANSWER else '1')
+                for row in ('new', 'old')
+            )
+            add = f"INSERT INTO search_index(rowid, title, body) SELECT {new_row[0]} WHERE {new_row[1]};"
+            remove = (f"INSERT INTO search_index(search_index, rowid, title, body) "
+                      f"SELECT 'delete', {old_row[0]} WHERE {old_row[1]};")
+            watched = ', '.join(name for name in (title, body) if name != 'NULL')
+            connection.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS search_{source}_ai AFTER INSERT ON {source} BEGIN {add} END")
+            connection.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS search_{source}_ad AFTER DELETE ON {source} BEGIN {remove} END")
+            connection.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS search_{source}_au AFTER UPDATE OF {watched} ON {source} "
+                f"BEGIN {remove} {add} END")
+
+    def drop(self, connection):
+        for _, source, _, _ in self.SOURCES:
+            for suffix in ('ai', 'ad', 'au'):
+                connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS search_{source}_{suffix}")
+        connection.exec_driver_sql("DROP TABLE IF EXISTS search_index")
+
+    def rebuild(self, connection):
+        self.drop(connection)
+        self.install(connection)
+        for kind, source, title, body in self.SOURCES:
+            connection.exec_driver_sql(
+                f"INSERT INTO search_index(rowid, title, body) SELECT id * 4 + {kind}, {title}, {body} FROM {source}"
+                + (" WHERE answer_text IS NOT NULL" if kind == ANSWER else "")
+            )
+        connection.exec_driver_sql("INSERT INTO search_index(search_index) VALUES ('optimize')")
+
+    def matches(self, terms, kinds):
+        query = ' '.join(f'"{term}"' + ('*' if prefix else '') for term, prefix in terms)
+        kind = literal_column('search_index.rowid % 4', Integer)
+        return (
+            select(kind.label('kind'), literal_column('search_index.rowid / 4', Integer).label('ref_id'),
+                   literal_column(f'-bm25(search_index, {self.TITLE_WEIGHT}, 1.0)', Float).label('score'))
+            .select_from(table('search_index'))
+            .where(text('search_index MATCH :search_query').bindparams(search_query=query), kind.in_(kinds))
+        )
+
+
+class FulltextBackend:
+    """MySQL: InnoDB FULLTEXT indexes on the searched columns (see the ft_* indexes in app/model.py).
+
+    InnoDB maintains them on every write. Terms shorter than innodb_ft_min_token_size (3) and
+    stopwords are not indexed, so a query made only of those finds nothing.
+    """
+    name = 'fulltext'
+    INDEXES = ((Survey, 'ft_survey_text'), (Question, 'ft_question_text'), (Answer, 'ft_answer_text'))
+
+    def install(self, connection):
+        for model, name in self.INDEXES:
+            self._index(model, name).create(connection, checkfirst=True)
+
+    def drop(self, connection):
+        for model, name in self.INDEXES:
+            self._index(model, name).drop(connection, checkfirst=True)
+
+    @staticmethod
+    def _index(model, name):
+        return next(index for index in model.__table__.indexes if index.name == name)
+
+    def rebuild(self, connection):
+        self.install(connection)
+        for model, _ in self.INDEXES:
+            # With innodb_optimize_fulltext_only=ON this merges the FULLTEXT index instead of the table
+            connection.exec_driver_sql(f"OPTIMIZE TABLE {model.__tablename__}")
+
+    def matches(self, terms, kinds):
+        query = ' '.join('+' + term + ('*' if prefix else '') for term, prefix in terms)
+        sources = {
+            SURVEY: (Survey.id, match(Survey.title, Survey.description, against=query)),
+            QUESTION: (Question.id, match(Question.text, against=query)),
+            ANSWER: (Answer.id, match(Answer.answer_text, against=query)),
+        }
+        return union_all(*(
+            select(literal(kind).label('kind'), ref_id.label('ref_id'), relevance.in_boolean_mode().label('score'))
+            .where(relevance.in_boolean_mode())
+            for kind, (ref_id, relevance) in sources.items() if kind in kinds
+        ))
+
+
+BACKENDS = {'sqlite': Fts5Backend, 'mysql': FulltextBackend, 'mariadb': FulltextBackend}
+
+
+def backend_for(dialect_name):
+    backend = BACKENDS.get(dialect_name)
+    return backend() if backend else None
+
+
+@event.listens_for(Answer.__table__, 'after_create')
+def _install_index(target, connection, **kw):
+    # The answer table is created after survey and question, so every trigger target exists by now
+    if connection.dialect.name == 'sqlite':
+        Fts5Backend().install(connection)
+
+
+@event.listens_for(Answer.__table__, 'before_drop')
+def _drop_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        Fts5Backend().drop(connection)
+
+
+def search(query, kinds, user_id=None, survey_id=None, page=1, per_page=20):
+    """Ranked matches of `query` over live surveys, questions and answers.
+
+    Answers are only returned when `user_id` wrote them or created or edits their survey;
+    pass user_id=None to search all of them. Returns (rows, has_more).
+    """
+    backend = current_app.extensions['search']
+    if backend is None:
+        raise NotImplementedHTTP("Search is not available on this database.")
+    terms = parse_query(query)
+    matches = backend.matches(terms, kinds).subquery()
+    is_survey = matches.c.kind == SURVEY
+    statement = (
+        select(matches.c.kind, matches.c.ref_id, matches.c.score, Survey.id.label('survey_id'),
+               Question.id.label('question_id'),
+               case((is_survey, Survey.title), (matches.c.kind == QUESTION, Question.text),
+                    else_=Answer.answer_text).label('text'))
+        .select_from(matches)
+        # Soft-deleted, archived or purged sources drop out of these joins
+        .outerjoin(Answer, and_(matches.c.kind == ANSWER, Answer.id == matches.c.ref_id))
+        .outerjoin(Question, and_(~is_survey, Question.id == case((matches.c.kind == QUESTION, matches.c.ref_id),
+                                                                   else_=Answer.question_id)))
+        .join(Survey, Survey.id == case((is_survey, matches.c.ref_id), else_=Question.survey_id))
+        .where(or_(is_survey, Question.id.isnot(None)))
+        .order_by(matches.c.score.desc(), matches.c.kind, matches.c.ref_id)
+        .limit(per_page + 1).offset((page - 1) * per_page)
+    )
+    if survey_id is not None:
+        statement = statement.where(Survey.id == survey_id)
+    if user_id is not None and ANSWER in kinds:
+        statement = statement.where(or_(
+            matches.c.kind != ANSWER,
+            Survey.created_by_user_id == user_id,
+            Survey.id.in_(select(survey_editors.c.survey_id).where(survey_editors.c.user_id == user_id)),
+            Answer.attempt_id.in_(select(SurveyAttempt.id).where(SurveyAttempt.user_id == user_id)),
+        ))
+
+    rows = db.session.execute(statement).all()
+    return [{
+        'kind': KIND_NAMES[row.kind],
+        'id': row.ref_id,
+        'survey_id': row.survey_id,
+        'question_id': row.question_id,
+        'text': row.text,
+        'score': round(row.score, 4),
+    } for row in rows[:per_page]], len(rows) > per_page
+
+
+def init_search(app):
+    app.extensions['search'] = backend_for(make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name())
@@ -2,46 +2,114 @@
 
 
 from flask import current_app as app
-import requests
+from werkzeug.exceptions import BadRequest
 
-def send_sms(mobile,message):
-	# Data for the POST request
+from app.util.metrics import OTP_SENT
 
-	data = {
-		'username': app.config.get('OTP_USERNAME'),
-		'password': app.config.get('OTP_PASSWORD'),
-		'senderid': app.config.get('OTP_SENDERID'),
-		'mobileNos': mobile,
-		'message': f'{message}',
-		'templateid1': app.config.get('OTP_ID')
-	}
 
-	# Headers for the POST request
-	headers = {
-		'Content-Type': 'application/x-www-form-urlencoded'
-	}
+def send_sms(mobile, message):
+    # Data for the POST request
+    data = {
+        'username': app.config.get('OTP_USERNAME'),
+        'password': app.config.get('OTP_PASSWORD'),
+        'senderid': app.config.get('OTP_SENDERID'),
+        'mobileNos': mobile,
+        'message': f'{message}',
+        'templateid1': app.config.get('OTP_ID')
+    }
 
-	# URL of the service
-	url = app.config.get("OTP_SERVER")
-	app.logger.info(url)
-	app.logger.info(f'username : {app.config.get("OTP_USERNAME")}')
-	app.logger.info(f'password : {app.config.get("OTP_PASSWORD")}')
-	app.logger.info(f'senderid : {app.config.get("OTP_SENDERID")}')
-	app.logger.info(f'templateid1 : {app.config.get("OTP_ID")}')
+    # Headers for the POST request
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
 
-	# Send the POST request
-	response = requests.post(url, data=data, headers=headers)
+    # URL of the service
+    url = app.config.get("OTP_SERVER")
+    app.logger.info(url)
 
-	# Return the response from the SMS service
-	return response.status_code
+    # Send the POST request (requests is imported here to keep it out of worker boot)
+    import requests
+    try:
+        response = requests.post(url, data=data, headers=headers, timeout=app.config['OTP_SERVER_TIMEOUT'])
+    except requests.RequestException as e:
+        app.logger.warning(f"SMS service unavailable: {e}")
+        return 503
+
+    # Return the response from the SMS service
+    return response.status_code
+
+
+def sms_enabled(config):
+    """SMS go out with SMS_SERVICE on and an OTP_SERVER set; otherwise OTPs are only logged."""
+    return config['SMS_SERVICE'] and bool(config['OTP_SERVER'])
+
+
+def otp_request_mobile(data):
+    """Mobile number of a RequestOtp body."""
+    if not isinstance(data, dict) or 'mobile' not in data:
+        raise BadRequest("Mobile number is required.")
+    return data['mobile']
+
+
+def otp_response(status):
+    """Response (body, status) of an OTP request once the SMS service answered `status`."""
+    OTP_SENT.labels(status='sent' if status == 200 else 'failed').inc()
+    if status == 200:
+        return {"message": "OTP sent successfully."}, 200
+    return {"message": "Something went wrong, please try after some time."}, 400
 
 
 def send_otp(mobile, otp_value):
-    """ Placeholder function to send OTP via SMS or Email """
-    # If you want to use email:
+    """Send the OTP by SMS; returns the SMS service's status code, 200 when only logged."""
     msg = f"Your OTP is {otp_value}"
-    app.logger.info(msg)
-    # If you want to use SMS, you can integrate with Twilio or any other SMS API
-    # send_sms(user.mobile, otp_value)
-    return 200
+    if not sms_enabled(app.config):
+        app.logger.info(msg)
+        return 200
     return send_sms(mobile, msg)
+
+
+_async_client = None
+
+
+def get_async_client():
+    """Shared httpx.AsyncClient so async SMS sends reuse pooled keep-alive connections."""
+    global _async_client
+    if _async_client is None:
+        import httpx
+        _async_client = httpx.AsyncClient(timeout=app.config['OTP_SERVER_TIMEOUT'])
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def send_sms_async(mobile, message):
+    """Async counterpart of send_sms for the ASGI entry point."""
+    data = {
+        'username': app.config.get('OTP_USERNAME'),
+        'password': app.config.get('OTP_PASSWORD'),
+        'senderid': app.config.get('OTP_SENDERID'),
+        'mobileNos': mobile,
+        'message': f'{message}',
+        'templateid1': app.config.get('OTP_ID')
+    }
+    import httpx
+    try:
+        response = await get_async_client().post(app.config.get("OTP_SERVER"), data=data)
+    except httpx.HTTPError as e:
+        app.logger.warning(f"SMS service unavailable: {e}")
+        return 503
+    return response.status_code
+
+
+async def send_otp_async(mobile, otp_value):
+    """Async counterpart of send_otp."""
+    msg = f"Your OTP is {otp_value}"
+    if not sms_enabled(app.config):
+        app.logger.info(msg)
+        return 200
+    return await send_sms_async(mobile, msg)
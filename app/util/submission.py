@@ -0,0 +1,77 @@
+"""Answer submission, shared by SurveyAnswersResource.post and the ASGI fast path (app/asgi.py).
+
+Every step runs on a Core connection: the ORM session's under Flask, an async engine's through
+`AsyncConnection.run_sync` under ASGI. The entry points only differ in how they authenticate the
+caller and manage the transaction.
+"""
+from sqlalchemy import select
+from werkzeug.exceptions import Forbidden, NotFound
+
+from app.model import Role, Survey, SurveyAttempt, user_roles
+from app.util.idempotency import find_attempt, remember_attempt, replay_result
+from app.util.invitations import InvitedUser, accept_invitation
+from app.util.metrics import ANSWERS_INGESTED, SUBMISSIONS_REPLAYED, SURVEY_ATTEMPTS_INGESTED
+
+SURVEY_TESTER_ROLES = {'TESTER', 'ADMIN', 'SUPERADMIN'}  # Role names that may answer surveys in testing
+
+
+def role_names(connection, user_id):
+    """Names of the user's roles; run it on the default database, tenant replicas only have the users."""
+    return set(connection.execute(
+        select(Role.name).join(user_roles, user_roles.c.role_id == Role.id).where(user_roles.c.user_id == user_id)
+    ).scalars())
+
+
+def submission_survey(connection, survey_id):
+    """(id, status) of the survey to answer."""
+    survey = connection.execute(
+        select(Survey.id, Survey.status).where(Survey.id == survey_id, Survey.is_deleted == False)
+    ).first()
+    if survey is None:
+        raise NotFound("Survey not found.")
+    return survey
+
+
+def validate_survey_submission_permission(survey, current_user, roles=()):
+    """Check if the user can submit answers in the survey's state.
+
+    While testing only users with a role in SURVEY_TESTER_ROLES answer; once released everyone can.
+    For an invited user the invitation is the permission, so only a closed survey is refused.
+    """
+    if survey.status == "testing" and not isinstance(current_user, InvitedUser) and not SURVEY_TESTER_ROLES & set(roles):
+        raise Forbidden("Only testers can submit answers for surveys in the testing phase.")
+    if survey.status == "close":
+        raise Forbidden("This survey is closed and cannot accept responses.")
+
+
+def replayed_submission(connection, cache, user_id, key, survey_id, source='lookup'):
+    """Body of the submission already recorded with idempotency `key`, None if there is none."""
+    if key is None:
+        return None
+    attempt = find_attempt(connection, cache, user_id, key)
+    if attempt is None:
+        return None
+    SUBMISSIONS_REPLAYED.labels(source=source).inc()
+    return replay_result(attempt, survey_id)
+
+
+def record_submission(connection, survey_id, current_user, answers, key):
+    """Record the attempt, and accept the invitation it was made with; returns (attempt_id, answers_count)."""
+    attempt_id, answers_count = SurveyAttempt.record(connection, survey_id, current_user.id, answers,
+                                                     idempotency_key=key)
+    if isinstance(current_user, InvitedUser):
+        accept_invitation(connection, current_user.invitation_id, attempt_id)
+    return attempt_id, answers_count
+
+
+def submitted(cache, user_id, key, survey_id, attempt_id, answers_count):
+    """Body of a committed submission; remembers its key for retries and counts it."""
+    if key is not None:
+        remember_attempt(cache, user_id, key, survey_id, attempt_id, answers_count)
+    SURVEY_ATTEMPTS_INGESTED.inc()
+    ANSWERS_INGESTED.inc(answers_count)
+    return {
+        "message": "Answers submitted successfully",
+        "attempt_id": attempt_id,
+        "answers_count": answers_count
+    }
@@ -0,0 +1,234 @@
+"""Tenant sharding: each tenant's surveys, attempts and answers live in a database (or schema) of its own.
+
+Tenants are configured in TENANT_DATABASES and become Flask-SQLAlchemy binds named "tenant:<name>".
+A request works on the tenant of the "tenant" claim of its JWT; CLI commands on SPARS_TENANT, and
+code covering several tenants on `tenant_scope`, `each_tenant` or `fan_out`. The session routes
+every statement touching a table outside GLOBAL_TABLES to the current tenant's bind. Users stay in
+the default database; each shard keeps a replica of its tenant's users for foreign keys and the
+survey editor joins, refreshed when users are created or changed and by `flask tenants sync-users`.
+Schemas are migrated with alembic (migrations/), each tenant database with `flask tenants upgrade`.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
+import jwt
+from flask import current_app, g, has_app_context, jsonify, request
+from sqlalchemy import bindparam, func, insert, inspect, select, update
+from sqlalchemy.sql.util import find_tables
+from werkzeug.exceptions import BadRequest, Forbidden, ServiceUnavailable
+
+from app.decorator import verify_superadmin
+from app.extensions import db
+from app.model import Answer, ArchivedAnswer, Survey, SurveyAttempt, User
+
+GLOBAL_TABLES = frozenset({'user', 'role', 'user_roles', 'otp', 'job_run', 'scheduler_lease', 'apscheduler_jobs',
+                           'mail_campaign', 'mail_message', 'mail_suppression'})
+TENANT_HEADER = 'X-Spars-Tenant'
+DEFAULT = 'default'  # the default database, in fan-out results and the tenant header
+_TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,49}$')
+
+
+def bind_key(tenant):
+    return None if tenant is None else f"tenant:{tenant}"
+
+
+def tenants():
+    return list(current_app.config['TENANT_DATABASES'])
+
+
+def current_tenant():
+    """Tenant the current app context works on; None for the default database."""
+    if not has_app_context():
+        return None
+    if 'tenant' in g:
+        return g.tenant
+    return current_app.config['DEFAULT_TENANT']
+
+
+def engine_for(tenant):
+    """Engine of `tenant`'s database, the default engine for None."""
+    return db.engine if tenant is None else db.engines[bind_key(tenant)]
+
+
+def tenant_engine():
+    """Engine of the current tenant, for Core work outside the session."""
+    return engine_for(current_tenant())
+
+
+@lru_cache(maxsize=None)
+def _is_tenant_mapper(mapper):
+    table = getattr(inspect(mapper), 'local_table', None)
+    return table is not None and table.name not in GLOBAL_TABLES
+
+
+def tenant_bind(sqlalchemy, mapper, clause):
+    """Engine for a statement of the session (TenantSession.get_bind), None to use the default one.
+
+    Statements on a tenant entity, or joining a tenant table to a global one, go to the tenant's bind.
+    So does `session.connection()` without a mapper, which SurveyAttempt.record and the funnel run on.
+    """
+    tenant = current_tenant()
+    if tenant is None:
+        return None
+    engine = sqlalchemy.engines[bind_key(tenant)]
+    if mapper is not None and _is_tenant_mapper(mapper):
+        return engine
+    if clause is None:
+        return engine if mapper is None else None
+    tables = find_tables(clause, check_columns=True, include_crud=True)
+    if not tables or any(table.name not in GLOBAL_TABLES for table in tables):
+        return engine  # text() and the like, without tables, are taken to be on tenant data
+    return None
+
+
+@contextmanager
+def tenant_scope(tenant, app=None):
+    """Work on `tenant` (None: the default database) in an app context, and so a session, of its own."""
+    with (app or current_app._get_current_object()).app_context():
+        g.tenant = tenant
+        yield
+
+
+def _label(tenant):
+    return DEFAULT if tenant is None else tenant
+
+
+def each_tenant(fn):
+    """Run `fn` for the default database and every tenant, one after the other: {tenant: result}."""
+    results = {}
+    for tenant in [None] + tenants():
+        with tenant_scope(tenant):
+            results[_label(tenant)] = fn()
+    return results
+
+
+def fan_out(fn, only=None):
+    """Run `fn` for the default database and every tenant (or the `only` ones) in parallel threads.
+
+    Each call gets its own app context and session. Returns {tenant: result}; the first error raised
+    by any tenant is raised once all of them finished.
+    """
+    app = current_app._get_current_object()
+    targets = [None] + tenants() if only is None else list(only)
+
+    def run(tenant):
+        with tenant_scope(tenant, app):
+            return fn()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(targets), app.config['TENANT_FANOUT_THREADS']))) as pool:
+        futures = [(tenant, pool.submit(run, tenant)) for tenant in targets]
+    return {_label(tenant): future.result() for tenant, future in futures}
+
+
+def shard_tables():
+    """Tables each tenant database has: the tenant tables and the replica of the users."""
+    return [table for table in db.metadata.sorted_tables if table.name not in GLOBAL_TABLES or table.name == 'user']
+
+
+def sync_users(tenant, user_ids=None, chunk_size=1000):
+    """Copy the users of `tenant` (or the given `user_ids`) from the default database into its replica.
+
+    Existing replica rows are updated rather than replaced, as survey data references them. Returns
+    the number of users copied.
+    """
+    table = User.__table__
+    criteria = [table.c.tenant_id == tenant] if user_ids is None else [table.c.id.in_(user_ids)]
+    changes = {column.key: bindparam(f"new_{column.key}") for column in table.columns if column.key != 'id'}
+    copied = 0
+    with db.engine.connect() as source, engine_for(tenant).begin() as target:
+        result = source.execution_options(stream_results=True).execute(select(table).where(*criteria))
+        for partition in result.mappings().partitions(chunk_size):
+            rows = [dict(row) for row in partition]
+            existing = set(target.execute(
+                select(table.c.id).where(table.c.id.in_([row['id'] for row in rows]))).scalars())
+            updates = [dict({f"new_{key}": value for key, value in row.items()}, user_id=row['id'])
+                       for row in rows if row['id'] in existing]
+            if updates:
+                target.execute(update(table).where(table.c.id == bindparam('user_id')).values(changes), updates)
+            inserts = [row for row in rows if row['id'] not in existing]
+            if inserts:
+                target.execute(insert(table), inserts)
+            copied += len(rows)
+    return copied
+
+
+def replicate_users(user_ids):
+    """Refresh users in their tenants' replicas after they were created or changed; users without a tenant have none."""
+    databases = current_app.config['TENANT_DATABASES']
+    if not databases or not user_ids:
+        return
+    by_tenant = {}
+    for tenant, user_id in db.session.execute(
+            select(User.tenant_id, User.id).where(User.id.in_(user_ids), User.tenant_id.in_(databases))):
+        by_tenant.setdefault(tenant, []).append(user_id)
+    for tenant, ids in by_tenant.items():
+        sync_users(tenant, ids)
+
+
+def tenant_stats():
+    """Users, surveys, attempts and answers of the current tenant (or the default database)."""
+    tenant = current_tenant()
+    return {
+        'users': db.session.execute(select(func.count(User.id)).where(User.tenant_id == tenant)).scalar(),
+        'surveys': db.session.execute(select(func.count(Survey.id))).scalar(),
+        'attempts': db.session.execute(select(func.count(SurveyAttempt.id))).scalar(),
+        'answers': db.session.execute(select(func.count(Answer.id))).scalar(),
+        'archived_answers': db.session.execute(select(func.count(ArchivedAnswer.id))).scalar(),
+    }
+
+
+def merge_counts(results):
+    """Sum per-tenant dictionaries of counts."""
+    total = {}
+    for counts in results.values():
+        for name, value in counts.items():
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def request_tenant(config, token, requested=None):
+    """Tenant of a request with bearer `token`: its "tenant" claim, or the `requested` one (the tenant
+    header) for superadmins. An invalid token counts as none; authentication rejects it later."""
+    try:
+        claims = jwt.decode(token, config['SECRET_KEY'], algorithms=["HS256"]) if token else {}
+    except jwt.InvalidTokenError:
+        claims = {}
+    tenant = claims.get('tenant')
+    if requested:
+        if 'superadmin' not in claims.get('roles', ()):
+            raise Forbidden(f"Only superadmins can choose the tenant with {TENANT_HEADER}.")
+        tenant = None if requested == DEFAULT else requested
+        if tenant is not None and tenant not in config['TENANT_DATABASES']:
+            raise BadRequest(f"Unknown tenant {requested!r}.")
+    if tenant is not None and tenant not in config['TENANT_DATABASES']:
+        raise ServiceUnavailable(f"The database of tenant {tenant!r} is not configured.")
+    return tenant
+
+
+@verify_superadmin
+def tenants_view():
+    results = fan_out(tenant_stats)
+    return jsonify({'tenants': results, 'total': merge_counts(results)})
+
+
+def init_tenancy(app):
+    """Check the tenant configuration and resolve the tenant of every request before its handler runs."""
+    for tenant in app.config['TENANT_DATABASES']:
+        if tenant == DEFAULT or not _TENANT_NAME.match(tenant):
+            raise ValueError(f"Invalid tenant name {tenant!r}: use up to 50 lowercase letters, digits, - and _,"
+                             f" other than {DEFAULT!r}.")
+    default_tenant = app.config['DEFAULT_TENANT']
+    if default_tenant is not None and default_tenant not in app.config['TENANT_DATABASES']:
+        raise ValueError(f"SPARS_TENANT={default_tenant!r} is not in TENANT_DATABASES.")
+
+    app.add_url_rule('/spars/tenants', 'tenants', tenants_view)
+    if not app.config['TENANT_DATABASES']:
+        return  # everything is in the default database
+
+    @app.before_request
+    def _set_tenant():
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        g.tenant = request_tenant(app.config, token if scheme == 'Bearer' else None,
+                                  request.headers.get(TENANT_HEADER))
@@ -0,0 +1,26 @@
+from app.util.lookup import LookupClient, lookup_client
+
+
+class UhidClient(LookupClient):
+    """Patient details by UHID (hospital registration number).
+
+    GET /patients/<uhid> returns {"uhid": ..., "name": ..., "gender": ..., "age": ..., ...} or a 404;
+    POST /patients/_batch {"ids": [uhids]} returns {"patients": [...]} without the unknown ones.
+    """
+    name = 'uhid'
+    path = '/patients/{key}'
+    batch_path = '/patients/_batch'
+    collection = 'patients'
+    key_field = 'uhid'
+
+
+def get_patient(uhid):
+    """Patient record of `uhid`, None when unknown or the service is disabled; raises LookupFailed."""
+    client = lookup_client('uhid')
+    return client.get(uhid) if client is not None else None
+
+
+def get_patients(uhids):
+    """{uhid: record or None} in batches; empty when the service is disabled; raises LookupFailed."""
+    client = lookup_client('uhid')
+    return client.get_many(uhids) if client is not None else {}
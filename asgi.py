@@ -0,0 +1,5 @@
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
+
+# uvicorn asgi:app --host 127.0.0.1 --port 5015 --workers 4
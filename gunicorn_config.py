@@ -1,2 +1,180 @@
-bind = '127.0.0.1:5015'
-worker = 4
+"""Gunicorn settings built from a serving profile.
+
+Pick a profile with SPARS_SERVING_PROFILE (sync, gthread or gevent; default sync) and override
+individual values with the GUNICORN_* variables below. Settings are validated when gunicorn loads
+this file, so a bad value stops the master instead of silently falling back to a default.
+
+    SPARS_SERVING_PROFILE=gthread gunicorn -c gunicorn_config.py flask_app:app
+
+Benchmark: seed with `flask bench seed --users 200 --surveys 3 --questions 20 --attempts 500 --logins 200`,
+start the server with a profile, then run
+`python loadgen.py --dataset bench_dataset.json --vus 16 --duration 15 --out bench_<profile>.json`
+and compare reports with `flask bench compare`. Results on a 1-CPU VM with SQLite (loadgen on the same
+host), median / p95 latency:
+
+    profile   workers x threads   flows/s   fetch survey p50/p95   submit answers p50/p95
+    sync      3 x 1               5.4       568 / 1202 ms          346 / 1119 ms
+    gthread   2 x 4               4.4       598 / 1349 ms          321 / 1135 ms
+    gevent    1 x 1000 greenlets  3.9       556 / 1710 ms          851 / 2383 ms
+
+Survey fetch is CPU-bound (marshmallow serialization), so sync workers win when CPUs are scarce;
+gthread and gevent pay off once requests spend most of their time waiting on MySQL or the SMS gateway.
+"""
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+# Defaults per worker model. Workers and threads are derived from the CPU count:
+#   sync    - one request per process; 2 * CPU + 1 processes keep the CPUs busy while some wait on I/O
+#   gthread - CPU + 1 processes with a thread pool each; threads wait on DB/SMS I/O while others run
+#   gevent  - one process per CPU with greenlets; best for many slow, I/O-bound connections
+PROFILES = {
+    'sync': {
+        'worker_class': 'sync',
+        'workers': 2 * CPU_COUNT + 1,
+        'threads': 1,
+        'keepalive': 2,  # ignored by sync workers, which close the connection after each request
+    },
+    'gthread': {
+        'worker_class': 'gthread',
+        'workers': CPU_COUNT + 1,
+        'threads': 4,
+        'keepalive': 5,
+    },
+    'gevent': {
+        'worker_class': 'gevent',
+        'workers': CPU_COUNT,
+        'threads': 1,
+        'worker_connections': 1000,
+        'keepalive': 5,
+    },
+}
+
+
+def _env_int(name, default, minimum=1):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise RuntimeError(f"{name} must be an integer, got {value!r}")
+    if number < minimum:
+        raise RuntimeError(f"{name} must be >= {minimum}, got {number}")
+    return number
+
+
+def load_profile(name):
+    """Resolve and validate the settings of a serving profile."""
+    if name not in PROFILES:
+        raise RuntimeError(f"Unknown SPARS_SERVING_PROFILE {name!r}; choose one of {', '.join(PROFILES)}")
+    profile = dict(PROFILES[name])
+    if profile['worker_class'] == 'gevent':
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            raise RuntimeError("The gevent profile needs the gevent package installed")
+
+    profile['workers'] = _env_int('GUNICORN_WORKERS', profile['workers'])
+    profile['threads'] = _env_int('GUNICORN_THREADS', profile['threads'])
+    if 'worker_connections' in profile:
+        profile['worker_connections'] = _env_int('GUNICORN_WORKER_CONNECTIONS', profile['worker_connections'])
+    profile['keepalive'] = _env_int('GUNICORN_KEEPALIVE', profile['keepalive'])
+    # Recycle workers to bound slow memory growth; jitter keeps them from all restarting at once
+    profile['max_requests'] = _env_int('GUNICORN_MAX_REQUESTS', 2000, minimum=0)
+    profile['max_requests_jitter'] = _env_int('GUNICORN_MAX_REQUESTS_JITTER', profile['max_requests'] // 10, minimum=0)
+    profile['timeout'] = _env_int('GUNICORN_TIMEOUT', 30)
+    profile['graceful_timeout'] = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+
+    if profile['threads'] > 1 and profile['worker_class'] == 'sync':
+        # gunicorn silently switches sync workers with threads to gthread; make that explicit instead
+        raise RuntimeError("GUNICORN_THREADS > 1 needs the gthread profile")
+    if profile['max_requests'] and profile['max_requests_jitter'] >= profile['max_requests']:
+        raise RuntimeError("GUNICORN_MAX_REQUESTS_JITTER must be smaller than GUNICORN_MAX_REQUESTS")
+    if profile['graceful_timeout'] > profile['timeout']:
+        raise RuntimeError("GUNICORN_GRACEFUL_TIMEOUT must not exceed GUNICORN_TIMEOUT")
+    return profile
+
+
+SERVING_PROFILE = os.getenv('SPARS_SERVING_PROFILE', 'sync')
+_profile = load_profile(SERVING_PROFILE)
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:5015')
+worker_class = _profile['worker_class']
+workers = _profile['workers']
+threads = _profile['threads']
+keepalive = _profile['keepalive']
+max_requests = _profile['max_requests']
+max_requests_jitter = _profile['max_requests_jitter']
+timeout = _profile['timeout']
+graceful_timeout = _profile['graceful_timeout']
+if 'worker_connections' in _profile:
+    worker_connections = _profile['worker_connections']
+# Worker heartbeat files on tmpfs so a slow disk cannot make healthy workers look stuck
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+if worker_class == 'gevent':
+    # Patch before the preloaded app imports socket/threading/ssl in the master
+    from gevent import monkey
+
+    monkey.patch_all()
+
+# Import and build the app once in the master; workers are forked from it and share its memory
+# copy-on-write, so booting or recycling a worker costs a fork instead of a full import.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+if preload_app:
+    os.environ.setdefault('SPARS_STARTUP_WARMUP', 'true')
+
+# prometheus_client aggregates metrics of all workers through files in this directory.
+# It must be set before any worker imports the app, and is wiped once per master start.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'spars_metrics')
+)
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def when_ready(server):
+    """Runs in the master after the preloaded app is built, before workers are forked."""
+    server.log.info("Serving profile %s: %s workers x %s threads (%s)", SERVING_PROFILE, workers, threads,
+                    worker_class)
+    if preload_app:
+        # Move everything allocated so far out of the GC's reach; collections in the workers
+        # would otherwise touch these objects and copy the shared pages.
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    """Never share database connections opened in the master with a forked worker."""
+    if preload_app:
+        from app.extensions import db
+
+        with worker.app.wsgi().app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """Every worker competes for the job scheduler lease; the one holding it runs the jobs."""
+    from app.util.jobs import start_scheduler
+
+    start_scheduler(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    """Let another worker take over the scheduler right away instead of after the lease expires."""
+    from app.util.jobs import stop_scheduler
+
+    stop_scheduler()
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
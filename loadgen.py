@@ -0,0 +1,202 @@
+"""Standalone load generator for the SPARS API.
+
+Drives the respondent flow (request OTP -> verify OTP -> fetch survey -> submit answers -> list answers)
+with concurrent virtual users against a running server, using a dataset manifest written by
+`flask bench seed`. Only needs `requests`, so it can run from any machine:
+
+    python loadgen.py --url http://127.0.0.1:5015 --dataset bench_dataset.json --vus 16 --duration 30
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+
+STEPS = ('request_otp', 'verify_otp', 'fetch_survey', 'submit_answers', 'list_answers')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return round(sorted_values[min(rank, len(sorted_values) - 1)], 3)
+
+
+def summarize(samples):
+    """Reduce a list of (latency_seconds, ok, query_count) samples to a stats dict."""
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    queries = [sample[2] for sample in samples if sample[2] is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if not sample[1]),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def build_answers(survey, rng):
+    answers = []
+    for question in survey['questions']:
+        if question['options']:
+            answers.append({'question_id': question['id'], 'selected_option_id': rng.choice(question['options'])})
+        else:
+            answers.append({'question_id': question['id'], 'answer_text': f"benchmark answer {rng.randint(0, 9999)}"})
+    return {'answers': answers}
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, url, dataset, deadline, iterations, results, lock, seed):
+        super().__init__(daemon=True)
+        self.index = index
+        self.url = url.rstrip('/')
+        self.dataset = dataset
+        self.deadline = deadline
+        self.iterations = iterations
+        self.results = results
+        self.lock = lock
+        self.rng = random.Random(seed + index)
+        self.session = requests.Session()
+        self.completed = 0
+
+    def call(self, step, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, timeout=30, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        elapsed = time.perf_counter() - start
+        query_count = response.headers.get('X-Query-Count') if response is not None else None
+        with self.lock:
+            self.results[step].append((elapsed, ok, int(query_count) if query_count else None))
+        return response if ok else None
+
+    def run(self):
+        users = self.dataset['users']
+        surveys = self.dataset['surveys']
+        turn = self.index
+        while time.monotonic() < self.deadline and (self.iterations is None or self.completed < self.iterations):
+            # Virtual users stride through the user list so they rarely log in as the same respondent
+            mobile = users[turn % len(users)]
+            turn += self.dataset['vus']
+            survey = self.rng.choice(surveys)
+
+            self.call('request_otp', 'POST', '/spars/auth/request_otp', json={'mobile': mobile})
+            response = self.call('verify_otp', 'POST', '/spars/auth/verify_otp',
+                                 json={'mobile': mobile, 'otp': self.dataset['otp']})
+            if response is None:
+                continue
+            headers = {'Authorization': f"Bearer {response.json()['token']}", 'Accept-Encoding': 'gzip'}
+
+            self.call('fetch_survey', 'GET', f"/spars/survey/{survey['id']}", headers=headers)
+            self.call('submit_answers', 'POST', f"/spars/survey/{survey['id']}/answers",
+                      headers=headers, json=build_answers(survey, self.rng))
+            self.call('list_answers', 'GET', f"/spars/survey/{survey['id']}/answers", headers=headers)
+            self.completed += 1
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(url, dataset, vus=8, duration=30.0, iterations=None, seed=0):
+    """Run the load test and return the report dict."""
+    dataset = dict(dataset, vus=vus)
+    results = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    workers = [VirtualUser(i, url, dataset, deadline, iterations, results, lock, seed) for i in range(vus)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - start
+
+    all_samples = [sample for step in STEPS for sample in results[step]]
+    flows = sum(worker.completed for worker in workers)
+    return {
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'host': platform.node(),
+        'url': url,
+        'vus': vus,
+        'duration_s': round(wall, 3),
+        'flows_completed': flows,
+        'flows_per_s': round(flows / wall, 2) if wall else None,
+        'requests_per_s': round(len(all_samples) / wall, 2) if wall else None,
+        'overall': summarize(all_samples),
+        'steps': {step: summarize(results[step]) for step in STEPS},
+    }
+
+
+def compare(baseline, current):
+    """Return {metric: (baseline, current, change_pct)} for the headline numbers of two reports."""
+    rows = {}
+    pairs = [('requests_per_s', baseline.get('requests_per_s'), current.get('requests_per_s'))]
+    for step in ('overall',) + STEPS:
+        old = baseline['overall'] if step == 'overall' else baseline['steps'].get(step, {})
+        new = current['overall'] if step == 'overall' else current['steps'].get(step, {})
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+            pairs.append((f"{step}.{key}", old.get(key), new.get(key)))
+    for name, old, new in pairs:
+        change = round((new - old) / old * 100, 1) if old and new is not None else None
+        rows[name] = (old, new, change)
+    return rows
+
+
+def format_report(report):
+    lines = [
+        f"{report['flows_completed']} flows in {report['duration_s']}s with {report['vus']} VUs: "
+        f"{report['flows_per_s']} flows/s, {report['requests_per_s']} req/s",
+        f"{'step':<16}{'reqs':>7}{'errs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/req':>8}",
+    ]
+    for step in STEPS + ('overall',):
+        stats = report['overall'] if step == 'overall' else report['steps'][step]
+        cells = [stats['p50_ms'], stats['p95_ms'], stats['p99_ms']]
+        cells = [f"{value:.2f}" if value is not None else '-' for value in cells]
+        queries = stats['queries_per_request']
+        lines.append(f"{step:<16}{stats['requests']:>7}{stats['errors']:>6}{cells[0]:>10}{cells[1]:>10}"
+                     f"{cells[2]:>10}{queries if queries is not None else '-':>8}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SPARS API load generator')
+    parser.add_argument('--url', default='http://127.0.0.1:5015')
+    parser.add_argument('--dataset', default='bench_dataset.json', help='Manifest written by `flask bench seed`')
+    parser.add_argument('--vus', type=int, default=8, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run')
+    parser.add_argument('--iterations', type=int, default=None, help='Flows per virtual user (overrides duration)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='Write the JSON report to this path')
+    args = parser.parse_args()
+
+    with open(args.dataset) as fh:
+        dataset = json.load(fh)
+    duration = float('inf') if args.iterations else args.duration
+    report = run(args.url, dataset, vus=args.vus, duration=duration, iterations=args.iterations, seed=args.seed)
+    print(format_report(report))
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import logging
+from logging.config import fileConfig
+
+from flask import current_app
+
+from alembic import context
+from alembic.operations.ops import DowngradeOps, UpgradeOps
+
+from app.util.tenancy import GLOBAL_TABLES, engine_for
+
+# this is the Alembic Config object, which provides
+# access to the values within the .ini file in use.
+config = context.config
+
+# Interpret the config file for Python logging.
+# This line sets up loggers basically.
+fileConfig(config.config_file_name)
+logger = logging.getLogger('alembic.env')
+
+# `flask db upgrade -x tenant=<name>` (or `flask tenants upgrade`) migrates a tenant database; its
+# revisions only run the shard part, see script.py.mako
+tenant = context.get_x_argument(as_dictionary=True).get('tenant')
+
+
+def get_engine():
+    if tenant is not None:
+        if tenant not in current_app.config['TENANT_DATABASES']:
+            raise RuntimeError(f"Unknown tenant {tenant!r}, configure it in TENANT_DATABASES.")
+        return engine_for(tenant)
+    return current_app.extensions['migrate'].db.engine
+
+
+def get_engine_url():
+    return get_engine().url.render_as_string(hide_password=False).replace('%', '%%')
+
+
+config.set_main_option('sqlalchemy.url', get_engine_url())
+target_db = current_app.extensions['migrate'].db
+
+
+def get_metadata():
+    if hasattr(target_db, 'metadatas'):
+        return target_db.metadatas[None]
+    return target_db.metadata
+
+
+def is_global(table_name):
+    """Tables of the default database only; the user table is also replicated to every shard."""
+    return table_name in GLOBAL_TABLES and table_name != 'user'
+
+
+def include_object(dialect_name):
+    def include(object, name, type_, reflected, compare_to):
+        # Tables created outside the models (the FTS5 index, APScheduler's jobs) are not ours to drop
+        if type_ == 'table' and reflected and compare_to is None:
+            return False
+        # Dialect-specific indexes (MySQL full-text) are compared on their own dialect only
+        ddl_if = getattr(object, '_ddl_if', None)
+        if type_ == 'index' and ddl_if is not None and ddl_if.dialect not in (None, dialect_name):
+            return False
+        return True
+    return include
+
+
+def split_ops(ops):
+    """The shard and the global part of autogenerated operations, rendered separately by script.py.mako."""
+    parts = {'shard': [], 'global': []}
+    for op in ops.ops:
+        parts['global' if is_global(getattr(op, 'table_name', None)) else 'shard'].append(op)
+    if isinstance(ops, UpgradeOps):
+        return [UpgradeOps(ops=part, upgrade_token=f"{name}_upgrades") for name, part in parts.items()]
+    return [DowngradeOps(ops=part, downgrade_token=f"{name}_downgrades") for name, part in parts.items()]
+
+
+def run_migrations_offline():
+    """Run migrations in 'offline' mode.
+
+    This configures the context with just a URL
+    and not an Engine, though an Engine is acceptable
+    here as well.  By skipping the Engine creation
+    we don't even need a DBAPI to be available.
+
+    Calls to context.execute() here emit the given string to the
+    script output.
+
+    """
+    url = config.get_main_option("sqlalchemy.url")
+    context.configure(
+        url=url, target_metadata=get_metadata(), literal_binds=True
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Run migrations in 'online' mode.
+
+    In this scenario we need to create an Engine
+    and associate a connection with the context.
+
+    """
+
+    # this callback is used to prevent an auto-migration from being generated
+    # when there are no changes to the schema, and splits the operations into
+    # the part every shard runs and the part only the default database runs
+    # reference: http://alembic.zzzcomputing.com/en/latest/cookbook.html
+    def process_revision_directives(context, revision, directives):
+        if getattr(config.cmd_opts, 'autogenerate', False):
+            if tenant is not None:
+                raise RuntimeError("Generate revisions on the default database, it has every table.")
+            script = directives[0]
+            if script.upgrade_ops.is_empty():
+                directives[:] = []
+                logger.info('No changes in schema detected.')
+                return
+            script.upgrade_ops = split_ops(script.upgrade_ops)
+            script.downgrade_ops = split_ops(script.downgrade_ops)
+
+    conf_args = current_app.extensions['migrate'].configure_args
+    if conf_args.get("process_revision_directives") is None:
+        conf_args["process_revision_directives"] = process_revision_directives
+
+    connectable = get_engine()
+
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=get_metadata(),
+            include_object=include_object(connection.dialect.name),
+            **conf_args
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,49 @@
+"""${message}
+
+Revision ID: ${up_revision}
+Revises: ${down_revision | comma,n}
+Create Date: ${create_date}
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+${imports if imports else ""}
+
+# revision identifiers, used by Alembic.
+revision = ${repr(up_revision)}
+down_revision = ${repr(down_revision)}
+branch_labels = ${repr(branch_labels)}
+depends_on = ${repr(depends_on)}
+
+
+def on_tenant_database():
+    """Tenant databases (-x tenant=<name>) only have the shard tables."""
+    return context.get_x_argument(as_dictionary=True).get('tenant') is not None
+
+
+def upgrade():
+    upgrade_shard()
+    if not on_tenant_database():
+        upgrade_global()
+
+
+def downgrade():
+    if not on_tenant_database():
+        downgrade_global()
+    downgrade_shard()
+
+
+def upgrade_shard():
+    ${context.get("shard_upgrades", "pass")}
+
+
+def downgrade_shard():
+    ${context.get("shard_downgrades", "pass")}
+
+
+def upgrade_global():
+    ${context.get("global_upgrades", "pass")}
+
+
+def downgrade_global():
+    ${context.get("global_downgrades", "pass")}
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+os.environ.setdefault('FLASK_ENV', 'testing')
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    from app import create_app
+    from app.config import TestingConfig
+    from app.extensions import db
+    from app.model import Role
+
+    # A database of the test's own, not TestingConfig's instance/test_users.db
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'spars.db'}")
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all(Role(name=name) for name in ('SUPERADMIN', 'ADMIN', 'TESTER'))
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    """Create a user with the given role names; returns (user, Authorization header)."""
+    from app.extensions import db
+    from app.model import Role, User
+    from app.util.generator import generate_jwt_token
+
+    def make(mobile, *role_names):
+        user = User(first_name='Test', mobile=mobile)
+        user.roles = Role.query.filter(Role.name.in_(role_names)).all() if role_names else []
+        db.session.add(user)
+        db.session.commit()
+        return user, {'Authorization': f"Bearer {generate_jwt_token(user)}"}
+
+    return make
+
+
+@pytest.fixture
+def survey(make_user):
+    """A survey in the create state, owned by an admin, with one single-choice question."""
+    from app.extensions import db
+    from app.model import Option, Question, Survey
+
+    owner, _ = make_user('9000000000', 'ADMIN')
+    survey = Survey(title='Survey', description='', created_by_user_id=owner.id, status='create')
+    question = Question(text='Pick one', question_type='single-choice', survey=survey)
+    question.options = [Option(text='a', order=0), Option(text='b', order=1)]
+    db.session.add(survey)
+    db.session.commit()
+    return survey
+
+
+@pytest.fixture
+def owner_headers(survey):
+    """Authorization header of the survey's creator."""
+    from app.extensions import db
+    from app.model import User
+    from app.util.generator import generate_jwt_token
+
+    return {'Authorization': f"Bearer {generate_jwt_token(db.session.get(User, survey.created_by_user_id))}"}
+
+
+@pytest.fixture
+def serve():
+    """Run servers (the `flask ... stub` ones) in threads for the test; returns what it is given."""
+    import threading
+
+    servers = []
+
+    def start(server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,38 @@
+from app.extensions import db
+from app.util.funnel import rebuild_funnels
+
+
+def test_funnel_moves_only_with_the_questions(client, make_user, survey, owner_headers):
+    _, tester_headers = make_user('9000000001', 'TESTER')
+    question = survey.questions[0]
+    answers = {'answers': [{'question_id': question.id, 'selected_option_id': question.options[0].id}]}
+
+    def set_state(state):
+        response = client.put(f"/spars/survey/{survey.id}/status", headers=owner_headers,
+                              json={'state': state, 'version': survey.version})
+        assert response.status_code == 200, response.json
+        db.session.refresh(survey)
+
+    def submit():
+        assert client.post(f"/spars/survey/{survey.id}/answers", json=answers,
+                           headers=tester_headers).status_code == 201
+
+    def attempts(query=''):
+        return client.get(f"/spars/survey/{survey.id}/funnel{query}", headers=owner_headers).json['attempts']
+
+    set_state('testing')
+    submit()
+    set_state('create')
+    assert (survey.questions_version, attempts()) == (1, 1)
+
+    response = client.patch(f"/spars/survey/{survey.id}", headers=owner_headers,
+                            json={'questions': [{'id': question.id, 'version': question.version, 'text': 'Pick'}]})
+    assert response.status_code == 200, response.json
+    db.session.refresh(survey)
+    set_state('testing')
+    submit()
+    submit()
+
+    assert (survey.questions_version, attempts(), attempts('?version=1')) == (2, 2, 1)
+    assert rebuild_funnels([survey.id]) == 2
+    assert (attempts(), attempts('?version=1')) == (2, 1)
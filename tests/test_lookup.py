@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from app.util.lookup import CircuitOpen, LookupFailed, lookup_client
+
+
+@pytest.fixture
+def lookup_stub(request, monkeypatch, serve):
+    """The `flask lookup stub` services, with short cache and breaker timeouts; yields the stub."""
+    from app.config import TestingConfig
+    from app.lookup import StubLookupServer
+
+    server = serve(StubLookupServer(('127.0.0.1', 0), missing_rate=0))
+    monkeypatch.setattr(TestingConfig, 'UHID_SERVER', f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(TestingConfig, 'LOOKUP_CACHE_TTL', 0.2)
+    monkeypatch.setattr(TestingConfig, 'LOOKUP_NEGATIVE_TTL', 0.2)
+    monkeypatch.setattr(TestingConfig, 'LOOKUP_BREAKER_THRESHOLD', 2)
+    monkeypatch.setattr(TestingConfig, 'LOOKUP_BREAKER_RESET', 0.2)
+    request.getfixturevalue('app')
+    return server
+
+
+def test_records_and_misses_are_cached_until_they_expire(lookup_stub):
+    client = lookup_client('uhid')
+
+    assert client.get('AIIMS00000042')['uhid'] == 'AIIMS00000042'
+    assert client.get('unknown') is None
+    assert lookup_stub.requests == 2
+    assert client.get('AIIMS00000042')['uhid'] == 'AIIMS00000042'
+    assert client.get('unknown') is None
+    assert lookup_stub.requests == 2
+
+    records = client.get_many(['AIIMS00000042', 'AIIMS00000043', 'AIIMS00000044'])
+    assert sorted(records) == ['AIIMS00000042', 'AIIMS00000043', 'AIIMS00000044']
+    assert lookup_stub.requests == 3  # the two misses in one batch
+
+    time.sleep(0.25)
+    client.get('AIIMS00000042')
+    client.get('unknown')
+    assert lookup_stub.requests == 5
+
+
+def test_circuit_opens_after_repeated_failures_and_closes_after_a_trial(lookup_stub):
+    client = lookup_client('uhid')
+    lookup_stub.fail_rate = 1
+
+    for key in ('AIIMS00000001', 'AIIMS00000002'):
+        with pytest.raises(LookupFailed):
+            client.get(key)
+    with pytest.raises(CircuitOpen):
+        client.get('AIIMS00000003')
+    assert (lookup_stub.requests, client.status()['circuit']) == (2, 'open')
+
+    lookup_stub.fail_rate = 0
+    time.sleep(0.25)
+    assert client.status()['circuit'] == 'half-open'
+    assert client.get('AIIMS00000003')['uhid'] == 'AIIMS00000003'
+    assert (lookup_stub.requests, client.status()['circuit']) == (3, 'closed')
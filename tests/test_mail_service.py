@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+
+from app.extensions import db
+from app.model import MailMessage, MailSuppression
+from app.util.mail_service import create_campaign, dispatch, recipient_address
+
+
+def test_recipient_address_encodes_the_domain():
+    assert recipient_address('a@example.com') == ('a@example.com', False)
+    assert recipient_address('a@exämple.com') == ('a@xn--exmple-cua.com', False)
+    assert recipient_address('zoë@example.com') == ('zoë@example.com', True)
+
+
+@pytest.mark.parametrize('email', ['a@example.com\r\nBcc: b@example.com', 'a example@example.com', 'example.com'])
+def test_recipient_address_rejects_header_injection_and_garbage(email):
+    with pytest.raises(ValueError):
+        recipient_address(email)
+
+
+def test_dispatch_fails_messages_it_cannot_build_and_sends_the_rest(app, make_user, monkeypatch):
+    user, _ = make_user('9000000001')
+    recipients = [(user.id, email, {'link': 'http://spars/survey/1'}) for email in
+                  ('a@example.com', 'b@example.com\nBcc: c@example.com', 'zoë@exämple.com')]
+    create_campaign('invitation', recipients, {'survey': {'id': 1, 'title': 'T', 'description': ''}, 'url': ''})
+
+    sent = []
+    mailer = app.extensions['mailer']
+    monkeypatch.setitem(app.config, 'MAIL_SMTP_HOST', 'smtp.example.com')
+    monkeypatch.setattr(mailer, 'send', lambda messages: sent.extend(messages) or {
+        message_id: ('sent', None) for message_id, *_ in messages})
+
+    assert dispatch() == {'sent': 2, 'failed': 1}
+
+    rows = {row.recipient: row for row in db.session.query(MailMessage)}
+    assert rows['b@example.com\nbcc: c@example.com'].status == 'failed'
+    assert all(row.locked_until is None and row.attempts == 1 for row in rows.values())
+    _, address, message, options = next(message for message in sent if message[1].startswith('zo'))
+    assert (address, options) == ('zoë@xn--exmple-cua.com', ('SMTPUTF8',))
+    assert 'To: zoë@xn--exmple-cua.com\r\n' in message.decode('utf-8')
+
+
+@pytest.fixture
+def smtp_stub(serve):
+    """The `flask mail stub` server on a free port; returns it with the messages it accepted."""
+    from app.mail import StubSmtpServer
+
+    received = []
+    return serve(StubSmtpServer(('127.0.0.1', 0), on_message=lambda *message: received.append(message))), received
+
+
+@pytest.fixture
+def smtp_app(request, monkeypatch, smtp_stub):
+    from app.config import TestingConfig
+
+    server, _ = smtp_stub
+    monkeypatch.setattr(TestingConfig, 'MAIL_SMTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(TestingConfig, 'MAIL_SMTP_PORT', server.server_address[1])
+    monkeypatch.setattr(TestingConfig, 'MAIL_SMTP_STARTTLS', False)
+    monkeypatch.setattr(TestingConfig, 'MAIL_RATE_LIMIT', 0)
+    app = request.getfixturevalue('app')
+    yield app
+    app.extensions['mailer'].pool.close()
+
+
+def test_dispatch_over_smtp_sends_bounces_and_retries(smtp_app, make_user, smtp_stub):
+    _, received = smtp_stub
+    user, _ = make_user('9000000001')
+    recipients = [(user.id, email, {'link': 'http://spars/survey/1'}) for email in
+                  ('a@example.com', 'bounce@example.com', 'tempfail@example.com')]
+    create_campaign('invitation', recipients, {'survey': {'id': 1, 'title': 'T', 'description': ''}, 'url': ''})
+
+    assert dispatch() == {'sent': 1, 'bounced': 1, 'retry': 1}
+
+    rows = {row.recipient: row for row in db.session.query(MailMessage)}
+    assert rows['a@example.com'].status == 'sent'
+    assert [recipients for _, _, recipients, _ in received] == [['a@example.com']]
+    assert (rows['bounce@example.com'].status, rows['bounce@example.com'].last_error[:3]) == ('bounced', '550')
+    assert db.session.get(MailSuppression, 'bounce@example.com').suppressed
+    retried = rows['tempfail@example.com']
+    assert (retried.status, retried.last_error[:3], retried.attempts) == ('queued', '451', 1)
+    assert retried.next_attempt_at > datetime.utcnow()
+    assert db.session.get(MailSuppression, 'tempfail@example.com') is None
@@ -0,0 +1,66 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from app.extensions import db
+from app.model import OutboxCursor
+from app.util.outbox import SIGNATURE_HEADER, TIMESTAMP_HEADER, dispatch, sign, verify_signature
+
+
+def test_verify_signature_rejects_tampered_and_stale_deliveries():
+    def headers(secret, timestamp, body):
+        return {TIMESTAMP_HEADER: timestamp, SIGNATURE_HEADER: sign(secret, timestamp, body)}
+
+    now = str(int(time.time()))
+    assert verify_signature('secret', headers('secret', now, b'{}'), b'{}')
+    assert not verify_signature('secret', headers('secret', now, b'{}'), b'{"events":[]}')
+    assert not verify_signature('secret', headers('other', now, b'{}'), b'{}')
+    old = str(int(time.time()) - 600)
+    assert not verify_signature('secret', headers('secret', old, b'{}'), b'{}')
+
+
+@pytest.fixture
+def webhook(app, serve, monkeypatch):
+    """The `flask outbox stub` consumer, configured as OUTBOX_WEBHOOKS consumer "crm"."""
+    from app.outbox import StubWebhookServer
+
+    server = serve(StubWebhookServer(('127.0.0.1', 0), 'secret'))
+    monkeypatch.setitem(app.config, 'OUTBOX_WEBHOOKS', {
+        'crm': {'url': f"http://127.0.0.1:{server.server_address[1]}/", 'secret': 'secret'}})
+    return server
+
+
+def move(survey, *states):
+    for state in states:
+        survey.status = state
+        db.session.commit()
+
+
+def test_dispatch_delivers_signed_events_in_order_once(survey, webhook):
+    move(survey, 'testing', 'release', 'close')
+
+    assert dispatch() == {'crm': 3}
+    assert dispatch() == {'crm': 0}
+
+    events = [event for delivery in webhook.deliveries for event in delivery['events']]
+    assert [(event['type'], event['data']['to']) for event in events] == [
+        ('survey.status_changed', 'testing'), ('survey.published', 'release'), ('survey.status_changed', 'close')]
+    assert db.session.get(OutboxCursor, 'crm').last_event_id == events[-1]['id']
+
+
+def test_dispatch_backs_off_when_the_consumer_refuses(survey, webhook):
+    webhook.secret = 'rotated'  # the consumer no longer accepts our signature
+    move(survey, 'testing')
+
+    assert dispatch() == {'crm': 0}
+    cursor = db.session.get(OutboxCursor, 'crm')
+    assert (cursor.last_event_id, cursor.failures, cursor.last_error[:8]) == (0, 1, 'HTTP 401')
+    assert cursor.next_attempt_at > datetime.utcnow()
+    assert dispatch() == {}  # backing off, the consumer is not claimed
+
+    webhook.secret = 'secret'
+    cursor.next_attempt_at = None
+    db.session.commit()
+    assert dispatch() == {'crm': 1}
+    assert (cursor.failures, cursor.last_error, len(webhook.seen)) == (0, None, 1)
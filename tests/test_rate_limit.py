@@ -0,0 +1,35 @@
+import pytest
+
+from app.util.rate_limit import client_address
+
+
+def test_client_address_trusts_only_the_configured_hops():
+    assert client_address('127.0.0.1', '203.0.113.7', 1) == '203.0.113.7'
+    assert client_address('127.0.0.1', '198.51.100.1, 203.0.113.7', 1) == '203.0.113.7'
+    assert client_address('127.0.0.1', '198.51.100.1, 203.0.113.7', 2) == '198.51.100.1'
+    assert client_address('127.0.0.1', '203.0.113.7', 2) == '127.0.0.1'
+    assert client_address('127.0.0.1', '203.0.113.7', 0) == '127.0.0.1'
+    assert client_address('127.0.0.1', None, 1) == '127.0.0.1'
+
+
+@pytest.fixture
+def limited_app(request, monkeypatch, tmp_path):
+    from app.config import TestingConfig
+
+    monkeypatch.setattr(TestingConfig, 'RATELIMIT_ENABLED', True)
+    monkeypatch.setattr(TestingConfig, 'RATELIMIT_STORAGE_PATH', str(tmp_path / 'buckets'))
+    monkeypatch.setattr(TestingConfig, 'RATELIMIT_LIMITS', {'request_otp': {'ip': '1/minute'}})
+    monkeypatch.setattr(TestingConfig, 'PROXY_TRUSTED_HOPS', 1)
+    return request.getfixturevalue('app')
+
+
+def test_clients_behind_the_proxy_have_buckets_of_their_own(limited_app):
+    client = limited_app.test_client()
+
+    def request_otp(mobile, forwarded_for):
+        return client.post('/spars/auth/request_otp', json={'mobile': mobile},
+                           headers={'X-Forwarded-For': forwarded_for}).status_code
+
+    assert request_otp('9000000001', '203.0.113.7') == 200
+    assert request_otp('9000000002', '203.0.113.7') == 429
+    assert request_otp('9000000003', '203.0.113.8') == 200
@@ -0,0 +1,34 @@
+from app.extensions import db
+
+
+def test_put_requires_the_version_read(client, survey, owner_headers):
+    url = f"/spars/survey/{survey.id}"
+    version = survey.version
+
+    def put(**data):
+        return client.put(url, json={'title': 'New', 'state': 'create', **data}, headers=owner_headers).status_code
+
+    assert put() == 400
+    assert put(version=version) == 200
+    assert put(version=version) == 409
+
+
+def test_status_change_requires_the_version_read(client, survey, owner_headers):
+    url = f"/spars/survey/{survey.id}/status"
+
+    assert client.put(url, json={'state': 'testing'}, headers=owner_headers).status_code == 400
+    assert client.put(url, json={'state': 'testing', 'version': survey.version},
+                      headers=owner_headers).status_code == 200
+
+
+def test_only_the_creator_and_editors_manage_the_survey(client, make_user, survey, owner_headers):
+    editor, editor_headers = make_user('9000000001')
+    _, other_headers = make_user('9000000002', 'ADMIN')
+    survey.editors.append(editor)
+    db.session.commit()
+
+    for path in ('funnel', 'respondents', 'mail', 'invitations'):
+        url = f"/spars/survey/{survey.id}/{path}"
+        assert client.get(url, headers=other_headers).status_code == 403
+        assert client.get(url, headers=editor_headers).status_code == 200
+        assert client.get(url, headers=owner_headers).status_code == 200
@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+
+from app.extensions import db
+from app.model import SurveyAttempt
+
+
+def answers(survey):
+    question = survey.questions[0]
+    return {'answers': [{'question_id': question.id, 'selected_option_id': question.options[0].id}]}
+
+
+def set_status(survey, status):
+    survey.status = status
+    db.session.commit()
+
+
+def test_user_submits_to_released_survey(client, make_user, survey):
+    set_status(survey, 'release')
+    _, headers = make_user('9000000001')
+
+    response = client.post(f"/spars/survey/{survey.id}/answers", json=answers(survey), headers=headers)
+
+    assert response.status_code == 201, response.json
+    assert response.json['answers_count'] == 1
+    assert db.session.query(SurveyAttempt).filter_by(survey_id=survey.id).count() == 1
+
+
+def test_only_testers_submit_to_survey_in_testing(client, make_user, survey):
+    set_status(survey, 'testing')
+    _, user_headers = make_user('9000000001')
+    _, tester_headers = make_user('9000000002', 'TESTER')
+
+    assert client.post(f"/spars/survey/{survey.id}/answers", json=answers(survey), headers=user_headers).status_code == 403
+    assert client.post(f"/spars/survey/{survey.id}/answers", json=answers(survey), headers=tester_headers).status_code == 201
+
+
+def test_closed_survey_rejects_submissions(client, make_user, survey):
+    set_status(survey, 'close')
+    _, headers = make_user('9000000002', 'TESTER')
+
+    assert client.post(f"/spars/survey/{survey.id}/answers", json=answers(survey), headers=headers).status_code == 403
+
+
+def asgi_post(app, url, body, headers):
+    """POST through the ASGI entry point, which serves answer submission with its own handler."""
+    from app.asgi import SparsAsgi
+
+    asgi = SparsAsgi(app)
+
+    async def post():
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url='http://spars') as client:
+                return await client.post(url, json=body, headers=headers)
+        finally:
+            for engine in asgi.engines.values():
+                await engine.dispose()
+
+    return asyncio.run(post())
+
+
+def test_asgi_submits_to_released_survey(app, make_user, survey):
+    set_status(survey, 'release')
+    _, headers = make_user('9000000001')
+
+    response = asgi_post(app, f"/spars/survey/{survey.id}/answers", answers(survey), headers)
+
+    assert response.status_code == 201, response.json()
+    assert response.json()['answers_count'] == 1
+
+
+def test_asgi_applies_the_same_testing_rules(app, make_user, survey):
+    set_status(survey, 'testing')
+    _, user_headers = make_user('9000000001')
+    _, tester_headers = make_user('9000000002', 'TESTER')
+    url = f"/spars/survey/{survey.id}/answers"
+
+    assert asgi_post(app, url, answers(survey), user_headers).status_code == 403
+    assert asgi_post(app, url, answers(survey), tester_headers).status_code == 201